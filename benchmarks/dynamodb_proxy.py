@@ -0,0 +1,82 @@
+from collections import Counter
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import urlsplit
+import threading
+
+
+# Forwards requests to a local DynamoDB and counts them by operation, ccproxy is
+# pointed to it via DYNAMODB_HOST so calls are counted without touching its code.
+class DynamoDBCountingProxy:
+    def __init__(self, upstream_url: str) -> None:
+        upstream = urlsplit(upstream_url)
+        if upstream.scheme != 'http' or upstream.hostname is None:
+            raise ValueError(f'Only plain HTTP local DynamoDB is supported, "{upstream_url}" given')
+
+        self.upstream_host = upstream.hostname
+        self.upstream_port = upstream.port or 80
+        self.request_counts: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _create_handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self) -> 'DynamoDBCountingProxy':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'DynamoDBCountingProxy':
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.request_counts.clear()
+
+    def count(self, operation: str) -> None:
+        with self._lock:
+            self.request_counts[operation] += 1
+
+
+def _create_handler(proxy: DynamoDBCountingProxy) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            # e.g. "DynamoDB_20120810.GetItem"
+            proxy.count(self.headers.get('X-Amz-Target', '').rpartition('.')[2])
+
+            connection = HTTPConnection(proxy.upstream_host, proxy.upstream_port)
+            try:
+                connection.request('POST', self.path, body, dict(self.headers.items()))
+                response = connection.getresponse()
+                payload = response.read()
+
+                self.send_response(response.status)
+                for name, value in response.getheaders():
+                    if name.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+                        self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            finally:
+                connection.close()
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    return Handler
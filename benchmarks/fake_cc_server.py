@@ -0,0 +1,204 @@
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+
+# Faults injected into "/SetValue" and "/GetValue" requests, rates are
+# probabilities per request. "/Login" is only ever slowed down, so a client
+# that re-authenticates always gets a session in the end.
+@dataclass
+class Faults:
+    # seconds added to every request, plus up to latency_jitter more
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # the session of the request is dropped on the server, it's answered with 401
+    session_expiry_rate: float = 0.0
+    # answered with 503, like a gateway in front of a restarting server does
+    error_rate: float = 0.0
+    # the connection is closed without a response
+    drop_rate: float = 0.0
+
+
+# Minimal stand-in for a ComfortClick server: "/Login" issues session cookies,
+# "/SetValue" and "/GetValue" accept requests that carry one of them and answer
+# 401 otherwise. "/SetValue" toggles the value of an object, "/GetValue" reads
+# it back. Faults are injected at random, see Faults.
+class FakeComfortClickServer:
+    def __init__(self, faults: Optional[Faults] = None, seed: Optional[int] = None) -> None:
+        self.faults = faults or Faults()
+        self.request_counts: Counter[str] = Counter()
+        self.fault_counts: Counter[str] = Counter()
+        self.tokens: set[str] = set()
+        self.values: dict[str, bool] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _create_handler(self))
+        self._server.daemon_threads = True
+        # the default of 5 refuses connections under load
+        self._server.request_queue_size = 1024
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self) -> 'FakeComfortClickServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeComfortClickServer':
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.request_counts.clear()
+            self.fault_counts.clear()
+
+    def expire_sessions(self) -> None:
+        with self._lock:
+            self.tokens.clear()
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.request_counts[path] += 1
+
+    def issue_token(self) -> str:
+        token = str(uuid.uuid4())
+        with self._lock:
+            self.tokens.add(token)
+
+        return token
+
+    def get_token(self, cookie_header: Optional[str]) -> Optional[str]:
+        if cookie_header is None:
+            return None
+
+        cookies = dict(
+            part.strip().partition('=')[::2] for part in cookie_header.split(';') if '=' in part
+        )
+
+        return cookies.get('Token')
+
+    def is_valid_cookie(self, cookie_header: Optional[str]) -> bool:
+        token = self.get_token(cookie_header)
+        with self._lock:
+            return token in self.tokens
+
+    def get_latency(self) -> float:
+        with self._lock:
+            return self.faults.latency + self._random.uniform(0, self.faults.latency_jitter)
+
+    # picks the fault to inject into a request, if any
+    def pick_fault(self, cookie_header: Optional[str]) -> Optional[str]:
+        with self._lock:
+            roll = self._random.random()
+            fault = None
+            for name, rate in (
+                ('drop', self.faults.drop_rate),
+                ('error', self.faults.error_rate),
+                ('session_expiry', self.faults.session_expiry_rate),
+            ):
+                if roll < rate:
+                    fault = name
+                    break
+                roll -= rate
+
+            if fault is not None:
+                self.fault_counts[fault] += 1
+            if fault == 'session_expiry':
+                self.tokens.discard(self.get_token(cookie_header) or '')
+
+            return fault
+
+    def toggle_value(self, object_name: str) -> None:
+        with self._lock:
+            self.values[object_name] = not self.values.get(object_name, False)
+
+    def get_value(self, object_name: str) -> bool:
+        with self._lock:
+            return self.values.get(object_name, False)
+
+
+def _create_handler(server: FakeComfortClickServer) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # TCP_NODELAY, otherwise the body written after the headers waits for the
+        # client's delayed ACK and every request on a kept-alive connection takes ~40ms
+        disable_nagle_algorithm = True
+
+        def do_HEAD(self) -> None:
+            server.count(self.path)
+            self._respond(200, None)
+
+        def do_POST(self) -> None:
+            server.count(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            latency = server.get_latency()
+            if latency > 0:
+                time.sleep(latency)
+
+            if self.path == '/Login':
+                json.loads(body)
+                self._respond(
+                    200,
+                    {'Status': 'OK'},
+                    {'Set-Cookie': f'Token={server.issue_token()}; HttpOnly'}
+                )
+                return
+            elif self.path not in ('/SetValue', '/GetValue'):
+                self._respond(404, None)
+                return
+
+            fault = server.pick_fault(self.headers.get('Cookie'))
+            if fault == 'drop':
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            elif fault == 'error':
+                self._respond(503, None)
+                return
+
+            if not server.is_valid_cookie(self.headers.get('Cookie')):
+                self._respond(401, None)
+                return
+
+            object_name = json.loads(body).get('objectName', '')
+            if self.path == '/SetValue':
+                server.toggle_value(object_name)
+                self._respond(200, {})
+            else:
+                self._respond(200, {'Value': server.get_value(object_name)})
+
+        def _respond(self, status: int, body: Any, headers: dict[str, str] = {}) -> None:
+            payload = b'' if body is None else json.dumps(body).encode('utf-8')
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(payload)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    return Handler
@@ -0,0 +1,328 @@
+# Load test for process_action_handler and login_handler: replays a trace of
+# requests at a target rate with up to --concurrency of them in flight, and
+# reports throughput, tail latency, ComfortClick calls per requested action
+# (retries and re-logins after 401s make it go above 1) and DynamoDB calls.
+#
+# ComfortClick is benchmarks.fake_cc_server with faults injected as asked,
+# DynamoDB is the local one (`make local-db`) behind the counting proxy, like
+# in benchmarks.run. Handlers are invoked in-process, so everything they keep
+# warm is shared by all requests, like in a long-running server:
+#
+#   make load OPTS="--synthetic 2000 --rate 200 --concurrency 100 --session-expiry-rate 0.02"
+#   python -m benchmarks.load --trace trace.jsonl --concurrency 50 --output load.json
+#
+# A trace is a JSONL file with a request per line, e.g.
+#
+#   {"at": 0.5, "account": 3, "action": "garage_door"}
+#   {"account": 1, "action": "garage_door,front_door"}
+#   {"account": 0, "scene": "leaving_home"}
+#   {"account": 2, "read": "garage_door,lights"}
+#   {"handler": "login", "account": 2}
+#
+# "at" is when to send the request, in seconds from the start of the run, lines
+# without it are sent at --rate. "account" is an index into --accounts accounts
+# that are logged in before the run, actions and scenes are the ones of
+# LOAD_CONFIG below.
+from benchmarks.dynamodb_proxy import DynamoDBCountingProxy
+from benchmarks.fake_cc_server import Faults, FakeComfortClickServer
+from benchmarks.run import load_handler, summarize_latency, assert_succeeded, get_git_revision
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterator, Optional
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+
+LOAD_CONFIG: dict[str, Any] = {
+    'messages': {
+        'garage_door': ['Garage door'],
+        'front_door': ['Front door'],
+        'ventilation': ['Ventilation'],
+        'lights': ['Lights'],
+        'leaving_home': ['Bye'],
+    },
+    'actions': {
+        'garage_door': 'Tasks\\Garage door',
+        'front_door': 'Tasks\\Front door',
+        'ventilation': 'Tasks\\Ventilation',
+        'lights': 'Tasks\\Lights',
+    },
+    'scenes': {
+        'leaving_home': ['garage_door', 'front_door', 'lights'],
+    }
+}
+
+LOAD_PASSWORD = 'load-password'
+
+
+def get_username(account: int) -> str:
+    return f'load-user-{account}'
+
+
+# Toggles of a single action are the bulk of real traffic, the rest is a mix of
+# batches, scenes, reads and logins
+def generate_trace(count: int, accounts: int, seed: Optional[int]) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    actions = list(LOAD_CONFIG['actions'].keys())
+
+    trace: list[dict[str, Any]] = []
+    for _ in range(count):
+        request: dict[str, Any] = {'account': rng.randrange(accounts)}
+        roll = rng.random()
+        if roll < 0.7:
+            request['action'] = rng.choice(actions)
+        elif roll < 0.8:
+            request['action'] = ','.join(rng.sample(actions, 2))
+        elif roll < 0.85:
+            request['scene'] = rng.choice(list(LOAD_CONFIG['scenes'].keys()))
+        elif roll < 0.98:
+            request['read'] = ','.join(rng.sample(actions, rng.randint(1, 2)))
+        else:
+            request['handler'] = 'login'
+        trace.append(request)
+
+    return trace
+
+
+def read_trace(path: str) -> list[dict[str, Any]]:
+    with open(path) as reader:
+        return [json.loads(line) for line in reader if line.strip() != '']
+
+
+def create_event(request: dict[str, Any], account_ids: list[str], cc_url: str) -> dict[str, Any]:
+    account = int(request.get('account', 0))
+
+    if request.get('handler', 'process_action') == 'login':
+        return {
+            'body': json.dumps({'username': get_username(account), 'password': LOAD_PASSWORD, 'host': cc_url})
+        }
+
+    return {
+        'queryStringParameters': {
+            name: request[name] for name in ('action', 'scene', 'read') if name in request
+        },
+        'headers': {'x-ccproxy-account': account_ids[account % len(account_ids)]}
+    }
+
+
+# ComfortClick calls a request needs when nothing goes wrong and nothing is cached
+def count_intended_calls(request: dict[str, Any]) -> int:
+    if request.get('handler', 'process_action') == 'login':
+        return 1
+    elif 'read' in request:
+        return len({name.strip() for name in str(request['read']).split(',') if name.strip() != ''})
+
+    names = {name.strip() for name in str(request.get('action', '')).split(',') if name.strip() != ''}
+
+    return len(names | set(LOAD_CONFIG['scenes'].get(request.get('scene', ''), [])))
+
+
+# Requests are sent on schedule no matter how many are still in flight, so their
+# latency is measured from when they were meant to be sent: time spent waiting
+# for a free worker counts too.
+def run_load(
+    trace: list[dict[str, Any]],
+    handlers: dict[str, Callable[..., dict[str, Any]]],
+    account_ids: list[str],
+    cc_url: str,
+    rate: float,
+    concurrency: int
+) -> tuple[list[dict[str, Any]], float]:
+    def invoke(request: dict[str, Any], scheduled_at: float) -> dict[str, Any]:
+        started_at = time.perf_counter()
+        try:
+            result = handlers[request.get('handler', 'process_action')](
+                create_event(request, account_ids, cc_url), {}
+            )
+            status = str(result.get('statusCode'))
+            replayed = 'x-ccproxy-idempotent-replay' in result.get('headers', {})
+        except Exception as e:
+            status = type(e).__name__
+            replayed = False
+        finished_at = time.perf_counter()
+
+        return {
+            'latency_ms': (finished_at - scheduled_at) * 1000,
+            'service_ms': (finished_at - started_at) * 1000,
+            'status': status,
+            'replayed': replayed,
+        }
+
+    futures: list[Future[dict[str, Any]]] = []
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='load') as executor:
+        for scheduled_at, request in _schedule(trace, started_at, rate):
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(invoke, request, scheduled_at))
+
+    duration = time.perf_counter() - started_at
+
+    return [future.result() for future in futures], duration
+
+
+def _schedule(trace: list[dict[str, Any]], started_at: float, rate: float) -> Iterator[tuple[float, dict[str, Any]]]:
+    schedule = [
+        (started_at + (float(request['at']) if 'at' in request else index / rate), request)
+        for index, request in enumerate(trace)
+    ]
+
+    return iter(sorted(schedule, key=lambda entry: entry[0]))
+
+
+def summarize(
+    trace: list[dict[str, Any]],
+    samples: list[dict[str, Any]],
+    duration: float,
+    server: FakeComfortClickServer,
+    dynamodb_proxy: DynamoDBCountingProxy
+) -> dict[str, Any]:
+    requests = len(samples)
+    comfortclick_calls = dict(server.request_counts)
+    intended_calls = sum(count_intended_calls(request) for request in trace)
+    logins_intended = len([request for request in trace if request.get('handler') == 'login'])
+
+    return {
+        'requests': requests,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(requests / duration, 1),
+        'latency_ms': summarize_latency(samples),
+        'service_ms': summarize_latency([{'latency_ms': sample['service_ms']} for sample in samples]),
+        'status_codes': dict(sorted(Counter(sample['status'] for sample in samples).items())),
+        'idempotent_replays': len([sample for sample in samples if sample['replayed']]),
+        'comfortclick': {
+            'calls': comfortclick_calls,
+            'calls_per_request': {path: round(count / requests, 3) for path, count in comfortclick_calls.items()},
+            # 1.0 when every requested action took exactly one call, cached reads make it go lower
+            'amplification': round(sum(comfortclick_calls.values()) / max(1, intended_calls), 3),
+            # logins that weren't asked for, i.e. sessions that had to be renewed
+            'relogins': comfortclick_calls.get('/Login', 0) - logins_intended,
+            'faults_injected': dict(server.fault_counts),
+        },
+        'dynamodb': {
+            'calls': dict(dynamodb_proxy.request_counts),
+            'calls_per_request': {
+                name: round(count / requests, 3) for name, count in dynamodb_proxy.request_counts.items()
+            },
+        },
+    }
+
+
+def run(args: argparse.Namespace, dynamodb_proxy: DynamoDBCountingProxy) -> dict[str, Any]:
+    from ccproxy import tutils
+
+    tutils.create_accounts_table_if_not_exists()
+
+    trace = read_trace(args.trace) if args.trace is not None else generate_trace(
+        args.synthetic, args.accounts, args.seed
+    )
+    faults = Faults(
+        latency=args.latency / 1000,
+        latency_jitter=args.latency_jitter / 1000,
+        session_expiry_rate=args.session_expiry_rate,
+        error_rate=args.error_rate,
+        drop_rate=args.drop_rate
+    )
+    handlers = {
+        'process_action': load_handler('process_action'),
+        'login': load_handler('login'),
+    }
+
+    with FakeComfortClickServer(faults, args.seed) as server:
+        account_ids = []
+        for account in range(args.accounts):
+            result = handlers['login'](create_event({'handler': 'login', 'account': account}, [], server.url), {})
+            assert_succeeded(result)
+            account_ids.append(result['body'])
+
+        server.reset_counts()
+        dynamodb_proxy.reset_counts()
+
+        samples, duration = run_load(trace, handlers, account_ids, server.url, args.rate, args.concurrency)
+        report = summarize(trace, samples, duration, server, dynamodb_proxy)
+
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revision': get_git_revision(),
+            'trace': args.trace or f'synthetic({args.synthetic}, seed={args.seed})',
+            'rate': args.rate,
+            'concurrency': args.concurrency,
+            'accounts': args.accounts,
+            'idempotency_window': args.idempotency_window,
+            'faults': asdict(faults),
+        },
+        'results': report
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load tests ccproxy handlers against a faulty ComfortClick')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--trace', help='JSONL file with requests to replay')
+    source.add_argument('--synthetic', type=int, default=1000, help='number of requests to generate')
+    parser.add_argument('--rate', type=float, default=100.0, help='requests per second, unless a line has "at"')
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight at most')
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--seed', type=int, help='makes synthetic traces and injected faults repeatable')
+    parser.add_argument('--latency', type=float, default=20.0, help='ComfortClick latency, in milliseconds')
+    parser.add_argument('--latency-jitter', type=float, default=30.0, help='in milliseconds')
+    parser.add_argument('--session-expiry-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    # random synthetic requests repeat an account and action far more often than real ones do
+    parser.add_argument(
+        '--idempotency-window', type=float, default=0.0, help='IDEMPOTENCY_WINDOW, 0 turns deduplication off'
+    )
+    parser.add_argument('--output', help='file to write JSON report to, stdout by default')
+    parser.add_argument('--verbose', action='store_true', help='print what ccproxy logs')
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if not args.verbose:
+        # injected faults are logged as warnings by every request
+        logging.getLogger('ccproxy').setLevel(logging.CRITICAL + 1)
+
+    from ccproxy import config
+
+    if config.DYNAMODB_HOST == '':
+        raise RuntimeError('DYNAMODB_HOST must point to a local DynamoDB, run "make local-db" first')
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump(LOAD_CONFIG, config_file)
+
+    with DynamoDBCountingProxy(config.DYNAMODB_HOST) as dynamodb_proxy:
+        os.environ['IDEMPOTENCY_WINDOW'] = str(args.idempotency_window)
+        os.environ['CONFIG_FILE'] = config_file.name
+        os.environ['DYNAMODB_HOST'] = dynamodb_proxy.url
+        del config.DYNAMODB_HOST
+
+        try:
+            report = run(args, dynamodb_proxy)
+        finally:
+            os.unlink(config_file.name)
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as writer:
+            writer.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Microbenchmarks for the model layer: the per-request cost of building the
+# account loaded from DynamoDB and the other model operations a request does.
+# Runs without DynamoDB or ComfortClick, the report is printed as JSON with the
+# best time per operation of --repeat rounds, in microseconds:
+#
+#   make bench-models
+#   python -m benchmarks.models --number 20000 --output models.json
+from benchmarks.run import get_git_revision
+from datetime import datetime, timezone
+from typing import Any, Callable
+import argparse
+import json
+import platform
+import timeit
+
+_NOW = datetime.now(timezone.utc)
+
+_RAW_CONFIG = {
+    'messages': {
+        'garage_door': ['Opening garage door', 'Closing garage door'],
+        'front_door': ['Unlocking front door'],
+        'lights': ['Toggling lights'],
+    },
+    'actions': {
+        'garage_door': 'Doors\\Garage',
+        'front_door': 'Doors\\Front',
+        'lights': 'Lights\\All',
+    },
+    'scenes': {
+        'leaving_home': ['garage_door', 'lights'],
+    },
+}
+
+
+def _decrypt(value: str) -> str:
+    return value
+
+
+def create_operations() -> dict[str, Callable[[], Any]]:
+    from ccproxy import api, model
+
+    account = model.Account(username='un', password='pwd', host='hst', cookie='ck', version=1)
+    config = api.parse_config(_RAW_CONFIG)
+
+    def hydrate_account() -> Any:
+        # what AccountTable._hydrate() does for every request
+        return model.Account.from_encrypted_password(
+            'encrypted-pwd',
+            _decrypt,
+            id='1',
+            username='un',
+            host='hst',
+            cookie='ck',
+            cookie_issued_at=_NOW,
+            cookie_expires_at=_NOW,
+            version=1
+        )
+
+    def create_account() -> Any:
+        return model.Account(username='un', password='pwd', host='hst', cookie='ck')
+
+    def set_cookie() -> None:
+        account.cookie = 'ck'
+        account.mark_clean()
+
+    def parse_credentials() -> Any:
+        return model.CredentialsEnvelope.parse_obj({'username': 'un', 'password': 'pwd', 'host': 'hst'})
+
+    def create_cookie() -> Any:
+        return model.Cookie(value='Token=ck', issued_at=_NOW, expires_at=None)
+
+    # only done when the config file changes, RemoteDeviceController reuses it
+    def parse_config() -> Any:
+        return api.parse_config(_RAW_CONFIG)
+
+    def create_controller() -> Any:
+        return api.RemoteDeviceController(config, account)
+
+    return {
+        'hydrate_account': hydrate_account,
+        'create_account': create_account,
+        'set_cookie': set_cookie,
+        'parse_credentials': parse_credentials,
+        'create_cookie': create_cookie,
+        'parse_config': parse_config,
+        'create_controller': create_controller,
+    }
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict[str, Any]:
+    results = {}
+    for name, operation in create_operations().items():
+        timings = timeit.repeat(operation, number=args.number, repeat=args.repeat)
+        results[name] = round(min(timings) / args.number * 1_000_000, 3)
+
+    return {
+        'us_per_operation': results,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revision': get_git_revision(),
+            'number': args.number,
+            'repeat': args.repeat,
+        },
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks ccproxy models')
+    parser.add_argument('--number', type=int, default=10000, help='calls per round')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per operation, the best one is reported')
+    parser.add_argument('--output', help='file to write JSON report to, stdout by default')
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    output = json.dumps(run_benchmarks(args), indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as writer:
+            writer.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
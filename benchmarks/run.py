@@ -0,0 +1,326 @@
+# Latency benchmarks for process_action_handler and login_handler.
+#
+# Every handler is measured in three scenarios:
+#   - cold_import: importing the handler module in a fresh interpreter
+#   - first_call: the first invocation in a fresh interpreter (nothing cached yet)
+#   - warm: steady state invocations in an already warmed up process
+#
+# ComfortClick is replaced with benchmarks.fake_cc_server, DynamoDB is the local one
+# from docker/local-dynamodb.yml (`make local-db`), reached through a proxy that
+# counts calls per operation. The report is printed as JSON:
+#
+#   make bench
+#   python -m benchmarks.run --iterations 500 --output bench.json
+from benchmarks.dynamodb_proxy import DynamoDBCountingProxy
+from benchmarks.fake_cc_server import FakeComfortClickServer
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HANDLERS = {
+    'process_action': ('ccproxy.handlers.process_action', 'process_action_handler'),
+    'login': ('ccproxy.handlers.login', 'login_handler'),
+}
+
+BENCH_ACTION = 'bench_action'
+BENCH_USERNAME = 'bench-user'
+BENCH_PASSWORD = 'bench-password'
+
+_BENCH_CONFIG = {
+    'messages': {BENCH_ACTION: ['Done']},
+    'actions': {BENCH_ACTION: 'Tasks\\Bench'}
+}
+
+
+def create_event(handler: str, account_id: str, cc_url: str) -> dict[str, Any]:
+    if handler == 'process_action':
+        return {
+            'queryStringParameters': {'action': BENCH_ACTION},
+            'headers': {'x-ccproxy-account': account_id}
+        }
+
+    return {
+        'body': json.dumps({'username': BENCH_USERNAME, 'password': BENCH_PASSWORD, 'host': cc_url})
+    }
+
+
+def load_handler(handler: str) -> Callable[..., dict[str, Any]]:
+    module_name, function_name = HANDLERS[handler]
+    handler_fn: Callable[..., dict[str, Any]] = getattr(importlib.import_module(module_name), function_name)
+
+    return handler_fn
+
+
+def measure(fn: Callable[[], Any], trace_allocations: bool) -> dict[str, Any]:
+    if trace_allocations:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        current_before, _ = tracemalloc.get_traced_memory()
+
+    started_at = time.perf_counter()
+    result = fn()
+    latency_ms = (time.perf_counter() - started_at) * 1000
+
+    sample: dict[str, Any] = {'latency_ms': latency_ms, 'result': result}
+    if trace_allocations:
+        current_after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sample['peak_kb'] = (peak - current_before) / 1024
+        sample['retained_kb'] = (current_after - current_before) / 1024
+
+    return sample
+
+
+# --- worker, runs inside a fresh interpreter ---
+
+def run_worker(args: argparse.Namespace) -> None:
+    if args.worker == 'cold_import':
+        sample = measure(lambda: load_handler(args.handler), args.trace_allocations)
+    else:
+        handler_fn = load_handler(args.handler)
+        event = create_event(args.handler, args.account, args.cc_url)
+        sample = measure(lambda: handler_fn(event, {}), args.trace_allocations)
+        assert_succeeded(sample['result'])
+
+    del sample['result']
+    print(json.dumps(sample))
+
+
+def assert_succeeded(result: dict[str, Any]) -> None:
+    if result.get('statusCode') != 200:
+        raise RuntimeError(f'Handler failed: {result}')
+
+
+# --- orchestration ---
+
+def run_in_fresh_interpreter(
+    scenario: str,
+    handler: str,
+    account_id: str,
+    server: FakeComfortClickServer,
+    dynamodb_proxy: DynamoDBCountingProxy,
+    trace_allocations: bool
+) -> dict[str, Any]:
+    server.reset_counts()
+    dynamodb_proxy.reset_counts()
+
+    command = [
+        sys.executable, '-m', 'benchmarks.run',
+        '--worker', scenario,
+        '--handler', handler,
+        '--account', account_id,
+        '--cc-url', server.url
+    ]
+    if trace_allocations:
+        command.append('--trace-allocations')
+
+    completed = subprocess.run(command, capture_output=True, text=True, check=True)
+    sample: dict[str, Any] = json.loads(completed.stdout.strip().splitlines()[-1])
+    sample['comfortclick_calls'] = dict(server.request_counts)
+    sample['dynamodb_calls'] = dict(dynamodb_proxy.request_counts)
+
+    return sample
+
+
+def run_warm(
+    handler: str,
+    account_id: str,
+    server: FakeComfortClickServer,
+    dynamodb_proxy: DynamoDBCountingProxy,
+    iterations: int,
+    allocation_iterations: int
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]], dict[str, float], dict[str, float]]:
+    handler_fn = load_handler(handler)
+    event = create_event(handler, account_id, server.url)
+
+    assert_succeeded(handler_fn(event, {}))  # warms up the process
+
+    server.reset_counts()
+    dynamodb_proxy.reset_counts()
+
+    samples = []
+    for _ in range(iterations):
+        sample = measure(lambda: handler_fn(event, {}), False)
+        assert_succeeded(sample['result'])
+        samples.append(sample)
+
+    comfortclick_calls = {path: count / iterations for path, count in server.request_counts.items()}
+    dynamodb_calls_per_request = {
+        name: count / iterations for name, count in dynamodb_proxy.request_counts.items()
+    }
+
+    allocation_samples = [
+        measure(lambda: handler_fn(event, {}), True) for _ in range(allocation_iterations)
+    ]
+
+    return samples, allocation_samples, comfortclick_calls, dynamodb_calls_per_request
+
+
+def summarize_latency(samples: list[dict[str, Any]]) -> dict[str, float]:
+    latencies = sorted(sample['latency_ms'] for sample in samples)
+    if len(latencies) == 1:
+        percentiles = [latencies[0]] * 99
+    else:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+
+    return {
+        'p50': round(percentiles[49], 3),
+        'p95': round(percentiles[94], 3),
+        'p99': round(percentiles[98], 3),
+        'mean': round(statistics.fmean(latencies), 3),
+        'min': round(latencies[0], 3),
+        'max': round(latencies[-1], 3),
+    }
+
+
+def summarize_allocations(samples: list[dict[str, Any]]) -> dict[str, float]:
+    return {
+        'peak_kb': round(statistics.median(sample['peak_kb'] for sample in samples), 1),
+        'retained_kb': round(statistics.median(sample['retained_kb'] for sample in samples), 1),
+    }
+
+
+def average_counts(samples: list[dict[str, Any]], key: str) -> dict[str, float]:
+    total: Counter[str] = Counter()
+    for sample in samples:
+        total.update(sample[key])
+
+    return {name: count / len(samples) for name, count in sorted(total.items())}
+
+
+def run_benchmarks(args: argparse.Namespace, dynamodb_proxy: DynamoDBCountingProxy) -> dict[str, Any]:
+    from ccproxy import tutils
+
+    tutils.create_accounts_table_if_not_exists()
+
+    results: dict[str, Any] = {}
+    with FakeComfortClickServer() as server:
+        login_result = load_handler('login')(create_event('login', '', server.url), {})
+        assert_succeeded(login_result)
+        account_id = login_result['body']
+
+        for handler in args.handlers:
+            handler_results: dict[str, Any] = {}
+
+            for scenario in ('cold_import', 'first_call'):
+                samples = [
+                    run_in_fresh_interpreter(scenario, handler, account_id, server, dynamodb_proxy, False)
+                    for _ in range(args.cold_samples)
+                ]
+                allocation_samples = [
+                    run_in_fresh_interpreter(scenario, handler, account_id, server, dynamodb_proxy, True)
+                    for _ in range(max(1, args.cold_samples // 5))
+                ]
+                handler_results[scenario] = {
+                    'samples': len(samples),
+                    'latency_ms': summarize_latency(samples),
+                    'allocations': summarize_allocations(allocation_samples),
+                    'outbound_per_request': {
+                        'comfortclick': average_counts(samples, 'comfortclick_calls'),
+                        'dynamodb': average_counts(samples, 'dynamodb_calls'),
+                    }
+                }
+
+            samples, allocation_samples, comfortclick_calls, dynamodb_calls_per_request = run_warm(
+                handler, account_id, server, dynamodb_proxy, args.iterations, args.allocation_iterations
+            )
+            handler_results['warm'] = {
+                'samples': len(samples),
+                'latency_ms': summarize_latency(samples),
+                'allocations': summarize_allocations(allocation_samples),
+                'outbound_per_request': {
+                    'comfortclick': comfortclick_calls,
+                    'dynamodb': dynamodb_calls_per_request,
+                }
+            }
+
+            results[handler] = handler_results
+
+    return {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revision': get_git_revision(),
+            'iterations': args.iterations,
+            'cold_samples': args.cold_samples,
+        },
+        'results': results
+    }
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks ccproxy handlers')
+    parser.add_argument('--handlers', nargs='+', choices=list(HANDLERS.keys()), default=list(HANDLERS.keys()))
+    parser.add_argument('--iterations', type=int, default=200, help='warm invocations per handler')
+    parser.add_argument('--allocation-iterations', type=int, default=20)
+    parser.add_argument('--cold-samples', type=int, default=10, help='fresh interpreters per cold scenario')
+    parser.add_argument('--output', help='file to write JSON report to, stdout by default')
+    # internal, used when a scenario runs in a fresh interpreter
+    parser.add_argument('--worker', choices=['cold_import', 'first_call'], help=argparse.SUPPRESS)
+    parser.add_argument('--handler', choices=list(HANDLERS.keys()), help=argparse.SUPPRESS)
+    parser.add_argument('--account', help=argparse.SUPPRESS)
+    parser.add_argument('--cc-url', help=argparse.SUPPRESS)
+    parser.add_argument('--trace-allocations', action='store_true', help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.worker is not None:
+        run_worker(args)
+        return
+
+    from ccproxy import config
+
+    if config.DYNAMODB_HOST == '':
+        raise RuntimeError('DYNAMODB_HOST must point to a local DynamoDB, run "make local-db" first')
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump(_BENCH_CONFIG, config_file)
+
+    with DynamoDBCountingProxy(config.DYNAMODB_HOST) as dynamodb_proxy:
+        # read lazily by ccproxy.config and inherited by worker interpreters. Warm
+        # invocations repeat the same action, all of them have to reach the fake server.
+        os.environ['CONFIG_FILE'] = config_file.name
+        os.environ['DYNAMODB_HOST'] = dynamodb_proxy.url
+        os.environ['IDEMPOTENCY_WINDOW'] = '0'
+        del config.DYNAMODB_HOST
+
+        try:
+            report = run_benchmarks(args, dynamodb_proxy)
+        finally:
+            os.unlink(config_file.name)
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as writer:
+            writer.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,69 @@
-from typing import Any
-from pydantic import BaseModel
+from typing import Any, Awaitable, Callable, Optional, TypeVar, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import asyncio
+import contextvars
+import json
+import logging
+import os
 import random
-from ccproxy import model, network
+import threading
+import time
+from ccproxy import async_network, config as ccproxy_config, model, network, tracing
 
+logger = logging.getLogger(__name__)
 
-class Config(BaseModel):
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+@dataclass(slots=True)
+class Config:
     messages: dict[str, list[str]]
     actions: dict[str, str]
+    # named lists of actions that are toggled together, e.g. "leaving_home"
+    scenes: dict[str, list[str]] = field(default_factory=dict)
+
+
+# Short-lived cache of values read from ComfortClick, keyed by account and
+# object. A toggle sent through ccproxy invalidates the entry of its object, a
+# change made elsewhere (e.g. in the app) shows up once the entry expires.
+class ValueCache:
+    def __init__(self, max_size: int, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # returns whether the value was found, values may be None
+    def get(self, account_id: str, object_name: str) -> tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get((account_id, object_name))
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end((account_id, object_name))
+
+                return True, entry[1]
+
+            if entry is not None:
+                del self._entries[(account_id, object_name)]
+
+            return False, None
+
+    def put(self, account_id: str, object_name: str, value: Any) -> None:
+        if self._max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[(account_id, object_name)] = (self._clock() + self._ttl, value)
+            self._entries.move_to_end((account_id, object_name))
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, account_id: str, object_name: str) -> None:
+        with self._lock:
+            self._entries.pop((account_id, object_name), None)
 
 
 class RemoteDeviceController:
@@ -18,64 +75,369 @@ class RemoteDeviceController:
 
     def __init__(
         self,
-        config: dict[str, Any],
-        account: model.Account
+        config: Union[Config, dict[str, Any]],
+        account: model.Account,
+        value_cache: Optional[ValueCache] = None
     ) -> None:
-        self._config = Config.parse_obj(config)
+        # Config instances come from ConfigLoader which has already validated them
+        self._config = config if isinstance(config, Config) else parse_config(config)
         self._account = account
-        self._validate_config()
-
-    def _validate_config(self) -> None:
-        missing_messages = []
-        empty_messages = []
-        empty_actions = []
-        for action_name in self._config.actions:
-            if action_name not in self._config.messages:
-                missing_messages.append(action_name)
-            else:
-                messages = self._config.messages[action_name]
-                if len(messages) == 0:
-                    empty_messages.append(action_name)
-
-            action_path = self._config.actions[action_name]
-            if action_path == '':
-                empty_actions.append(action_name)
-
-        if len(missing_messages) > 0:
-            raise self.InvalidConfigError(
-                f'Config is missing messages for the following actions: {", ".join(missing_messages)}'
-            )
-
-        if len(empty_actions) > 0:
-            raise self.InvalidConfigError(
-                f'Path is empty for the following actions: {", ".join(empty_actions)}')
-
-        if len(empty_messages) > 0:
-            raise self.InvalidConfigError(
-                f'Messages are not provided for the following actions: {", ".join(empty_messages)}')
+        self._value_cache = value_cache
 
     def toggle(self, action: str) -> str:
         if action not in self._config.actions:
-            raise self.UnknownActionError()
+            raise self.UnknownActionError(action)
+
+        try:
+            self._do_toggle_request(self._config.actions[action])
+        finally:
+            # even a failed toggle may have reached the device
+            self._invalidate_value(self._config.actions[action])
+
+        return self._pick_message(action)
+
+    # Toggles all actions concurrently, returns a message for every action that
+    # succeeded and an exception for every one that failed. Nothing is sent if
+    # any of the actions is unknown.
+    def toggle_many(self, actions: list[str]) -> dict[str, Union[str, Exception]]:
+        return self._call_many(self.toggle, actions)
+
+    async def toggle_async(self, action: str) -> str:
+        if action not in self._config.actions:
+            raise self.UnknownActionError(action)
+
+        try:
+            await self._do_toggle_request_async(self._config.actions[action])
+        finally:
+            self._invalidate_value(self._config.actions[action])
+
+        return self._pick_message(action)
+
+    # same contract as toggle_many(), concurrency is bounded by the client's pool limits
+    async def toggle_many_async(self, actions: list[str]) -> dict[str, Union[str, Exception]]:
+        return await self._call_many_async(self.toggle_async, actions)
+
+    # Returns the current value of an action's object, e.g. whether a garage door
+    # is open. Values are served from the cache when there is one.
+    def read(self, action: str) -> Any:
+        if action not in self._config.actions:
+            raise self.UnknownActionError(action)
+
+        object_name = self._config.actions[action]
+        found, value = self._get_cached_value(object_name)
+        if found:
+            return value
+
+        value = self._do_read_request(object_name)
+        self._cache_value(object_name, value)
+
+        return value
+
+    # Same contract as toggle_many(). ComfortClick has no endpoint that reads
+    # several objects at once, so objects that aren't cached are read concurrently.
+    def read_many(self, actions: list[str]) -> dict[str, Union[Any, Exception]]:
+        return self._call_many(self.read, actions)
+
+    async def read_async(self, action: str) -> Any:
+        if action not in self._config.actions:
+            raise self.UnknownActionError(action)
+
+        object_name = self._config.actions[action]
+        found, value = self._get_cached_value(object_name)
+        if found:
+            return value
 
-        self._do_toggle_request(self._config.actions[action])
+        value = await self._do_read_request_async(object_name)
+        self._cache_value(object_name, value)
 
-        messages = self._config.messages[action]
+        return value
+
+    async def read_many_async(self, actions: list[str]) -> dict[str, Union[Any, Exception]]:
+        return await self._call_many_async(self.read_async, actions)
+
+    def _call_many(self, fn: Callable[[str], T], actions: list[str]) -> dict[str, Union[T, Exception]]:
+        for action in actions:
+            if action not in self._config.actions:
+                raise self.UnknownActionError(action)
+
+        # bounded by the connection pool size, so concurrent requests reuse pooled connections
+        max_workers = max(1, min(len(actions), ccproxy_config.HTTP_POOL_SIZE))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # worker threads see the request's trace, see ccproxy.tracing
+            futures = {
+                action: executor.submit(_call_in_context, contextvars.copy_context(), fn, action)
+                for action in actions
+            }
+
+        results: dict[str, Union[T, Exception]] = {}
+        for action, future in futures.items():
+            try:
+                results[action] = future.result()
+            except Exception as e:
+                results[action] = e
+
+        return results
+
+    async def _call_many_async(
+        self,
+        fn: Callable[[str], Awaitable[T]],
+        actions: list[str]
+    ) -> dict[str, Union[T, Exception]]:
+        for action in actions:
+            if action not in self._config.actions:
+                raise self.UnknownActionError(action)
+
+        outcomes = await asyncio.gather(*(fn(action) for action in actions), return_exceptions=True)
+
+        results: dict[str, Union[T, Exception]] = {}
+        for action, outcome in zip(actions, outcomes):
+            if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+                raise outcome
+            results[action] = outcome
+
+        return results
+
+    def get_scene_actions(self, scene: str) -> list[str]:
+        if scene not in self._config.scenes:
+            raise self.UnknownActionError(scene)
+
+        return self._config.scenes[scene]
+
+    # messages are optional for scenes
+    def get_scene_message(self, scene: str) -> Optional[str]:
+        return self._pick_message(scene) if len(self._config.messages.get(scene, [])) > 0 else None
+
+    def _pick_message(self, name: str) -> str:
+        messages = self._config.messages[name]
         return messages[random.randint(0, len(messages) - 1)]
 
     def _do_toggle_request(self, action: str) -> None:
+        # a toggle must not be sent twice, it's only retried when it hasn't reached ComfortClick
         response = network.do_authenticated_request(
             self._account,
             f'{self._account.host}/SetValue',
             'POST',
-            {
-                'objectName': action,
-                'valueName': 'Value',
-                'value': 'true'
-            }
+            self._create_toggle_payload(action),
+            idempotent=False
+        )
+
+        response.raise_for_status()
+
+    async def _do_toggle_request_async(self, action: str) -> None:
+        response = await async_network.do_authenticated_request(
+            self._account,
+            f'{self._account.host}/SetValue',
+            'POST',
+            self._create_toggle_payload(action),
+            idempotent=False
+        )
+
+        response.raise_for_status()
+
+    def _do_read_request(self, object_name: str) -> Any:
+        # reads don't change anything, so they are retried like any idempotent request
+        response = network.do_authenticated_request(
+            self._account,
+            f'{self._account.host}/GetValue',
+            'POST',
+            self._create_read_payload(object_name),
+            idempotent=True
+        )
+
+        response.raise_for_status()
+
+        return _parse_value(response.json())
+
+    async def _do_read_request_async(self, object_name: str) -> Any:
+        response = await async_network.do_authenticated_request(
+            self._account,
+            f'{self._account.host}/GetValue',
+            'POST',
+            self._create_read_payload(object_name),
+            idempotent=True
         )
 
         response.raise_for_status()
 
+        return _parse_value(response.json())
+
+    def _create_read_payload(self, object_name: str) -> dict[str, Any]:
+        return {
+            'objectName': object_name,
+            'valueName': 'Value'
+        }
+
+    def _get_cached_value(self, object_name: str) -> tuple[bool, Any]:
+        if self._value_cache is None or self._account.id is None:
+            return False, None
+
+        found, value = self._value_cache.get(self._account.id, object_name)
+        tracing.count('value_cache_hits' if found else 'value_cache_misses')
+
+        return found, value
+
+    def _cache_value(self, object_name: str, value: Any) -> None:
+        if self._value_cache is not None and self._account.id is not None:
+            self._value_cache.put(self._account.id, object_name, value)
+
+    def _invalidate_value(self, object_name: str) -> None:
+        if self._value_cache is not None and self._account.id is not None:
+            self._value_cache.invalidate(self._account.id, object_name)
+
+    def _create_toggle_payload(self, action: str) -> dict[str, Any]:
+        return {
+            'objectName': action,
+            'valueName': 'Value',
+            'value': 'true'
+        }
+
     def get_supported_actions(self) -> tuple[str, ...]:
         return tuple(self._config.actions.keys())
+
+    def get_supported_scenes(self) -> tuple[str, ...]:
+        return tuple(self._config.scenes.keys())
+
+
+def _call_in_context(context: contextvars.Context, fn: Callable[[str], R], action: str) -> R:
+    return context.run(fn, action)
+
+
+# /GetValue answers with the object's value, either bare or wrapped as {"Value": ...}
+def _parse_value(data: Any) -> Any:
+    if isinstance(data, dict) and 'Value' in data:
+        return data['Value']
+
+    return data
+
+
+def parse_config(raw_config: dict[str, Any]) -> Config:
+    if not isinstance(raw_config, dict):
+        raise RemoteDeviceController.InvalidConfigError('Config should be an object')
+
+    config = Config(
+        messages=_parse_mapping(raw_config, 'messages', _is_string_list),
+        actions=_parse_mapping(raw_config, 'actions', _is_string),
+        scenes=_parse_mapping(raw_config, 'scenes', _is_string_list, required=False)
+    )
+
+    missing_messages = []
+    empty_messages = []
+    empty_actions = []
+    for action_name in config.actions:
+        if action_name not in config.messages:
+            missing_messages.append(action_name)
+        else:
+            messages = config.messages[action_name]
+            if len(messages) == 0:
+                empty_messages.append(action_name)
+
+        action_path = config.actions[action_name]
+        if action_path == '':
+            empty_actions.append(action_name)
+
+    if len(missing_messages) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'Config is missing messages for the following actions: {", ".join(missing_messages)}'
+        )
+
+    if len(empty_actions) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'Path is empty for the following actions: {", ".join(empty_actions)}')
+
+    if len(empty_messages) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'Messages are not provided for the following actions: {", ".join(empty_messages)}')
+
+    empty_scenes = []
+    unknown_scene_actions = []
+    for scene_name, scene_actions in config.scenes.items():
+        if len(scene_actions) == 0:
+            empty_scenes.append(scene_name)
+
+        for action_name in scene_actions:
+            if action_name not in config.actions and action_name not in unknown_scene_actions:
+                unknown_scene_actions.append(action_name)
+
+    if len(empty_scenes) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'Actions are not provided for the following scenes: {", ".join(empty_scenes)}')
+
+    if len(unknown_scene_actions) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'Scenes refer to the following unknown actions: {", ".join(unknown_scene_actions)}')
+
+    return config
+
+
+def _parse_mapping(
+    raw_config: dict[str, Any],
+    key: str,
+    is_valid: Callable[[Any], bool],
+    required: bool = True
+) -> dict[str, Any]:
+    if key not in raw_config and not required:
+        return {}
+
+    mapping = raw_config.get(key)
+    if not isinstance(mapping, dict):
+        raise RemoteDeviceController.InvalidConfigError(f'"{key}" should be an object')
+
+    invalid_names = [name for name, value in mapping.items() if not is_valid(value)]
+    if len(invalid_names) > 0:
+        raise RemoteDeviceController.InvalidConfigError(
+            f'"{key}" has invalid values for the following names: {", ".join(invalid_names)}')
+
+    return mapping
+
+
+def _is_string(value: Any) -> bool:
+    return isinstance(value, str)
+
+
+def _is_string_list(value: Any) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+# Parses and validates config file once per process, the file is re-read only
+# when its mtime or size changes. If a changed file can't be parsed, the last
+# successfully loaded config keeps being used.
+class ConfigLoader:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._config: Optional[Config] = None
+        self._signature: Optional[tuple[int, int]] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> Config:
+        try:
+            stat = os.stat(self._path)
+        except OSError as e:
+            if self._config is None:
+                raise
+            logger.warning(f'Unable to stat "{self._path}", using previously loaded config: {str(e)}')
+            return self._config
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if self._config is not None and signature == self._signature:
+            return self._config
+
+        with self._lock:
+            if self._config is None or signature != self._signature:
+                self._reload(signature)
+
+        assert self._config is not None
+        return self._config
+
+    def _reload(self, signature: tuple[int, int]) -> None:
+        try:
+            with open(self._path) as reader:
+                config = parse_config(json.loads(reader.read()))
+        except Exception as e:
+            if self._config is None:
+                raise
+            logger.warning(f'Failed to reload "{self._path}", using previously loaded config: {str(e)}')
+        else:
+            self._config = config
+
+        # remembered even for a broken file, so it is not re-parsed on every call
+        self._signature = signature
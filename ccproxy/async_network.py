@@ -0,0 +1,174 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Optional, TypeVar, TYPE_CHECKING
+from datetime import datetime, timezone
+import asyncio
+from ccproxy import circuit_breaker, config, network, retry, tracing
+# same exception type for both clients, so callers don't need to care which one they use
+from ccproxy.network import AuthContractError as AuthContractError
+
+if TYPE_CHECKING:
+    import httpx
+    from ccproxy import model
+
+T = TypeVar('T')
+
+# Async counterpart of ccproxy.network built on httpx. Pooled connections
+# belong to the event loop they were opened on, so coroutines are meant to be
+# executed with run() below which keeps one event loop for the life of the
+# process - this way warm invocations reuse connections just like the sync
+# client does.
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_clients: dict[str, httpx.AsyncClient] = {}
+_clients_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def run(coroutine: Awaitable[T]) -> T:
+    global _loop
+
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+
+    return _loop.run_until_complete(coroutine)
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    global _clients_loop
+
+    # clients opened on a loop that has gone away (e.g. after asyncio.run()) can't be reused
+    loop = asyncio.get_running_loop()
+    if _clients_loop is not loop:
+        _clients.clear()
+        _clients_loop = loop
+
+    origin = network._get_origin(url)
+
+    client = _clients.get(origin)
+    if client is None:
+        client = _create_client()
+        _clients[origin] = client
+
+    return client
+
+
+def get_known_origins() -> list[str]:
+    return list(_clients.keys())
+
+
+# same as network.warm_up_connection()
+async def warm_up_connection(url: str, timeout: float) -> bool:
+    origin = network._get_origin(url)
+    if circuit_breaker.get_breaker(origin).state is circuit_breaker.CircuitBreaker.State.OPEN:
+        return False
+
+    await get_client(origin).head(origin, timeout=timeout)
+
+    return True
+
+
+async def aclose_clients() -> None:
+    # clients of an event loop that has gone away can only be dropped
+    clients = list(_clients.values()) if _clients_loop is asyncio.get_running_loop() else []
+    _clients.clear()
+
+    await asyncio.gather(*(client.aclose() for client in clients))
+
+
+def _create_client() -> httpx.AsyncClient:
+    import httpx
+    from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+    headers = dict(network.DEFAULT_HEADERS)
+    if not config.HTTP_KEEP_ALIVE:
+        headers['Connection'] = 'close'
+
+    return httpx.AsyncClient(
+        headers=headers,
+        verify=False,
+        # cookies are managed per account via explicit "Cookie" header, the client
+        # is shared between accounts so it must never remember any of them
+        cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])),
+        limits=httpx.Limits(
+            max_connections=config.HTTP_POOL_SIZE,
+            max_keepalive_connections=config.HTTP_POOL_SIZE if config.HTTP_KEEP_ALIVE else 0
+        ),
+        timeout=httpx.Timeout(config.HTTP_READ_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT)
+    )
+
+
+# retried the same way as network.do_request()
+async def do_request(
+    url: str,
+    method: str,
+    json: dict[Any, Any] = {},
+    headers: dict[str, Any] = {},
+    idempotent: bool = False
+) -> httpx.Response:
+    return await _create_retry_policy().call_async(
+        lambda: _do_request_once(url, method, json, headers),
+        idempotent,
+        _classify_response
+    )
+
+
+def _classify_response(response: httpx.Response) -> Optional[retry.ErrorClass]:
+    return retry.classify_status_code(response.status_code)
+
+
+def _create_retry_policy() -> retry.RetryPolicy:
+    return retry.RetryPolicy(
+        'comfortclick',
+        _classify_error,
+        config.RETRY_MAX_ATTEMPTS,
+        config.RETRY_BASE_DELAY,
+        config.RETRY_MAX_DELAY
+    )
+
+
+def _classify_error(e: BaseException) -> Optional[retry.ErrorClass]:
+    import httpx
+
+    # a pool timeout means no connection has been free to send the request with
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return retry.ErrorClass.NOT_SENT
+    elif isinstance(e, httpx.TransportError):
+        return retry.ErrorClass.TRANSIENT
+
+    return None
+
+
+async def _do_request_once(url: str, method: str, json: dict[Any, Any], headers: dict[str, Any]) -> httpx.Response:
+    import httpx
+
+    breaker = circuit_breaker.get_breaker(network._get_origin(url))
+    with breaker.attempt((httpx.TimeoutException,), (httpx.TransportError,)) as attempt, tracing.span('comfortclick.request'):
+        response = await get_client(url).request(
+            method,
+            url,
+            json=json,
+            headers=headers,
+            timeout=httpx.Timeout(attempt.read_timeout, connect=config.HTTP_CONNECT_TIMEOUT)
+        )
+        attempt.status_code = response.status_code
+
+    return response
+
+
+async def do_authenticated_request(
+    account: model.Account,
+    url: str,
+    method: str,
+    json: dict[str, Any] = {},
+    headers: dict[str, Any] = {},
+    idempotent: bool = False
+) -> httpx.Response:
+    return await do_request(url, method, json, network.create_authenticated_headers(account, headers), idempotent)
+
+
+async def authenticate(credentials: model.CredentialsEnvelope) -> model.Cookie:
+    issued_at = datetime.now(timezone.utc)
+    with tracing.span('comfortclick.login'):
+        response = await do_request(
+            f'{credentials.host}/Login', 'POST', network.create_login_payload(credentials), idempotent=True
+        )
+
+    return network.parse_auth_response(response.json(), response.headers, issued_at)
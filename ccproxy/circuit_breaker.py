@@ -0,0 +1,303 @@
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+from enum import Enum
+from typing import Callable, Iterator, Optional, TYPE_CHECKING
+import logging
+import math
+import threading
+import time
+from ccproxy import config, dynamodb, tracing
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+logger = logging.getLogger(__name__)
+
+# Failures are tracked per ComfortClick host. After CIRCUIT_BREAKER_FAILURES
+# consecutive failures (connection errors, timeouts and 5xx responses) the circuit
+# of a host opens and requests to it fail right away with CircuitBreaker.OpenError
+# instead of waiting for a server that hangs. After CIRCUIT_BREAKER_COOL_DOWN
+# seconds a single trial request is let through (half-open), its outcome either
+# closes the circuit or opens it again.
+#
+# Read timeouts adapt to how fast a host has been responding: a multiple of the
+# HTTP_TIMEOUT_PERCENTILE latency of recent requests, kept between
+# HTTP_MIN_READ_TIMEOUT and HTTP_READ_TIMEOUT.
+
+# how many recent latencies per host are kept, and needed before adapting
+_LATENCY_WINDOW = 100
+_MIN_LATENCY_SAMPLES = 20
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+class Attempt:
+    __slots__ = ('read_timeout', 'status_code')
+
+    def __init__(self, read_timeout: float) -> None:
+        self.read_timeout = read_timeout
+        # set by the caller once a response has been received
+        self.status_code: Optional[int] = None
+
+
+class CircuitBreaker:
+    class State(Enum):
+        CLOSED = 'closed'
+        OPEN = 'open'
+        HALF_OPEN = 'half_open'
+
+    class OpenError(RuntimeError):
+        def __init__(self, *args: object, host: str, retry_after: float) -> None:
+            super().__init__(*args)
+            self.host = host
+            self.retry_after = retry_after
+
+    def __init__(
+        self,
+        host: str,
+        failure_threshold: int,
+        cool_down: float,
+        state_table: Optional[CircuitStateTable] = None,
+        sync_interval: float = 5.0,
+        clock: Callable[[], float] = time.time
+    ) -> None:
+        self._host = host
+        self._failure_threshold = failure_threshold
+        self._cool_down = cool_down
+        self._state_table = state_table
+        self._sync_interval = sync_interval
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.State.CLOSED
+        self._failures = 0
+        self._open_until = 0.0
+        self._is_trial_in_flight = False
+        self._synced_at: Optional[float] = None
+        self._latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+
+    @property
+    def state(self) -> CircuitBreaker.State:
+        return self._state
+
+    # Tracks one request to the host, raises OpenError when the circuit is open.
+    # The caller sets status_code of the yielded attempt once it has a response
+    # and passes read_timeout on to its HTTP client. Exceptions in timeout_errors
+    # and connection_errors count as failures, any other exception is ignored.
+    @contextmanager
+    def attempt(
+        self,
+        timeout_errors: tuple[type[BaseException], ...],
+        connection_errors: tuple[type[BaseException], ...]
+    ) -> Iterator[Attempt]:
+        is_trial = self.acquire()
+        attempt = Attempt(self.get_read_timeout(is_trial))
+
+        succeeded: Optional[bool] = None
+        latency: Optional[float] = None
+        started_at = time.perf_counter()
+        try:
+            yield attempt
+        except timeout_errors:
+            # a timed out request took at least that long, so timeouts grow back
+            # when a host slows down
+            succeeded = False
+            latency = time.perf_counter() - started_at
+            raise
+        except connection_errors:
+            succeeded = False
+            raise
+        else:
+            if attempt.status_code is not None:
+                succeeded = attempt.status_code < 500
+                latency = time.perf_counter() - started_at
+        finally:
+            self.release(is_trial, succeeded, latency)
+
+    # returns whether the request is the trial one of a half-open circuit
+    def acquire(self) -> bool:
+        if self._failure_threshold <= 0:
+            return False
+
+        self._sync_from_state_table()
+
+        with self._lock:
+            now = self._clock()
+            if self._state is CircuitBreaker.State.OPEN:
+                if now < self._open_until:
+                    self._reject(self._open_until - now)
+                self._state = CircuitBreaker.State.HALF_OPEN
+                self._is_trial_in_flight = False
+
+            if self._state is CircuitBreaker.State.HALF_OPEN:
+                if self._is_trial_in_flight:
+                    # the trial request gets the whole read timeout
+                    self._reject(config.HTTP_READ_TIMEOUT)
+                self._is_trial_in_flight = True
+
+                return True
+
+        return False
+
+    def _reject(self, retry_after: float) -> None:
+        tracing.count('circuit_open')
+        raise CircuitBreaker.OpenError(
+            f'Circuit for "{self._host}" is open', host=self._host, retry_after=retry_after
+        )
+
+    # succeeded is None when the outcome says nothing about the host's health
+    def release(self, is_trial: bool, succeeded: Optional[bool], latency: Optional[float]) -> None:
+        opened_until = None
+        has_closed = False
+
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+
+            if self._failure_threshold <= 0:
+                return
+
+            if self._state is not CircuitBreaker.State.CLOSED:
+                # outcomes of requests sent before the circuit opened don't count
+                if not is_trial:
+                    return
+                self._is_trial_in_flight = False
+
+            if succeeded is None:
+                return
+
+            if succeeded:
+                has_closed = self._state is not CircuitBreaker.State.CLOSED
+                self._state = CircuitBreaker.State.CLOSED
+                self._failures = 0
+            else:
+                self._failures += 1
+                if is_trial or self._failures >= self._failure_threshold:
+                    self._state = CircuitBreaker.State.OPEN
+                    self._failures = 0
+                    self._open_until = self._clock() + self._cool_down
+                    opened_until = self._open_until
+
+        if opened_until is not None:
+            open_until = opened_until
+            logger.warning(f'Circuit for "{self._host}" is open for {self._cool_down} seconds')
+            self._write_to_state_table(lambda table: table.set_open_until(self._host, open_until))
+        elif has_closed:
+            logger.info(f'Circuit for "{self._host}" is closed again')
+            self._write_to_state_table(lambda table: table.delete(self._host))
+
+    def get_read_timeout(self, is_trial: bool = False) -> float:
+        max_timeout = config.HTTP_READ_TIMEOUT
+        # a trial request gets all the time it may need, a host that has just
+        # recovered can be slower than it used to be
+        if not config.HTTP_ADAPTIVE_TIMEOUT or is_trial:
+            return max_timeout
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < _MIN_LATENCY_SAMPLES:
+            return max_timeout
+
+        index = min(len(latencies) - 1, math.ceil(config.HTTP_TIMEOUT_PERCENTILE * len(latencies)) - 1)
+        timeout = latencies[max(0, index)] * config.HTTP_TIMEOUT_MULTIPLIER
+
+        return min(max_timeout, max(config.HTTP_MIN_READ_TIMEOUT, timeout))
+
+    # picks up circuits opened by other processes, at most every sync_interval seconds
+    def _sync_from_state_table(self) -> None:
+        if self._state_table is None:
+            return
+
+        now = self._clock()
+        if self._synced_at is not None and now - self._synced_at < self._sync_interval:
+            return
+        self._synced_at = now
+
+        try:
+            open_until = self._state_table.get_open_until(self._host)
+        except Exception as e:
+            logger.warning(f'Failed to read circuit state of "{self._host}": {str(e)}')
+            return
+
+        if open_until is None or open_until <= now:
+            return
+
+        with self._lock:
+            if self._state is CircuitBreaker.State.CLOSED:
+                self._state = CircuitBreaker.State.OPEN
+                self._failures = 0
+                self._open_until = open_until
+
+    # the shared state is a best effort, failing to write it must not fail requests
+    def _write_to_state_table(self, write: Callable[[CircuitStateTable], None]) -> None:
+        if self._state_table is None:
+            return
+
+        try:
+            write(self._state_table)
+        except Exception as e:
+            logger.warning(f'Failed to write circuit state of "{self._host}": {str(e)}')
+
+
+# Open circuits shared between processes, items expire through DynamoDB's TTL
+# on the "expires_at" attribute
+class CircuitStateTable:
+    def __init__(self, dynamodb_client: DynamoDBClient, table_name: str) -> None:
+        self._dynamodb = dynamodb_client
+        self._table_name = table_name
+
+    def get_open_until(self, host: str) -> Optional[float]:
+        response = self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key=dynamodb.marshal_item({'host': host}),
+            ProjectionExpression='open_until'
+        )
+        if 'Item' not in response:
+            return None
+
+        # stored in milliseconds
+        return int(dynamodb.unmarshal_item(response['Item'])['open_until']) / 1000
+
+    def set_open_until(self, host: str, open_until: float) -> None:
+        self._dynamodb.put_item(
+            TableName=self._table_name,
+            Item=dynamodb.marshal_item({
+                'host': host,
+                'open_until': int(open_until * 1000),
+                'expires_at': math.ceil(open_until)
+            })
+        )
+
+    def delete(self, host: str) -> None:
+        self._dynamodb.delete_item(TableName=self._table_name, Key=dynamodb.marshal_item({'host': host}))
+
+
+def get_breaker(origin: str) -> CircuitBreaker:
+    breaker = _breakers.get(origin)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(origin)
+            if breaker is None:
+                breaker = _create_breaker(origin)
+                _breakers[origin] = breaker
+
+    return breaker
+
+
+def _create_breaker(origin: str) -> CircuitBreaker:
+    from ccproxy import container
+
+    return CircuitBreaker(
+        origin,
+        config.CIRCUIT_BREAKER_FAILURES,
+        config.CIRCUIT_BREAKER_COOL_DOWN,
+        container.get_circuit_state_table(),
+        config.CIRCUIT_BREAKER_SYNC_INTERVAL
+    )
+
+
+def reset_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
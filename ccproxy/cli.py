@@ -8,4 +8,50 @@ if len (sys.argv) == 1:
 command = sys.argv[1]
 
 if command == "generate-db-key":
-    print(Fernet.generate_key().decode("utf-8"))
\ No newline at end of file
+    print(Fernet.generate_key().decode("utf-8"))
+elif command == "backfill-host-username-key":
+    from ccproxy import container
+
+    count = container.get_account_table().backfill_host_username_keys()
+    print(f"Backfilled {count} account(s)")
+elif command == "rotate-db-key":
+    # DB_ENCRYPTION_KEY must list the new key first, followed by the previous one(s)
+    import argparse
+    from ccproxy import container, key_rotation
+
+    parser = argparse.ArgumentParser(prog="rotate-db-key")
+    parser.add_argument("--segments", type=int, default=4, help="parallel scan segments / worker threads")
+    parser.add_argument("--page-size", type=int, default=100, help="accounts per scanned page")
+    parser.add_argument("--progress-file", default=".rotate-db-key.progress.json")
+    args = parser.parse_args(sys.argv[2:])
+
+    stats = key_rotation.rotate_encryption_key(
+        container.get_account_table(),
+        container.get_encrypter(),
+        key_rotation.RotationProgress(args.progress_file, args.segments),
+        args.segments,
+        args.page_size
+    )
+    print(f"Scanned {stats.scanned}, re-encrypted {stats.rotated} account(s)")
+    if stats.skipped > 0:
+        print(f"{stats.skipped} account(s) changed during rotation, run the command again to verify them")
+    if stats.failed > 0:
+        print(f"{stats.failed} account(s) can't be decrypted with any of the keys, see the log")
+        exit(1)
+elif command == "serve":
+    # runs the handlers as a long-running HTTP server, see ccproxy/server.py
+    import argparse
+    import logging
+    from ccproxy import config, server
+
+    parser = argparse.ArgumentParser(prog="serve")
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS, help="requests served at a time")
+    args = parser.parse_args(sys.argv[2:])
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    server.serve(args.host, args.port, args.workers)
+else:
+    print(f"Unknown command \"{command}\", aborting ...")
+    exit(1)
@@ -1,10 +1,181 @@
 from decouple import config
+from typing import Any, Callable, TYPE_CHECKING
 
 ACCOUNT_ID_LENGTH = 8
 
-DB_ENCRYPTION_KEY = config('DB_ENCRYPTION_KEY')
-ACCOUNTS_TABLE = config('ACCOUNTS_TABLE')
-CONFIG_FILE = config('CONFIG_FILE')
-DYNAMODB_HOST = config('DYNAMODB_HOST')
-DEVICE_NAME = config('DEVICE_NAME')
-PUSH_TOKEN = config('PUSH_TOKEN')
+# Settings are read on first access instead of on import, so importing any
+# ccproxy module stays cheap. Every setting is declared twice: its type below
+# (for mypy) and how it is read in _SETTINGS.
+if TYPE_CHECKING:
+    DB_ENCRYPTION_KEY: str
+    ACCOUNTS_TABLE: str
+    CONFIG_FILE: str
+    DYNAMODB_HOST: str
+    DEVICE_NAME: str
+    PUSH_TOKEN: str
+
+    HTTP_POOL_SIZE: int
+    HTTP_KEEP_ALIVE: bool
+    HTTP_CONNECT_TIMEOUT: float
+    HTTP_READ_TIMEOUT: float
+    HTTP_ADAPTIVE_TIMEOUT: bool
+    HTTP_MIN_READ_TIMEOUT: float
+    HTTP_TIMEOUT_PERCENTILE: float
+    HTTP_TIMEOUT_MULTIPLIER: float
+
+    RETRY_MAX_ATTEMPTS: int
+    RETRY_BASE_DELAY: float
+    RETRY_MAX_DELAY: float
+    RETRY_DEADLINE_MARGIN: float
+    DYNAMODB_MAX_ATTEMPTS: int
+
+    IDEMPOTENCY_TABLE: str
+    IDEMPOTENCY_KEY_TTL: float
+    IDEMPOTENCY_WINDOW: float
+    IDEMPOTENCY_PENDING_TIMEOUT: float
+    IDEMPOTENCY_CACHE_SIZE: int
+
+    CIRCUIT_BREAKER_FAILURES: int
+    CIRCUIT_BREAKER_COOL_DOWN: float
+    CIRCUIT_BREAKER_TABLE: str
+    CIRCUIT_BREAKER_SYNC_INTERVAL: float
+
+    ACCOUNT_CACHE_SIZE: int
+    ACCOUNT_CACHE_TTL: float
+
+    VALUE_CACHE_SIZE: int
+    VALUE_CACHE_TTL: float
+
+    COOKIE_MAX_AGE: int
+    COOKIE_REFRESH_MARGIN: int
+
+    WARMUP_HOSTS: str
+    WARMUP_TIMEOUT: float
+    WARMUP_CHECK_COOKIES: bool
+
+    LEGACY_HOST_INDEX_FALLBACK: bool
+
+    AUTH_LEASE_DURATION: float
+    AUTH_LEASE_POLL_INTERVAL: float
+
+    TRACING_ENABLED: bool
+    TRACING_NAMESPACE: str
+
+    SERVER_HOST: str
+    SERVER_PORT: int
+    SERVER_WORKERS: int
+    SERVER_REQUEST_TIMEOUT: float
+    SERVER_KEEP_ALIVE_TIMEOUT: float
+
+_SETTINGS: dict[str, Callable[[], Any]] = {
+    'DB_ENCRYPTION_KEY': lambda: config('DB_ENCRYPTION_KEY'),
+    'ACCOUNTS_TABLE': lambda: config('ACCOUNTS_TABLE'),
+    'CONFIG_FILE': lambda: config('CONFIG_FILE'),
+    'DYNAMODB_HOST': lambda: config('DYNAMODB_HOST'),
+    'DEVICE_NAME': lambda: config('DEVICE_NAME'),
+    'PUSH_TOKEN': lambda: config('PUSH_TOKEN'),
+
+    'HTTP_POOL_SIZE': lambda: config('HTTP_POOL_SIZE', default=10, cast=int),
+    'HTTP_KEEP_ALIVE': lambda: config('HTTP_KEEP_ALIVE', default=True, cast=bool),
+    'HTTP_CONNECT_TIMEOUT': lambda: config('HTTP_CONNECT_TIMEOUT', default=3.05, cast=float),
+    'HTTP_READ_TIMEOUT': lambda: config('HTTP_READ_TIMEOUT', default=6.0, cast=float),
+    # read timeouts shrink to HTTP_TIMEOUT_MULTIPLIER times the HTTP_TIMEOUT_PERCENTILE
+    # latency of a host, but never below HTTP_MIN_READ_TIMEOUT nor above HTTP_READ_TIMEOUT
+    'HTTP_ADAPTIVE_TIMEOUT': lambda: config('HTTP_ADAPTIVE_TIMEOUT', default=True, cast=bool),
+    'HTTP_MIN_READ_TIMEOUT': lambda: config('HTTP_MIN_READ_TIMEOUT', default=1.0, cast=float),
+    'HTTP_TIMEOUT_PERCENTILE': lambda: config('HTTP_TIMEOUT_PERCENTILE', default=0.99, cast=float),
+    'HTTP_TIMEOUT_MULTIPLIER': lambda: config('HTTP_TIMEOUT_MULTIPLIER', default=3.0, cast=float),
+
+    # transient failures are retried RETRY_MAX_ATTEMPTS times in total (DYNAMODB_MAX_ATTEMPTS
+    # for DynamoDB), with delays of up to RETRY_BASE_DELAY * 2^attempt seconds but no more
+    # than RETRY_MAX_DELAY, and never later than RETRY_DEADLINE_MARGIN seconds before the
+    # Lambda invocation times out, see ccproxy.retry
+    'RETRY_MAX_ATTEMPTS': lambda: config('RETRY_MAX_ATTEMPTS', default=3, cast=int),
+    'RETRY_BASE_DELAY': lambda: config('RETRY_BASE_DELAY', default=0.1, cast=float),
+    'RETRY_MAX_DELAY': lambda: config('RETRY_MAX_DELAY', default=1.0, cast=float),
+    'RETRY_DEADLINE_MARGIN': lambda: config('RETRY_DEADLINE_MARGIN', default=0.5, cast=float),
+    'DYNAMODB_MAX_ATTEMPTS': lambda: config('DYNAMODB_MAX_ATTEMPTS', default=5, cast=int),
+
+    # responses of process_action are replayed for requests with the same "idempotency-key"
+    # header for IDEMPOTENCY_KEY_TTL seconds. Requests without one are only deduplicated,
+    # by account and action, if IDEMPOTENCY_WINDOW is set: a repeated toggle within that
+    # many seconds is then replayed rather than sent to the device. Keys are kept in
+    # IDEMPOTENCY_TABLE if set, in-process otherwise. A request that doesn't finish within
+    # IDEMPOTENCY_PENDING_TIMEOUT seconds no longer holds its key
+    'IDEMPOTENCY_TABLE': lambda: config('IDEMPOTENCY_TABLE', default=''),
+    'IDEMPOTENCY_KEY_TTL': lambda: config('IDEMPOTENCY_KEY_TTL', default=3600.0, cast=float),
+    'IDEMPOTENCY_WINDOW': lambda: config('IDEMPOTENCY_WINDOW', default=0.0, cast=float),
+    'IDEMPOTENCY_PENDING_TIMEOUT': lambda: config('IDEMPOTENCY_PENDING_TIMEOUT', default=15.0, cast=float),
+    'IDEMPOTENCY_CACHE_SIZE': lambda: config('IDEMPOTENCY_CACHE_SIZE', default=256, cast=int),
+
+    # requests to a host fail fast for CIRCUIT_BREAKER_COOL_DOWN seconds after it failed
+    # CIRCUIT_BREAKER_FAILURES times in a row (0 disables the breaker). Open circuits are
+    # shared between processes through CIRCUIT_BREAKER_TABLE, if set, which is checked
+    # at most every CIRCUIT_BREAKER_SYNC_INTERVAL seconds per host
+    'CIRCUIT_BREAKER_FAILURES': lambda: config('CIRCUIT_BREAKER_FAILURES', default=5, cast=int),
+    'CIRCUIT_BREAKER_COOL_DOWN': lambda: config('CIRCUIT_BREAKER_COOL_DOWN', default=30.0, cast=float),
+    'CIRCUIT_BREAKER_TABLE': lambda: config('CIRCUIT_BREAKER_TABLE', default=''),
+    'CIRCUIT_BREAKER_SYNC_INTERVAL': lambda: config('CIRCUIT_BREAKER_SYNC_INTERVAL', default=5.0, cast=float),
+
+    # accounts are cached in-process, set ACCOUNT_CACHE_SIZE to 0 to disable
+    'ACCOUNT_CACHE_SIZE': lambda: config('ACCOUNT_CACHE_SIZE', default=128, cast=int),
+    'ACCOUNT_CACHE_TTL': lambda: config('ACCOUNT_CACHE_TTL', default=300.0, cast=float),
+
+    # values read with "?read=..." are cached per account for VALUE_CACHE_TTL seconds,
+    # set VALUE_CACHE_SIZE to 0 to disable
+    'VALUE_CACHE_SIZE': lambda: config('VALUE_CACHE_SIZE', default=256, cast=int),
+    'VALUE_CACHE_TTL': lambda: config('VALUE_CACHE_TTL', default=5.0, cast=float),
+
+    # cookies are refreshed ahead of time when they are older than COOKIE_MAX_AGE
+    # seconds (0 disables the check), or expire within COOKIE_REFRESH_MARGIN seconds.
+    # ComfortClick doesn't tell when its cookies expire, so the age is all there is
+    # to go by: 12 hours costs a login per account twice a day, and a lapsed session
+    # is replaced before a request runs into the 401
+    'COOKIE_MAX_AGE': lambda: config('COOKIE_MAX_AGE', default=43200, cast=int),
+    'COOKIE_REFRESH_MARGIN': lambda: config('COOKIE_REFRESH_MARGIN', default=60, cast=int),
+
+    # comma-separated ComfortClick hosts to connect to on "lambda_tender" pings, hosts
+    # this process has already talked to are warmed up anyway
+    'WARMUP_HOSTS': lambda: config('WARMUP_HOSTS', default=''),
+    # connect and read timeout of warm-up requests, only the connection is kept, so
+    # it's way below HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT
+    'WARMUP_TIMEOUT': lambda: config('WARMUP_TIMEOUT', default=1.0, cast=float),
+    'WARMUP_CHECK_COOKIES': lambda: config('WARMUP_CHECK_COOKIES', default=True, cast=bool),
+
+    # accounts that aren't found by "host_username" are looked up in the legacy
+    # index too, which costs another query on every miss (e.g. every first login).
+    # Turn it off once "make backfill-host-username-key" has run, after that legacy
+    # accounts would be created again instead
+    'LEGACY_HOST_INDEX_FALLBACK': lambda: config('LEGACY_HOST_INDEX_FALLBACK', default=True, cast=bool),
+
+    # only one container at a time re-authenticates an account, the others poll
+    # DynamoDB for the new cookie until the lease runs out (in seconds) or their
+    # invocation is about to time out. It should outlast a login request (see
+    # HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT) but not the Lambda timeout of 10
+    # seconds, so the lease of a container that has died is taken over by the next invocation
+    'AUTH_LEASE_DURATION': lambda: config('AUTH_LEASE_DURATION', default=9.5, cast=float),
+    'AUTH_LEASE_POLL_INTERVAL': lambda: config('AUTH_LEASE_POLL_INTERVAL', default=0.25, cast=float),
+
+    # prints stage timings of every invocation as a CloudWatch EMF line, see ccproxy.tracing
+    'TRACING_ENABLED': lambda: config('TRACING_ENABLED', default=False, cast=bool),
+    'TRACING_NAMESPACE': lambda: config('TRACING_NAMESPACE', default='ccproxy'),
+
+    # self-hosted mode, see ccproxy.server. Every request has SERVER_REQUEST_TIMEOUT
+    # seconds, like the Lambda functions do, and idle keep-alive connections are
+    # closed after SERVER_KEEP_ALIVE_TIMEOUT seconds so they don't hold on to workers
+    'SERVER_HOST': lambda: config('SERVER_HOST', default='127.0.0.1'),
+    'SERVER_PORT': lambda: config('SERVER_PORT', default=8080, cast=int),
+    'SERVER_WORKERS': lambda: config('SERVER_WORKERS', default=8, cast=int),
+    'SERVER_REQUEST_TIMEOUT': lambda: config('SERVER_REQUEST_TIMEOUT', default=10.0, cast=float),
+    'SERVER_KEEP_ALIVE_TIMEOUT': lambda: config('SERVER_KEEP_ALIVE_TIMEOUT', default=5.0, cast=float),
+}
+
+if not TYPE_CHECKING:
+    def __getattr__(name: str) -> Any:
+        if name not in _SETTINGS:
+            raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+        value = _SETTINGS[name]()
+        globals()[name] = value
+
+        return value
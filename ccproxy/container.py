@@ -1,37 +1,119 @@
-from ccproxy import api, config, model, main
-from typing import Optional
-import json
-import boto3
-from mypy_boto3_dynamodb import DynamoDBServiceResource, DynamoDBClient
+from __future__ import annotations
+from ccproxy import api, circuit_breaker, config, idempotency, model, main, tracing
+from typing import Any, Callable, Optional, TypeVar, cast, TYPE_CHECKING
+import threading
 
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+T = TypeVar('T')
+
+# process-wide instances, survive between warm Lambda invocations
+_instances: dict[str, Any] = {}
+_instances_lock = threading.RLock()
+
+
+def _get_shared(name: str, factory: Callable[[], T]) -> T:
+    instance = _instances.get(name)
+    if instance is None:
+        with _instances_lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+
+    return cast(T, instance)
+
+
+# makes get_<name>() return a given instance, meant to be used in tests
+def override(name: str, instance: Any) -> None:
+    with _instances_lock:
+        _instances[name] = instance
 
-def create_dynamodb_resource() -> DynamoDBServiceResource:
-    return boto3.resource(
-        'dynamodb',
-        endpoint_url=_get_dynamodb_host()
-    )
+
+def reset() -> None:
+    with _instances_lock:
+        _instances.clear()
 
 
 def create_dynamodb_client() -> DynamoDBClient:
+    import boto3
+    from botocore.config import Config
+
     return boto3.client(
         'dynamodb',
-        endpoint_url=_get_dynamodb_host()
+        endpoint_url=_get_dynamodb_host(),
+        # retried by the callers instead, within the deadline of the invocation, see ccproxy.retry
+        config=Config(retries={'total_max_attempts': 1})
     )
 
 
+# items are marshalled by ccproxy.dynamodb, the resource layer isn't used
+def get_dynamodb_client() -> DynamoDBClient:
+    return _get_shared('dynamodb_client', create_dynamodb_client)
+
+
 def _get_dynamodb_host() -> Optional[str]:
     config_host = config.DYNAMODB_HOST
     return None if config_host == '' else config_host
 
 
+def get_encrypter() -> main.Encrypter:
+    return _get_shared('encrypter', main.Encrypter)
+
+
+def get_account_cache() -> main.AccountCache:
+    return _get_shared(
+        'account_cache',
+        lambda: main.AccountCache(config.ACCOUNT_CACHE_SIZE, config.ACCOUNT_CACHE_TTL)
+    )
+
+
 def create_account_table() -> main.AccountTable:
-    dynamodb_resource = create_dynamodb_resource()
+    with tracing.span('account_table.create'):
+        return main.AccountTable(get_encrypter(), get_dynamodb_client(), get_account_cache())
+
+
+def get_account_table() -> main.AccountTable:
+    return _get_shared('account_table', create_account_table)
+
+
+# None unless circuits are shared between processes, see CIRCUIT_BREAKER_TABLE
+def get_circuit_state_table() -> Optional[circuit_breaker.CircuitStateTable]:
+    if config.CIRCUIT_BREAKER_TABLE == '':
+        return None
+
+    return _get_shared(
+        'circuit_state_table',
+        lambda: circuit_breaker.CircuitStateTable(get_dynamodb_client(), config.CIRCUIT_BREAKER_TABLE)
+    )
+
+
+def create_idempotency_store() -> idempotency.IdempotencyStore:
+    if config.IDEMPOTENCY_TABLE == '':
+        return idempotency.InMemoryIdempotencyStore(config.IDEMPOTENCY_CACHE_SIZE)
+
+    return idempotency.DynamoDBIdempotencyStore(
+        get_dynamodb_client(),
+        config.IDEMPOTENCY_TABLE,
+        main.create_dynamodb_retry_policy()
+    )
+
+
+def get_idempotency_store() -> idempotency.IdempotencyStore:
+    return _get_shared('idempotency_store', create_idempotency_store)
+
+
+def get_config_loader() -> api.ConfigLoader:
+    return _get_shared('config_loader', lambda: api.ConfigLoader(config.CONFIG_FILE))
+
 
-    return main.AccountTable(main.Encrypter(), dynamodb_resource)
+def get_value_cache() -> api.ValueCache:
+    return _get_shared('value_cache', lambda: api.ValueCache(config.VALUE_CACHE_SIZE, config.VALUE_CACHE_TTL))
 
 
 def create_remote_device_controller(account: model.Account) -> api.RemoteDeviceController:
-    with open(config.CONFIG_FILE) as reader:
-        config_contents = json.loads(reader.read())
+    with tracing.span('config.load'):
+        device_config = get_config_loader().load()
 
-        return api.RemoteDeviceController(config_contents, account)
+    return api.RemoteDeviceController(device_config, account, get_value_cache())
@@ -0,0 +1,17 @@
+from typing import Any, Union
+
+# Items are marshalled by hand rather than by boto3's TypeSerializer and
+# TypeDeserializer (or the resource layer that uses them): all attributes of our
+# tables are strings or integers, which is a fraction of the work.
+
+
+def marshal_value(value: Union[str, int]) -> dict[str, str]:
+    return {'N': str(value)} if isinstance(value, int) else {'S': value}
+
+
+def marshal_item(item: dict[str, Any]) -> dict[str, Any]:
+    return {name: marshal_value(value) for name, value in item.items()}
+
+
+def unmarshal_item(item: dict[str, Any]) -> dict[str, Any]:
+    return {name: int(value['N']) if 'N' in value else value['S'] for name, value in item.items()}
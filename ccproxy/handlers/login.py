@@ -1,5 +1,5 @@
 import json
-from ccproxy import container, model, network, main
+from ccproxy import network, retry, tracing
 from ccproxy.handlers import utils as handler_utils
 import logging
 from typing import Any, Optional
@@ -7,8 +7,14 @@ from typing import Any, Optional
 logger = logging.getLogger(__name__)
 
 
+@tracing.traced('login')
+@retry.with_lambda_deadline
 @handler_utils.exception_handler(logger)
 def login_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    # imported on first invocation rather than on cold start, see tests/test_import_time.py
+    from ccproxy import container, model, main
+    from ccproxy.circuit_breaker import CircuitBreaker
+
     validation_result = _validate_request(event)
     if validation_result is not None:
         return validation_result
@@ -29,7 +35,7 @@ def login_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, A
             '_errorType': 'not_object_body_payload',
         }
 
-    account_table = container.create_account_table()
+    account_table = container.get_account_table()
 
     credentials = model.CredentialsEnvelope.parse_obj(body)
     try:
@@ -42,6 +48,8 @@ def login_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, A
             'statusCode': 403,
             'body': f'Failed to login "{credentials.username}" - "{e.type.value}" error returned.'
         }
+    except CircuitBreaker.OpenError as e:
+        return handler_utils.create_circuit_open_response(e)
 
     return {
         'statusCode': 200,
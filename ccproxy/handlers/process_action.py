@@ -1,20 +1,67 @@
-from requests import HTTPError
-from ccproxy import container, config, api, model, main
-from typing import Any, Optional
+from __future__ import annotations
+from ccproxy import config, retry, tracing
+from typing import Any, Awaitable, Callable, Optional, TypeVar, Union, TYPE_CHECKING
+import json
 import logging
 from ccproxy.handlers import utils as handler_utils
 
+if TYPE_CHECKING:
+    from ccproxy import api, model, main
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
 _ACCOUNT_HEADER_NAME = 'x-ccproxy-account'
+_IDEMPOTENCY_KEY_HEADER_NAME = 'idempotency-key'
+_IDEMPOTENCY_KEY_MAX_LENGTH = 128
+_IDEMPOTENT_REPLAY_HEADER_NAME = 'x-ccproxy-idempotent-replay'
 
 
+@tracing.traced('process_action')
+@retry.with_lambda_deadline
 @handler_utils.exception_handler(logger)
 def process_action_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    return _process_action(event, do_api_call, do_batch_api_call, do_read_api_call)
+
+
+# Same as process_action_handler, but requests to ComfortClick are sent with
+# ccproxy.async_network, on an event loop that is kept between invocations
+@tracing.traced('process_action_async')
+@retry.with_lambda_deadline
+@handler_utils.exception_handler(logger)
+def process_action_async_handler(event: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
+    from ccproxy import async_network
+
+    return _process_action(
+        event,
+        lambda account, account_table, action: async_network.run(
+            do_api_call_async(account, account_table, action)
+        ),
+        lambda account, account_table, actions: async_network.run(
+            do_batch_api_call_async(account, account_table, actions)
+        ),
+        lambda account, account_table, actions: async_network.run(
+            do_read_api_call_async(account, account_table, actions)
+        )
+    )
+
+
+def _process_action(
+    event: dict[str, Any],
+    call_action: Callable[[model.Account, main.AccountTable, str], str],
+    call_batch: Callable[[model.Account, main.AccountTable, list[str]], dict[str, Union[str, Exception]]],
+    call_read: Callable[[model.Account, main.AccountTable, list[str]], dict[str, Union[Any, Exception]]]
+) -> dict[str, Any]:
+    # modules that pull in boto3, requests and cryptography are imported
+    # on first invocation rather than on cold start, see tests/test_import_time.py
+    from ccproxy import container, warmup
+
     if 'lambda_tender' in event:
         return {
             'statusCode': 418,
-            'body': 'Brewing lambda'
+            'body': 'Brewing lambda',
+            '_timings': warmup.warm_up()
         }
 
     q = event['queryStringParameters']
@@ -23,9 +70,10 @@ def process_action_handler(event: dict[str, Any], context: dict[str, Any]) -> di
     if validation_result is not None:
         return validation_result
 
-    account_table = container.create_account_table()
+    account_table = container.get_account_table()
 
-    action = q['action']
+    action = q.get('action', '')
+    scene = q.get('scene')
 
     account_id_val = event['headers'][_ACCOUNT_HEADER_NAME][0:config.ACCOUNT_ID_LENGTH]
     account = account_table.find(account_id_val)
@@ -35,14 +83,64 @@ def process_action_handler(event: dict[str, Any], context: dict[str, Any]) -> di
             'body': f'Unable to find account "{account_id_val}".'
         }
 
+    # reads change nothing, so they aren't deduplicated
+    if 'read' in q:
+        return _process_read(account, account_table, q['read'], call_read)
+
+    # a replayed request must ask for the same thing as the first one
+    fingerprint = json.dumps({'action': action, 'scene': scene})
+    idempotency_key = _get_idempotency_key(event, account_id_val, fingerprint)
+    if idempotency_key is None:
+        return _call_actions(account, account_table, action, scene, call_action, call_batch)
+
+    key, ttl = idempotency_key
+    found_account = account
+
+    return _call_idempotently(
+        key,
+        fingerprint,
+        ttl,
+        lambda: _call_actions(found_account, account_table, action, scene, call_action, call_batch)
+    )
+
+
+def _call_actions(
+    account: model.Account,
+    account_table: main.AccountTable,
+    action: str,
+    scene: Optional[str],
+    call_action: Callable[[model.Account, main.AccountTable, str], str],
+    call_batch: Callable[[model.Account, main.AccountTable, list[str]], dict[str, Union[str, Exception]]]
+) -> dict[str, Any]:
+    from ccproxy import api
+    from ccproxy.circuit_breaker import CircuitBreaker
+
+    # several actions come either as "?action=foo,bar" or as "?action=foo&action=bar",
+    # Lambda function URLs join repeated query parameters with commas
+    if scene is not None or ',' in action:
+        actions = [name.strip() for name in action.split(',') if name.strip() != '']
+        try:
+            return _process_batch(account, account_table, actions, scene, call_batch)
+        except api.RemoteDeviceController.UnknownActionError as e:
+            name = str(e.args[0]) if len(e.args) > 0 else action
+            return {
+                'statusCode': 400,
+                'body': f'Unkown action "{name[0:16]}" given.',
+                '_errorType': 'unknown_action'
+            }
+        except CircuitBreaker.OpenError as e:
+            return handler_utils.create_circuit_open_response(e)
+
     try:
-        message = do_api_call(account, account_table, action)
+        message = call_action(account, account_table, action)
     except api.RemoteDeviceController.UnknownActionError:
         return {
             'statusCode': 400,
             'body': f'Unkown action "{action[0:16]}" given.',
             '_errorType': 'unknown_action'
         }
+    except CircuitBreaker.OpenError as e:
+        return handler_utils.create_circuit_open_response(e)
 
     return {
         'statusCode': 200,
@@ -50,8 +148,179 @@ def process_action_handler(event: dict[str, Any], context: dict[str, Any]) -> di
     }
 
 
+def _process_batch(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str],
+    scene: Optional[str],
+    call_batch: Callable[[model.Account, main.AccountTable, list[str]], dict[str, Union[str, Exception]]]
+) -> dict[str, Any]:
+    from ccproxy import container
+
+    message = None
+    if scene is not None:
+        device_controller = container.create_remote_device_controller(account)
+        actions = device_controller.get_scene_actions(scene) + actions
+        message = device_controller.get_scene_message(scene)
+
+    results = call_batch(account, account_table, list(dict.fromkeys(actions)))
+
+    body_results: dict[str, dict[str, Any]] = {}
+    for action_name, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning(f'Action "{action_name}" failed: {str(result)}')
+            body_results[action_name] = {'ok': False, 'error': _describe_error(result)}
+        else:
+            body_results[action_name] = {'ok': True, 'message': result}
+
+    if message is None:
+        message = ' '.join(result['message'] for result in body_results.values() if result['ok'])
+
+    return {
+        'statusCode': _get_batch_status_code(body_results),
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'message': message, 'results': body_results})
+    }
+
+
+# "?read=garage_door,front_door" returns current values of the actions' objects
+def _process_read(
+    account: model.Account,
+    account_table: main.AccountTable,
+    read: str,
+    call_read: Callable[[model.Account, main.AccountTable, list[str]], dict[str, Union[Any, Exception]]]
+) -> dict[str, Any]:
+    from ccproxy import api
+    from ccproxy.circuit_breaker import CircuitBreaker
+
+    actions = list(dict.fromkeys(name.strip() for name in read.split(',') if name.strip() != ''))
+    try:
+        results = call_read(account, account_table, actions)
+    except api.RemoteDeviceController.UnknownActionError as e:
+        name = str(e.args[0]) if len(e.args) > 0 else read
+        return {
+            'statusCode': 400,
+            'body': f'Unkown action "{name[0:16]}" given.',
+            '_errorType': 'unknown_action'
+        }
+    except CircuitBreaker.OpenError as e:
+        return handler_utils.create_circuit_open_response(e)
+
+    body_results: dict[str, dict[str, Any]] = {}
+    for action_name, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning(f'Reading "{action_name}" failed: {str(result)}')
+            body_results[action_name] = {'ok': False, 'error': _describe_error(result)}
+        else:
+            body_results[action_name] = {'ok': True, 'value': result}
+
+    return {
+        'statusCode': _get_batch_status_code(body_results),
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'results': body_results})
+    }
+
+
+def _describe_error(e: Exception) -> str:
+    from ccproxy.circuit_breaker import CircuitBreaker
+
+    status_code = _get_status_code(e)
+    if isinstance(e, CircuitBreaker.OpenError):
+        return 'ComfortClick is not responding'
+    elif status_code is not None:
+        return f'ComfortClick responded with {status_code}'
+
+    return 'Request to ComfortClick failed'
+
+
+def _get_batch_status_code(body_results: dict[str, dict[str, Any]]) -> int:
+    failed_count = len([result for result in body_results.values() if not result['ok']])
+    if failed_count == 0:
+        return 200
+    elif failed_count == len(body_results):
+        return 502
+
+    return 207
+
+
+# Requests that carry an "idempotency-key" header are deduplicated by the key.
+# The rest only are if IDEMPOTENCY_WINDOW is set, by what they ask for within
+# that many seconds. Keys are scoped to the account. Returns the key and for how long it's kept.
+def _get_idempotency_key(event: dict[str, Any], account_id: str, fingerprint: str) -> Optional[tuple[str, float]]:
+    key = event['headers'].get(_IDEMPOTENCY_KEY_HEADER_NAME, '')
+    if key != '':
+        return f'{account_id}#key#{key[0:_IDEMPOTENCY_KEY_MAX_LENGTH]}', config.IDEMPOTENCY_KEY_TTL
+
+    if config.IDEMPOTENCY_WINDOW > 0:
+        return f'{account_id}#window#{fingerprint}', config.IDEMPOTENCY_WINDOW
+
+    return None
+
+
+# Only responses of requests that have reached ComfortClick are replayed, a
+# request that has failed releases its key so it can be retried
+def _call_idempotently(
+    key: str,
+    fingerprint: str,
+    ttl: float,
+    call: Callable[[], dict[str, Any]]
+) -> dict[str, Any]:
+    from ccproxy import container
+
+    store = container.get_idempotency_store()
+    try:
+        record = store.claim(key, fingerprint, config.IDEMPOTENCY_PENDING_TIMEOUT)
+    except Exception as e:
+        # deduplication is a best effort, requests go through when the store is unavailable
+        logger.warning(f'Failed to claim idempotency key: {str(e)}')
+        return call()
+
+    if record is not None:
+        if record.fingerprint != fingerprint:
+            return {
+                'statusCode': 422,
+                'body': 'Idempotency key has already been used for another request.',
+                '_errorType': 'idempotency_key_reused'
+            }
+        elif record.response is None:
+            return {
+                'statusCode': 409,
+                'headers': {'Retry-After': '1'},
+                'body': 'The same request is being processed.',
+                '_errorType': 'request_in_progress'
+            }
+
+        tracing.count('idempotent_replays')
+
+        return record.response | {
+            'headers': record.response.get('headers', {}) | {_IDEMPOTENT_REPLAY_HEADER_NAME: 'true'}
+        }
+
+    response = None
+    try:
+        response = call()
+    finally:
+        try:
+            if response is not None and response['statusCode'] in (200, 207):
+                store.complete(key, fingerprint, response, ttl)
+            else:
+                store.release(key)
+        except Exception as e:
+            logger.warning(f'Failed to store response of idempotency key: {str(e)}')
+
+    return response
+
+
+# works for both requests' HTTPError and httpx' HTTPStatusError
+def _get_status_code(e: Exception) -> Optional[int]:
+    status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+
+    return status_code if isinstance(status_code, int) else None
+
+
 def _validate_request(event: dict[str, Any]) -> Optional[dict[str, Any]]:
-    if 'action' not in event['queryStringParameters']:
+    q = event['queryStringParameters']
+    if 'action' not in q and 'scene' not in q and 'read' not in q:
         return {
             'statusCode': 400,
             'body': '"action" is not specified. For example, you can append this to URL: ?action=open_garage',
@@ -68,19 +337,155 @@ def _validate_request(event: dict[str, Any]) -> Optional[dict[str, Any]]:
     return None
 
 
-# TODO convert to _do_api_call
-def do_api_call(account: model.Account, account_table: main.AccountTable, action: str, is_retry: bool = False) -> str:
-    device_controller = container.create_remote_device_controller(account)
+def do_api_call(account: model.Account, account_table: main.AccountTable, action: str) -> str:
+    return _unwrap(_call_with_reauth(
+        account, account_table, [action], lambda device_controller, actions: _call_one(device_controller.toggle, actions)
+    )[action])
+
+
+# Toggles several actions concurrently over one session, only actions that were
+# rejected with 401 are retried once the account has re-authenticated
+def do_batch_api_call(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str]
+) -> dict[str, Union[str, Exception]]:
+    return _call_with_reauth(
+        account, account_table, actions, lambda device_controller, actions: device_controller.toggle_many(actions)
+    )
+
+
+# Reads values of several actions' objects, same as do_batch_api_call() otherwise
+def do_read_api_call(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str]
+) -> dict[str, Union[Any, Exception]]:
+    return _call_with_reauth(
+        account, account_table, actions, lambda device_controller, actions: device_controller.read_many(actions)
+    )
+
+
+async def do_api_call_async(account: model.Account, account_table: main.AccountTable, action: str) -> str:
+    return _unwrap((await _call_with_reauth_async(
+        account,
+        account_table,
+        [action],
+        lambda device_controller, actions: _call_one_async(device_controller.toggle_async, actions)
+    ))[action])
+
+
+async def do_batch_api_call_async(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str]
+) -> dict[str, Union[str, Exception]]:
+    return await _call_with_reauth_async(
+        account, account_table, actions, lambda device_controller, actions: device_controller.toggle_many_async(actions)
+    )
+
+
+async def do_read_api_call_async(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str]
+) -> dict[str, Union[Any, Exception]]:
+    return await _call_with_reauth_async(
+        account, account_table, actions, lambda device_controller, actions: device_controller.read_many_async(actions)
+    )
+
+
+# Calls ComfortClick with the account's session. A cookie that is about to expire
+# is refreshed up front, actions rejected with 401 are retried once after the
+# account has re-authenticated. _call_with_reauth_async() is the same, but for
+# the calls being awaited.
+def _call_with_reauth(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str],
+    call: Callable[[api.RemoteDeviceController, list[str]], dict[str, Union[T, Exception]]],
+    is_retry: bool = False
+) -> dict[str, Union[T, Exception]]:
+    from ccproxy import container, main
 
+    if not is_retry and _is_cookie_expiring(account):
+        account = main.reauthenticate(account, account_table)
+        is_retry = True
+
+    results = call(container.create_remote_device_controller(account), actions)
+
+    expired_actions = [] if is_retry else _get_expired_actions(account, results)
+    if len(expired_actions) > 0:
+        refreshed_account = main.reauthenticate(account, account_table)
+        results |= _call_with_reauth(refreshed_account, account_table, expired_actions, call, True)
+
+    return results
+
+
+async def _call_with_reauth_async(
+    account: model.Account,
+    account_table: main.AccountTable,
+    actions: list[str],
+    call: Callable[[api.RemoteDeviceController, list[str]], Awaitable[dict[str, Union[T, Exception]]]],
+    is_retry: bool = False
+) -> dict[str, Union[T, Exception]]:
+    from ccproxy import container, main
+
+    if not is_retry and _is_cookie_expiring(account):
+        account = await main.reauthenticate_async(account, account_table)
+        is_retry = True
+
+    results = await call(container.create_remote_device_controller(account), actions)
+
+    expired_actions = [] if is_retry else _get_expired_actions(account, results)
+    if len(expired_actions) > 0:
+        refreshed_account = await main.reauthenticate_async(account, account_table)
+        results |= await _call_with_reauth_async(refreshed_account, account_table, expired_actions, call, True)
+
+    return results
+
+
+def _is_cookie_expiring(account: model.Account) -> bool:
+    from ccproxy import main
+
+    if not main.is_cookie_stale(account):
+        return False
+
+    logger.info(f'Auth token is about to expire, re-authenticating user "{account.username}"')
+
+    return True
+
+
+# actions that failed because the session has expired
+def _get_expired_actions(account: model.Account, results: dict[str, Union[T, Exception]]) -> list[str]:
+    expired_actions = [
+        action for action, result in results.items()
+        if isinstance(result, Exception) and _get_status_code(result) == 401
+    ]
+    if len(expired_actions) > 0:
+        logger.info(f'Auth token expired, re-authenticating user "{account.username}"')
+        tracing.count('retries')
+
+    return expired_actions
+
+
+# a single action in the shape of the results of toggle_many()
+def _call_one(fn: Callable[[str], T], actions: list[str]) -> dict[str, Union[T, Exception]]:
     try:
-        return device_controller.toggle(action)
-    except HTTPError as e:
-        if e.response.status_code == 401 and not is_retry:
-            logger.info(
-                f'Auth token expired, re-authenticating user "{account.username}"'
-            )
-            refreshed_account = main.authenticate(account, account_table)
-
-            return do_api_call(refreshed_account, account_table, action, True)
-        else:
-            raise e
+        return {actions[0]: fn(actions[0])}
+    except Exception as e:
+        return {actions[0]: e}
+
+
+async def _call_one_async(fn: Callable[[str], Awaitable[T]], actions: list[str]) -> dict[str, Union[T, Exception]]:
+    try:
+        return {actions[0]: await fn(actions[0])}
+    except Exception as e:
+        return {actions[0]: e}
+
+
+def _unwrap(result: Union[T, Exception]) -> T:
+    if isinstance(result, Exception):
+        raise result
+
+    return result
@@ -1,6 +1,11 @@
-from typing import Any, Callable
+from __future__ import annotations
+from typing import Any, Callable, TYPE_CHECKING
 from logging import Logger
 import functools
+import math
+
+if TYPE_CHECKING:
+    from ccproxy.circuit_breaker import CircuitBreaker
 
 def create_generic_error_response(logger: Logger, exception: Exception) -> dict[str,  Any]:
     logger.critical(f'Generic exception during login: {str(exception)}')
@@ -10,6 +15,18 @@ def create_generic_error_response(logger: Logger, exception: Exception) -> dict[
     }
 
 
+# ComfortClick has been failing lately, the request is refused without waiting for it
+def create_circuit_open_response(exception: CircuitBreaker.OpenError) -> dict[str, Any]:
+    retry_after = max(1, math.ceil(exception.retry_after))
+
+    return {
+        'statusCode': 503,
+        'headers': {'Retry-After': str(retry_after)},
+        'body': f'ComfortClick is not responding, try again in {retry_after} seconds.',
+        '_errorType': 'comfortclick_unavailable'
+    }
+
+
 def exception_handler(logger: Logger) -> Callable[..., Any]:
     def decorator(handler_fn: Callable[..., dict[str, Any]]) -> Callable[..., dict[str, Any]]:
         if not hasattr(handler_fn, 'decorators'):
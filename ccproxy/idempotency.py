@@ -0,0 +1,138 @@
+from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Union, TYPE_CHECKING
+import json
+import math
+import threading
+import time
+import uuid
+from ccproxy import dynamodb, retry
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
+
+# Responses of process_action are remembered by idempotency key, so a request
+# that is sent again (e.g. a client retrying after a timeout) gets the response
+# of the first one instead of toggling a device for a second time. A key is
+# claimed before ComfortClick is called: requests that come while the first one
+# is still in flight see it pending. Once the request is over, its response is
+# stored for "ttl" seconds, or the claim is released when the request has failed
+# so it can be retried.
+
+
+@dataclass
+class Record:
+    # what the key was used for, e.g. an action, the same key can't be reused for something else
+    fingerprint: str
+    # None while the request is in flight
+    response: Optional[dict[str, Any]]
+
+
+# In-process store, only duplicates that reach the same Lambda container are caught
+class InMemoryIdempotencyStore:
+    def __init__(self, max_size: int, clock: Callable[[], float] = time.time) -> None:
+        self._max_size = max_size
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, Record]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # returns None when the key has been claimed, otherwise the record that holds it
+    def claim(self, key: str, fingerprint: str, timeout: float) -> Optional[Record]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                return entry[1]
+
+            self._put(key, Record(fingerprint, None), timeout)
+
+            return None
+
+    def complete(self, key: str, fingerprint: str, response: dict[str, Any], ttl: float) -> None:
+        with self._lock:
+            self._put(key, Record(fingerprint, response), ttl)
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _put(self, key: str, record: Record, ttl: float) -> None:
+        self._entries[key] = (self._clock() + ttl, record)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+# Store shared by all containers. Items expire through DynamoDB's TTL on
+# "expires_at", which may lag behind, so expired items are overwritten as well.
+class DynamoDBIdempotencyStore:
+    def __init__(
+        self,
+        dynamodb_client: DynamoDBClient,
+        table_name: str,
+        retry_policy: retry.RetryPolicy,
+        clock: Callable[[], float] = time.time
+    ) -> None:
+        self._dynamodb = dynamodb_client
+        self._table_name = table_name
+        self._retry_policy = retry_policy
+        self._clock = clock
+
+    def claim(self, key: str, fingerprint: str, timeout: float) -> Optional[Record]:
+        now = self._clock()
+        # when the put is retried after it has actually succeeded, its condition
+        # fails and the claim is recognized by the owner
+        owner = str(uuid.uuid4())
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.put_item(
+                TableName=self._table_name,
+                Item=dynamodb.marshal_item({
+                    'id': key,
+                    'owner': owner,
+                    'fingerprint': fingerprint,
+                    'expires_at': math.ceil(now + timeout)
+                }),
+                ConditionExpression='attribute_not_exists(id) OR expires_at < :now',
+                ExpressionAttributeValues=dynamodb.marshal_item({':now': math.floor(now)})
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+        else:
+            return None
+
+        row = self._retry_policy.call(lambda: self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key=dynamodb.marshal_item({'id': key}),
+            ConsistentRead=True
+        ))
+        if 'Item' not in row:
+            # released in the meantime, the request has failed and is being retried
+            return Record(fingerprint, None)
+
+        item = dynamodb.unmarshal_item(row['Item'])
+        if item.get('owner') == owner:
+            return None
+
+        response = item.get('response')
+
+        return Record(item['fingerprint'], None if response is None else json.loads(response))
+
+    def complete(self, key: str, fingerprint: str, response: dict[str, Any], ttl: float) -> None:
+        self._retry_policy.call(lambda: self._dynamodb.put_item(
+            TableName=self._table_name,
+            Item=dynamodb.marshal_item({
+                'id': key,
+                'fingerprint': fingerprint,
+                'response': json.dumps(response),
+                'expires_at': math.ceil(self._clock() + ttl)
+            })
+        ))
+
+    def release(self, key: str) -> None:
+        self._retry_policy.call(lambda: self._dynamodb.delete_item(
+            TableName=self._table_name,
+            Key=dynamodb.marshal_item({'id': key})
+        ))
+
+
+IdempotencyStore = Union[InMemoryIdempotencyStore, DynamoDBIdempotencyStore]
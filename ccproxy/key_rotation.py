@@ -0,0 +1,146 @@
+from ccproxy import main
+from cryptography.fernet import InvalidToken
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Optional
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# attributes that hold ciphertext
+_ENCRYPTED_ATTRIBUTES = ('password', 'cookie')
+
+
+@dataclass
+class RotationStats:
+    scanned: int = 0
+    rotated: int = 0
+    # accounts that were written by someone else while being rotated, these
+    # already hold ciphertext of the primary key
+    skipped: int = 0
+    # accounts holding ciphertext that none of the keys decrypts
+    failed: int = 0
+
+
+# Where every scan segment has got to, stored in a JSON file after every page so
+# an interrupted rotation resumes instead of starting over
+class RotationProgress:
+    def __init__(self, path: str, total_segments: int) -> None:
+        self._path = path
+        self._total_segments = total_segments
+        self._lock = threading.Lock()
+        self._segments: dict[str, dict[str, Any]] = {}
+
+        if os.path.exists(path):
+            with open(path) as reader:
+                state = json.load(reader)
+
+            if state['total_segments'] != total_segments:
+                raise RuntimeError(
+                    f'"{path}" was recorded with {state["total_segments"]} segments, '
+                    f'resume with the same number or remove the file'
+                )
+            self._segments = state['segments']
+
+    def is_done(self, segment: int) -> bool:
+        return bool(self._segments.get(str(segment), {}).get('done', False))
+
+    def get_start_key(self, segment: int) -> Optional[dict[str, Any]]:
+        start_key: Optional[dict[str, Any]] = self._segments.get(str(segment), {}).get('last_key')
+        return start_key
+
+    def update(self, segment: int, last_key: Optional[dict[str, Any]]) -> None:
+        with self._lock:
+            self._segments[str(segment)] = {'last_key': last_key, 'done': last_key is None}
+
+            # written aside and renamed, so a crash never leaves a truncated file
+            tmp_path = f'{self._path}.tmp'
+            with open(tmp_path, 'w') as writer:
+                json.dump({'total_segments': self._total_segments, 'segments': self._segments}, writer)
+            os.replace(tmp_path, self._path)
+
+    def remove(self) -> None:
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+# Re-encrypts passwords and cookies of all accounts with the primary key of the
+# encrypter. The table is scanned in parallel segments, one worker thread per
+# segment, a page at a time, so memory stays bounded by segments * page_size.
+# Accounts already encrypted with the primary key are skipped, so a rotation
+# can be safely re-run or resumed.
+def rotate_encryption_key(
+    account_table: main.AccountTable,
+    encrypter: main.Encrypter,
+    progress: RotationProgress,
+    total_segments: int,
+    page_size: int
+) -> RotationStats:
+    stats = RotationStats()
+    stats_lock = threading.Lock()
+
+    def rotate_segment(segment: int) -> None:
+        if progress.is_done(segment):
+            return
+
+        start_key = progress.get_start_key(segment)
+        while True:
+            items, start_key = account_table.scan_encrypted_attributes(
+                segment, total_segments, page_size, start_key
+            )
+            page_stats = _rotate_items(account_table, encrypter, items)
+
+            with stats_lock:
+                stats.scanned += page_stats.scanned
+                stats.rotated += page_stats.rotated
+                stats.skipped += page_stats.skipped
+                stats.failed += page_stats.failed
+
+            progress.update(segment, start_key)
+            if start_key is None:
+                break
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        # result() re-raises the first failure, progress is kept for a resume
+        for future in [executor.submit(rotate_segment, segment) for segment in range(total_segments)]:
+            future.result()
+
+    progress.remove()
+
+    return stats
+
+
+def _rotate_items(
+    account_table: main.AccountTable,
+    encrypter: main.Encrypter,
+    items: list[dict[str, Any]]
+) -> RotationStats:
+    stats = RotationStats(scanned=len(items))
+
+    for item in items:
+        expected = {name: str(item[name]) for name in _ENCRYPTED_ATTRIBUTES if name in item}
+
+        replacements = {}
+        try:
+            for name, value in expected.items():
+                rotated_value = encrypter.rotate(value)
+                if rotated_value is not None:
+                    replacements[name] = rotated_value
+        except InvalidToken:
+            logger.error(f'Account "{item["id"]}" can\'t be decrypted with any of the keys')
+            stats.failed += 1
+            continue
+
+        if len(replacements) == 0:
+            continue
+
+        if account_table.replace_encrypted_attributes(str(item['id']), expected, replacements):
+            stats.rotated += 1
+        else:
+            logger.info(f'Account "{item["id"]}" has been modified during rotation, skipping it')
+            stats.skipped += 1
+
+    return stats
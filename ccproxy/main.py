@@ -1,110 +1,725 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import random
 import uuid
-from typing import Optional, Any
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Generator, Iterable, Optional, Any, Sequence, TypeVar, TYPE_CHECKING
 from ccproxy import config
-from boto3.dynamodb.conditions import Key, Attr
-from cryptography.fernet import Fernet
-from mypy_boto3_dynamodb import DynamoDBServiceResource
-from ccproxy import model, network
+from ccproxy import dynamodb, model, network, retry, tracing
 
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBClient
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+HOST_USERNAME_INDEX = 'HostUsernameIndex'
+# TODO drop together with HostAndUsernameIndex once all accounts are backfilled
+# with "host_username", see AccountTable.backfill_host_username_keys() and
+# LEGACY_HOST_INDEX_FALLBACK
+LEGACY_HOST_INDEX = 'HostAndUsernameIndex'
+
+
+# attributes that model.Account is hydrated from, bookkeeping attributes
+# (e.g. "host_username") are never fetched
+_ACCOUNT_PROJECTION = 'id, username, password, host, cookie, cookie_issued_at, cookie_expires_at, version'
+
+# DynamoDB limits, and retries of items that batch operations left unprocessed
+_BATCH_GET_SIZE = 100
+_BATCH_WRITE_SIZE = 25
+_BATCH_MAX_ATTEMPTS = 8
+_BATCH_BASE_BACKOFF = 0.05
+_BATCH_MAX_BACKOFF = 2.0
+
+# attributes of model.Account that AccountTable.save() writes
+_ACCOUNT_FIELDS = ('username', 'password', 'host', 'cookie', 'cookie_issued_at', 'cookie_expires_at')
+
+
+def create_host_username_key(host: str, username: str) -> str:
+    return f'{host}#{username}'
+
+
+def _serialize_datetime(value: Optional[datetime]) -> Optional[str]:
+    return None if value is None else value.isoformat()
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+# DB_ENCRYPTION_KEY may hold a comma-separated list of keys: the first one
+# encrypts, any of them decrypts. This way ciphertext of a previous key keeps
+# working while the key is being rotated, see "make rotate-db-key".
 class Encrypter:
-    def __init__(self) -> None:
-        self._fernet = Fernet(bytes(config.DB_ENCRYPTION_KEY, 'utf-8'))
+    def __init__(self, keys: Optional[Sequence[str]] = None) -> None:
+        from cryptography.fernet import Fernet, MultiFernet
+
+        if keys is None:
+            keys = parse_encryption_keys(config.DB_ENCRYPTION_KEY)
+        if len(keys) == 0:
+            raise RuntimeError('At least one encryption key has to be provided')
+
+        fernets = [Fernet(bytes(key, 'utf-8')) for key in keys]
+        self._primary_fernet = fernets[0]
+        self._fernet = MultiFernet(fernets)
+
+    # re-encrypts a value with the primary key, None if it already is encrypted with it
+    def rotate(self, encrypted_value: str) -> Optional[str]:
+        from cryptography.fernet import InvalidToken
+
+        token = bytes(encrypted_value, 'utf-8')
+        try:
+            self._primary_fernet.decrypt(token)
+        except InvalidToken:
+            return self._fernet.rotate(token).decode('utf-8')
+
+        return None
 
     def encrypt(self, raw_password: str) -> str:
-        return self._fernet.encrypt(bytes(raw_password, 'utf-8')).decode('utf-8')
+        with tracing.span('fernet'):
+            return self._fernet.encrypt(bytes(raw_password, 'utf-8')).decode('utf-8')
 
     def decrypt(self, encrypted_password: str) -> str:
-        return self._fernet.decrypt(bytes(encrypted_password, 'utf-8')).decode('utf-8')
+        with tracing.span('fernet'):
+            return self._fernet.decrypt(bytes(encrypted_password, 'utf-8')).decode('utf-8')
+
+    # Fernet has no batch primitive, these just process a whole batch in one go
+    def encrypt_many(self, raw_values: Sequence[str]) -> list[str]:
+        encrypt = self._fernet.encrypt
+        return [encrypt(bytes(value, 'utf-8')).decode('utf-8') for value in raw_values]
+
+    def decrypt_many(self, encrypted_values: Sequence[str]) -> list[str]:
+        decrypt = self._fernet.decrypt
+        return [decrypt(bytes(value, 'utf-8')).decode('utf-8') for value in encrypted_values]
+
+
+def parse_encryption_keys(value: str) -> list[str]:
+    return [key.strip() for key in value.split(',') if key.strip() != '']
+
+
+# In-process LRU cache of hydrated accounts, entries expire after "ttl" seconds.
+# Cached instances are shared with callers, so an account that is modified
+# must be saved (which refreshes the entry) or invalidated.
+class AccountCache:
+    def __init__(self, max_size: int, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, model.Account]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id: str) -> Optional[model.Account]:
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(id)
+                self.hits += 1
+
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[id]
+            self.misses += 1
+
+            return None
+
+    def put(self, account: model.Account) -> None:
+        if account.id is None or self._max_size <= 0:
+            return
+
+        with self._lock:
+            # an older version of the account (e.g. read before a concurrent save) never replaces a newer one
+            entry = self._entries.get(account.id)
+            if (
+                entry is not None and entry[0] > self._clock()
+                and entry[1].version is not None and account.version is not None
+                and entry[1].version > account.version
+            ):
+                return
+
+            self._entries[account.id] = (self._clock() + self._ttl, account)
+            self._entries.move_to_end(account.id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, id: str) -> None:
+        with self._lock:
+            self._entries.pop(id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def accounts(self) -> list[model.Account]:
+        with self._lock:
+            now = self._clock()
+            return [account for expires_at, account in self._entries.values() if expires_at > now]
 
 
 class AccountTable:
-    def __init__(self, encrypter: Encrypter, dynamodb_resource: DynamoDBServiceResource):
-        # TODO prolly better jus to pass a Table to constructor?
-        self._table = dynamodb_resource.Table(config.ACCOUNTS_TABLE)
+    def __init__(
+        self,
+        encrypter: Encrypter,
+        dynamodb_client: DynamoDBClient,
+        cache: Optional[AccountCache] = None,
+        retry_policy: Optional[retry.RetryPolicy] = None
+    ):
+        # the low-level client, see dynamodb.marshal_item()
+        self._dynamodb = dynamodb_client
+        self._table_name = config.ACCOUNTS_TABLE
         self._encrypter = encrypter
+        self._cache = cache
+        # Every call is retried on throttling and transient errors (boto3's own
+        # retries are turned off, see container.create_dynamodb_client()). A
+        # write whose response got lost may have succeeded, so its retry finds
+        # the item already written. Unconditional writes simply write the same
+        # item again. Conditional writes accept what they would have written
+        # themselves: inserts check whether the row that is there is theirs,
+        # leases accept their own owner and ciphertext replacements their own
+        # ciphertexts. Only updates of an account fail, with ConflictError,
+        # which callers handle the same way as a concurrent write.
+        self._retry_policy = retry_policy or create_dynamodb_retry_policy()
 
+    # Raised when the stored row has changed since the account was loaded
+    class ConflictError(RuntimeError):
+        pass
+
+    # Only fields that have changed since the account was loaded are written,
+    # conditioned on the version it was loaded with. Rows written before
+    # versioning are written in full once, which stores their first version.
+    # The new version is set on the account.
     def save(self, account: model.Account) -> model.Account:
         if account.cookie is None:
             raise RuntimeError(f"model.cookie cannot be None (but for Account with username '{account.username}' it is)")
 
-        encrypted_password = self._encrypter.encrypt(account.password)
-        encrypted_cookie = self._encrypter.encrypt(account.cookie)
+        with tracing.span('dynamodb.save'):
+            if account.id is None:
+                self._insert(account)
+            elif account.version is None:
+                self._update(account, _ACCOUNT_FIELDS, 'attribute_not_exists(version)', {})
+            else:
+                fields = [name for name in _ACCOUNT_FIELDS if name in account.dirty_fields]
+                if len(fields) == 0:
+                    return account
 
-        if account.id is None:
-            id = str(uuid.uuid4())[:config.ACCOUNT_ID_LENGTH]
-
-            self._table.put_item(
-                Item={
-                    'id': id,
-                    'username': account.username,
-                    'password': encrypted_password,
-                    'host': account.host,
-                    'cookie': encrypted_cookie
-                }
-            )
+                self._update(account, fields, 'version = :expected_version', {':expected_version': account.version})
+
+        account.mark_clean()
+        if self._cache is not None:
+            self._cache.put(account)
+
+        return account
+
+    def _insert(self, account: model.Account) -> None:
+        id = str(uuid.uuid4())[:config.ACCOUNT_ID_LENGTH]
+        attributes = self._serialize(account, _ACCOUNT_FIELDS)
+
+        # None values are not stored
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.put_item(
+                TableName=self._table_name,
+                Item=dynamodb.marshal_item(
+                    {'id': id, 'version': 1} | {name: value for name, value in attributes.items() if value is not None}
+                ),
+                ConditionExpression='attribute_not_exists(id)'
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            # a retry finds the row of the attempt that succeeded, ciphertexts are unique
+            if self._find_encrypted_cookie(id) != attributes['cookie']:
+                raise
+
+        account.id = id
+        account.version = 1
+
+    def _find_encrypted_cookie(self, id: str) -> Optional[str]:
+        row = self._retry_policy.call(lambda: self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key={
+                'id': {'S': id}
+            },
+            ProjectionExpression='cookie',
+            ConsistentRead=True
+        ))
+
+        return dynamodb.unmarshal_item(row.get('Item', {})).get('cookie')
+
+    def _update(
+        self,
+        account: model.Account,
+        fields: Sequence[str],
+        condition_expression: str,
+        condition_values: dict[str, Any]
+    ) -> None:
+        assert account.id is not None
+        account_id = account.id
+
+        version = (account.version or 0) + 1
+        attributes: dict[str, Any] = self._serialize(account, fields) | {'version': version}
+
+        set_names = [name for name, value in attributes.items() if value is not None]
+        remove_names = [name for name, value in attributes.items() if value is None]
+
+        update_expression = 'SET ' + ', '.join(f'{name} = :{name}' for name in set_names)
+        if len(remove_names) > 0:
+            update_expression += ' REMOVE ' + ', '.join(remove_names)
 
-            account.id = id
-        else:
-            self._table.update_item(
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.update_item(
+                TableName=self._table_name,
                 Key={
-                    'id': account.id
+                    'id': {'S': account_id}
                 },
-                UpdateExpression='SET username = :username, password = :password, host = :host, cookie = :cookie',
-                ExpressionAttributeValues={
-                    ':username': account.username,
-                    ':password': encrypted_password,
-                    ':host': account.host,
-                    ':cookie': encrypted_cookie
-                }
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues=dynamodb.marshal_item(
+                    {f':{name}': attributes[name] for name in set_names} | condition_values
+                )
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            if self._cache is not None:
+                self._cache.invalidate(account.id)
+
+            raise self.ConflictError(f'Account "{account.id}" has been modified concurrently')
+
+        account.version = version
+
+    # ciphertexts can be given when they've been computed in bulk
+    def _serialize(
+        self,
+        account: model.Account,
+        fields: Sequence[str],
+        encrypted_password: Optional[str] = None,
+        encrypted_cookie: Optional[str] = None
+    ) -> dict[str, Optional[str]]:
+        attributes: dict[str, Optional[str]] = {}
+        for name in fields:
+            if name == 'password':
+                # untouched passwords keep their ciphertext
+                attributes[name] = (
+                    encrypted_password or account.encrypted_password or self._encrypter.encrypt(account.password)
+                )
+            elif name == 'cookie':
+                if encrypted_cookie is None and account.cookie is not None:
+                    encrypted_cookie = self._encrypter.encrypt(account.cookie)
+                attributes[name] = encrypted_cookie
+            elif name in ('cookie_issued_at', 'cookie_expires_at'):
+                attributes[name] = _serialize_datetime(getattr(account, name))
+            else:
+                attributes[name] = getattr(account, name)
+
+        if 'host' in fields or 'username' in fields:
+            attributes['host_username'] = create_host_username_key(account.host, account.username)
+
+        return attributes
+
+    # Writes accounts with BatchWriteItem, 25 per request. BatchWriteItem can't
+    # carry conditions, so unlike save() every account is written in full and
+    # unconditionally (last writer wins), meant for bulk operations rather than
+    # request handling.
+    def save_many(self, accounts: Sequence[model.Account]) -> list[model.Account]:
+        ids = [account.id for account in accounts if account.id is not None]
+        if len(ids) != len(set(ids)):
+            raise RuntimeError('Accounts to save contain duplicate ids')
+
+        cookies = []
+        for account in accounts:
+            if account.cookie is None:
+                raise RuntimeError(f"model.cookie cannot be None (but for Account with username '{account.username}' it is)")
+            cookies.append(account.cookie)
+
+        encrypted_cookies = self._encrypter.encrypt_many(cookies)
+        # untouched passwords keep their ciphertext, the rest is encrypted in one go
+        encrypted_passwords = iter(self._encrypter.encrypt_many(
+            [account.password for account in accounts if account.encrypted_password is None]
+        ))
+
+        items: list[dict[str, Any]] = []
+        for account, encrypted_cookie in zip(accounts, encrypted_cookies):
+            attributes = self._serialize(
+                account,
+                _ACCOUNT_FIELDS,
+                encrypted_password=account.encrypted_password or next(encrypted_passwords),
+                encrypted_cookie=encrypted_cookie
             )
+            id = account.id or str(uuid.uuid4())[:config.ACCOUNT_ID_LENGTH]
+            version = (account.version or 0) + 1
 
-        return account
+            items.append(
+                {'id': id, 'version': version} | {name: value for name, value in attributes.items() if value is not None}
+            )
 
-    def _decrypt(self, account: model.Account) -> None:
-        account.password = self._encrypter.decrypt(
-            account.password
-        )
-        account.cookie = self._encrypter.decrypt(
-            account.cookie # type: ignore[arg-type]
-        )
+        for chunk in _chunk(items, _BATCH_WRITE_SIZE):
+            _call_until_processed(
+                lambda request_items: self._retry_policy.call(lambda: self._dynamodb.batch_write_item(
+                    RequestItems=request_items
+                )).get('UnprocessedItems', {}),
+                {self._table_name: [{'PutRequest': {'Item': dynamodb.marshal_item(item)}} for item in chunk]}
+            )
 
-    def _hydrate(self, item: dict[str, Any]) -> model.Account:
-        account = model.Account.parse_obj(item)
-        self._decrypt(account)
+        for account, item in zip(accounts, items):
+            account.id = item['id']
+            account.version = item['version']
+            account.mark_clean()
+            if self._cache is not None:
+                self._cache.put(account)
 
-        return account
+        return list(accounts)
 
-    def find_by_host_and_username(self, host: str, username: str) -> Optional[model.Account]:
-        response = self._table.query(
-            IndexName='HostAndUsernameIndex',
-            KeyConditionExpression=(
-                Key('host').eq(host)
-            ),
-            FilterExpression=(Attr('username').eq(username))
+    def _hydrate(self, item: dict[str, Any], cookie: Optional[str] = None) -> model.Account:
+        # password is only needed to re-authenticate, so it is decrypted lazily
+        return model.Account.from_encrypted_password(
+            item['password'],
+            self._encrypter.decrypt,
+            id=item['id'],
+            username=item['username'],
+            host=item['host'],
+            cookie=self._encrypter.decrypt(item['cookie']) if cookie is None else cookie,
+            cookie_issued_at=_parse_datetime(item.get('cookie_issued_at')),
+            cookie_expires_at=_parse_datetime(item.get('cookie_expires_at')),
+            version=int(item['version']) if 'version' in item else None
         )
 
-        items = response['Items']
+    def find_by_host_and_username(self, host: str, username: str) -> Optional[model.Account]:
+        response = self._retry_policy.call(lambda: self._dynamodb.query(
+            TableName=self._table_name,
+            IndexName=HOST_USERNAME_INDEX,
+            KeyConditionExpression='host_username = :host_username',
+            ExpressionAttributeValues={
+                ':host_username': {'S': create_host_username_key(host, username)}
+            }
+        ))
+
+        items = [dynamodb.unmarshal_item(item) for item in response['Items']]
+        if len(items) == 0 and config.LEGACY_HOST_INDEX_FALLBACK:
+            items = self._find_legacy_by_host_and_username(host, username)
+
         if len(items) > 1:
             raise Exception(
                 'Multiple records were returned for "host" and "username"'
             )
 
-        return self._hydrate(response['Items'][0]) if len(items) == 1 else None
+        return self._hydrate(items[0]) if len(items) == 1 else None
+
+    # accounts created before "host_username" was introduced are only reachable via
+    # the legacy index, these get backfilled in place as soon as they are found
+    def _find_legacy_by_host_and_username(self, host: str, username: str) -> list[dict[str, Any]]:
+        items: list[dict[str, Any]] = []
 
-    def find(self, id: str) -> Optional[model.Account]:
-        row = self._table.get_item(
+        query_kwargs: dict[str, Any] = {
+            'TableName': self._table_name,
+            'IndexName': LEGACY_HOST_INDEX,
+            'KeyConditionExpression': 'host = :host',
+            'FilterExpression': 'username = :username',
+            'ExpressionAttributeValues': {
+                ':host': {'S': host},
+                ':username': {'S': username}
+            }
+        }
+        while True:
+            response = self._retry_policy.call(lambda: self._dynamodb.query(**query_kwargs))
+            items.extend(dynamodb.unmarshal_item(item) for item in response['Items'])
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        for item in items:
+            if 'host_username' not in item:
+                self._set_host_username_key(item['id'], host, username)
+
+        return items
+
+    def _set_host_username_key(self, id: str, host: str, username: str) -> None:
+        self._retry_policy.call(lambda: self._dynamodb.update_item(
+            TableName=self._table_name,
             Key={
-                'id': id
+                'id': {'S': id}
+            },
+            UpdateExpression='SET host_username = :host_username',
+            ConditionExpression='attribute_exists(id)',
+            ExpressionAttributeValues={
+                ':host_username': {'S': create_host_username_key(host, username)}
             }
+        ))
+
+    def backfill_host_username_keys(self) -> int:
+        count = 0
+
+        scan_kwargs: dict[str, Any] = {
+            'TableName': self._table_name,
+            'ProjectionExpression': 'id, host, username, host_username'
+        }
+        while True:
+            response = self._retry_policy.call(lambda: self._dynamodb.scan(**scan_kwargs))
+            for item in map(dynamodb.unmarshal_item, response['Items']):
+                if 'host_username' not in item:
+                    self._set_host_username_key(
+                        str(item['id']), str(item['host']), str(item['username'])
+                    )
+                    count += 1
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return count
+
+    # one page of a (parallel) scan over the encrypted attributes, returns raw
+    # items and the key to continue from, None once the segment is exhausted
+    def scan_encrypted_attributes(
+        self,
+        segment: int,
+        total_segments: int,
+        page_size: int,
+        exclusive_start_key: Optional[dict[str, Any]] = None
+    ) -> tuple[list[dict[str, Any]], Optional[dict[str, Any]]]:
+        scan_kwargs: dict[str, Any] = {
+            'TableName': self._table_name,
+            'ProjectionExpression': 'id, password, cookie',
+            'Segment': segment,
+            'TotalSegments': total_segments,
+            'Limit': page_size
+        }
+        if exclusive_start_key is not None:
+            scan_kwargs['ExclusiveStartKey'] = dynamodb.marshal_item(exclusive_start_key)
+
+        response = self._retry_policy.call(lambda: self._dynamodb.scan(**scan_kwargs))
+        last_evaluated_key = response.get('LastEvaluatedKey')
+
+        return (
+            [dynamodb.unmarshal_item(item) for item in response['Items']],
+            None if last_evaluated_key is None else dynamodb.unmarshal_item(last_evaluated_key)
+        )
+
+    # Replaces ciphertexts of an account as long as they still hold the expected
+    # values, returns False if the account has been written in the meantime.
+    # The version is left as is, as the decrypted values don't change.
+    def replace_encrypted_attributes(self, id: str, expected: dict[str, str], replacements: dict[str, str]) -> bool:
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.update_item(
+                TableName=self._table_name,
+                Key={
+                    'id': {'S': id}
+                },
+                UpdateExpression='SET ' + ', '.join(f'{name} = :{name}' for name in replacements),
+                # a retry finds the replacements written by the attempt that succeeded
+                ConditionExpression=' AND '.join(
+                    f'({name} = :expected_{name} OR {name} = :{name})' if name in replacements
+                    else f'{name} = :expected_{name}'
+                    for name in expected
+                ),
+                ExpressionAttributeValues=dynamodb.marshal_item(
+                    {f':{name}': value for name, value in replacements.items()}
+                    | {f':expected_{name}': value for name, value in expected.items()}
+                )
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+        finally:
+            if self._cache is not None:
+                self._cache.invalidate(id)
+
+        return True
+
+    # cheap read that makes boto3 resolve credentials and connect to DynamoDB
+    def ping(self) -> None:
+        self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key={
+                'id': {'S': '-'}
+            },
+            ProjectionExpression='id'
         )
 
-        return self._hydrate(row['Item']) if row is not None and 'Item' in row else None
+    # Lease that lets only one container at a time log in to ComfortClick on behalf
+    # of an account, returns False while a lease of another owner hasn't expired
+    def acquire_auth_lease(self, id: str, owner: str, duration: float) -> bool:
+        now_ms = int(time.time() * 1000)
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.update_item(
+                TableName=self._table_name,
+                Key={
+                    'id': {'S': id}
+                },
+                UpdateExpression='SET auth_lease_owner = :owner, auth_lease_expires_at = :expires_at',
+                # the owner's own lease is accepted, a retry finds the lease it has taken
+                ConditionExpression=(
+                    'attribute_exists(id) AND (attribute_not_exists(auth_lease_expires_at) '
+                    'OR auth_lease_expires_at < :now OR auth_lease_owner = :owner)'
+                ),
+                ExpressionAttributeValues=dynamodb.marshal_item({
+                    ':owner': owner,
+                    ':expires_at': now_ms + int(duration * 1000),
+                    ':now': now_ms
+                })
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def release_auth_lease(self, id: str, owner: str) -> None:
+        try:
+            self._retry_policy.call(lambda: self._dynamodb.update_item(
+                TableName=self._table_name,
+                Key={
+                    'id': {'S': id}
+                },
+                UpdateExpression='REMOVE auth_lease_owner, auth_lease_expires_at',
+                ConditionExpression='auth_lease_owner = :owner',
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner}
+                }
+            ))
+        except self._dynamodb.exceptions.ConditionalCheckFailedException:
+            # the lease has expired and was taken over by someone else
+            pass
+
+    # Returns found accounts by id, missing ones are left out. Accounts that
+    # aren't cached are fetched with BatchGetItem, 100 per request, and their
+    # cookies are decrypted in one go.
+    def find_many(self, ids: Iterable[str]) -> dict[str, model.Account]:
+        accounts: dict[str, model.Account] = {}
+        missing_ids = []
+        for id in dict.fromkeys(ids):
+            account = self._cache.get(id) if self._cache is not None else None
+            if account is None:
+                missing_ids.append(id)
+            else:
+                accounts[id] = account
+
+        items: list[dict[str, Any]] = []
+
+        def batch_get(request_items: Any) -> Any:
+            response = self._retry_policy.call(lambda: self._dynamodb.batch_get_item(RequestItems=request_items))
+            items.extend(dynamodb.unmarshal_item(item) for item in response['Responses'].get(self._table_name, []))
+
+            return response.get('UnprocessedKeys', {})
+
+        for chunk in _chunk(missing_ids, _BATCH_GET_SIZE):
+            _call_until_processed(
+                batch_get,
+                {
+                    self._table_name: {
+                        'Keys': [{'id': {'S': id}} for id in chunk],
+                        'ProjectionExpression': _ACCOUNT_PROJECTION
+                    }
+                }
+            )
+
+        cookies = self._encrypter.decrypt_many([item['cookie'] for item in items])
+        for item, cookie in zip(items, cookies):
+            account = self._hydrate(item, cookie)
+            accounts[str(item['id'])] = account
+            if self._cache is not None:
+                self._cache.put(account)
+
+        return accounts
+
+    # consistent reads bypass the cache, the result is cached nevertheless
+    def find(self, id: str, consistent_read: bool = False) -> Optional[model.Account]:
+        if self._cache is not None and not consistent_read:
+            account = self._cache.get(id)
+            tracing.count('account_cache_hits' if account is not None else 'account_cache_misses')
+            if account is not None:
+                return account
+
+        with tracing.span('dynamodb.get_item'):
+            row = self._retry_policy.call(lambda: self._dynamodb.get_item(
+                TableName=self._table_name,
+                Key={
+                    'id': {'S': id}
+                },
+                ProjectionExpression=_ACCOUNT_PROJECTION,
+                ConsistentRead=consistent_read
+            ))
+
+        account = self._hydrate(dynamodb.unmarshal_item(row['Item'])) if row is not None and 'Item' in row else None
+        if account is not None and self._cache is not None:
+            self._cache.put(account)
+
+        return account
+
+
+def create_dynamodb_retry_policy() -> retry.RetryPolicy:
+    return retry.RetryPolicy(
+        'dynamodb',
+        _classify_dynamodb_error,
+        config.DYNAMODB_MAX_ATTEMPTS,
+        config.RETRY_BASE_DELAY,
+        config.RETRY_MAX_DELAY
+    )
+
+
+_THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+)
+
+
+def _classify_dynamodb_error(e: BaseException) -> Optional[retry.ErrorClass]:
+    from botocore.exceptions import (
+        ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+    )
+
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        if code in _THROTTLING_ERROR_CODES:
+            return retry.ErrorClass.THROTTLED
+        elif code in ('InternalServerError', 'ServiceUnavailable'):
+            return retry.ErrorClass.TRANSIENT
+    elif isinstance(e, (EndpointConnectionError, ConnectTimeoutError)):
+        return retry.ErrorClass.NOT_SENT
+    elif isinstance(e, (ConnectionClosedError, ReadTimeoutError)):
+        return retry.ErrorClass.TRANSIENT
+
+    return None
+
+
+def _chunk(values: Sequence[T], size: int) -> list[Sequence[T]]:
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+# Calls a batch operation until DynamoDB has processed all of the request items,
+# "call" returns the unprocessed part of the request. Retries back off
+# exponentially with full jitter, as DynamoDB leaves items unprocessed when
+# throttling.
+def _call_until_processed(call: Callable[[Any], Any], request_items: Any) -> None:
+    for attempt in range(_BATCH_MAX_ATTEMPTS):
+        request_items = call(request_items)
+        if len(request_items) == 0:
+            return
+
+        time.sleep(random.uniform(0, min(_BATCH_MAX_BACKOFF, _BATCH_BASE_BACKOFF * 2 ** attempt)))
+
+    raise RuntimeError(f'DynamoDB left items unprocessed after {_BATCH_MAX_ATTEMPTS} attempts')
 
 
 def authenticate(credentials: model.CredentialsEnvelope, account_table: AccountTable) -> model.Account:
-    cookie = network.authenticate(credentials)
+    return _save_cookie(credentials, network.authenticate(credentials), account_table)
+
+
+# only the request to ComfortClick is asynchronous, DynamoDB calls still block
+async def authenticate_async(credentials: model.CredentialsEnvelope, account_table: AccountTable) -> model.Account:
+    from ccproxy import async_network
+
+    return _save_cookie(credentials, await async_network.authenticate(credentials), account_table)
+
 
+def _save_cookie(
+    credentials: model.CredentialsEnvelope,
+    cookie: model.Cookie,
+    account_table: AccountTable
+) -> model.Account:
     account = account_table.find_by_host_and_username(
         credentials.host,
         credentials.username
@@ -116,6 +731,190 @@ def authenticate(credentials: model.CredentialsEnvelope, account_table: AccountT
             host=credentials.host
         )
 
-    account.cookie = cookie
+    return _set_cookie(account, cookie, account_table)
+
+
+def _set_cookie(account: model.Account, cookie: model.Cookie, account_table: AccountTable) -> model.Account:
+    _apply_cookie(account, cookie)
+
+    try:
+        return account_table.save(account)
+    except AccountTable.ConflictError:
+        if account.id is None:
+            raise
+
+        # the account has been written elsewhere in the meantime, the cookie that
+        # has just been issued is applied on top of the stored row
+        current = account_table.find(account.id, consistent_read=True)
+        if current is None:
+            raise
+
+        _apply_cookie(current, cookie)
+
+        return account_table.save(current)
+
+
+def _apply_cookie(account: model.Account, cookie: model.Cookie) -> None:
+    account.cookie = cookie.value
+    account.cookie_issued_at = cookie.issued_at
+    account.cookie_expires_at = cookie.expires_at
+
+
+# Re-authentication of an account whose cookie has expired is single-flight:
+# within a process concurrent callers wait on a per-account lock, across
+# containers they wait on a lease in DynamoDB, and all of them reuse the cookie
+# obtained by whoever logged in first.
+_reauth_locks: dict[str, threading.Lock] = {}
+_async_reauth_locks: dict[str, asyncio.Lock] = {}
+_reauth_locks_guard = threading.Lock()
+
+
+# Raised when the invocation is about to time out while another container is
+# still re-authenticating the account
+class ReauthTimeoutError(RuntimeError):
+    pass
+
+
+def reauthenticate(account: model.Account, account_table: AccountTable) -> model.Account:
+    if account.id is None:
+        return authenticate(account, account_table)
+
+    # the instance may be shared via the cache, so the cookie is remembered up front
+    steps = _reauthenticate(account, account.cookie, account_table)
+    with tracing.span('reauth'), _get_reauth_lock(account.id), contextlib.closing(steps):
+        try:
+            request = next(steps)
+            while True:
+                if request is None:
+                    request = steps.send(network.authenticate(account))
+                else:
+                    time.sleep(request)
+                    request = next(steps)
+        except StopIteration as e:
+            refreshed_account: model.Account = e.value
+
+    return refreshed_account
+
+
+# same as reauthenticate(), only the request to ComfortClick and waiting are asynchronous
+async def reauthenticate_async(account: model.Account, account_table: AccountTable) -> model.Account:
+    from ccproxy import async_network
+
+    if account.id is None:
+        return await authenticate_async(account, account_table)
+
+    steps = _reauthenticate(account, account.cookie, account_table)
+    with tracing.span('reauth'), contextlib.closing(steps):
+        async with _get_async_reauth_lock(account.id):
+            try:
+                request = next(steps)
+                while True:
+                    if request is None:
+                        request = steps.send(await async_network.authenticate(account))
+                    else:
+                        await asyncio.sleep(request)
+                        request = next(steps)
+            except StopIteration as e:
+                refreshed_account: model.Account = e.value
+
+    return refreshed_account
+
+
+# Steps of a re-authentication, shared by reauthenticate() and reauthenticate_async()
+# which do the I/O the steps ask for: a number is a delay to sleep for before the
+# next step, None is a login to ComfortClick, answered with the issued cookie.
+# Returns the account with a fresh cookie, either one obtained by someone else
+# in the meantime or the one issued to this login.
+def _reauthenticate(
+    account: model.Account,
+    stale_cookie: Optional[str],
+    account_table: AccountTable
+) -> Generator[Optional[float], Optional[model.Cookie], model.Account]:
+    assert account.id is not None
+
+    current = account_table.find(account.id)
+    if _has_fresh_cookie(current, stale_cookie):
+        assert current is not None
+        return current
+
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + config.AUTH_LEASE_DURATION
+    while not account_table.acquire_auth_lease(account.id, owner, config.AUTH_LEASE_DURATION):
+        # the lease of a container that has died holds out longer than the invocation
+        remaining_time = retry.get_remaining_time()
+        if remaining_time is not None and remaining_time <= config.AUTH_LEASE_POLL_INTERVAL:
+            raise ReauthTimeoutError(f'Timed out waiting for a re-authentication of user "{account.username}"')
+
+        if time.monotonic() >= deadline:
+            logger.warning(f'Gave up waiting for a re-authentication of user "{account.username}"')
+            break
+
+        yield config.AUTH_LEASE_POLL_INTERVAL
+        current = account_table.find(account.id, consistent_read=True)
+        if _has_fresh_cookie(current, stale_cookie):
+            assert current is not None
+            return current
+
+    try:
+        # the lease might have been released just before it was acquired
+        current = account_table.find(account.id, consistent_read=True)
+        if _has_fresh_cookie(current, stale_cookie):
+            assert current is not None
+            return current
+
+        tracing.count('reauth_logins')
+        cookie = yield None
+        assert cookie is not None
+
+        return _set_cookie(account, cookie, account_table)
+    finally:
+        account_table.release_auth_lease(account.id, owner)
+
+
+def _has_fresh_cookie(account: Optional[model.Account], stale_cookie: Optional[str]) -> bool:
+    return account is not None and account.cookie != stale_cookie and not is_cookie_stale(account)
+
+
+def _get_reauth_lock(id: str) -> threading.Lock:
+    with _reauth_locks_guard:
+        return _reauth_locks.setdefault(id, threading.Lock())
+
+
+def _get_async_reauth_lock(id: str) -> asyncio.Lock:
+    # coroutines are run on the event loop of async_network.run(), which lives as
+    # long as the process does, so do the locks
+    with _reauth_locks_guard:
+        return _async_reauth_locks.setdefault(id, asyncio.Lock())
+
+
+def is_cookie_stale(account: model.Account, now: Optional[datetime] = None) -> bool:
+    if account.cookie is None:
+        return True
+
+    now = now or datetime.now(timezone.utc)
+
+    expires_at = account.cookie_expires_at
+    if expires_at is not None and expires_at - now <= timedelta(seconds=config.COOKIE_REFRESH_MARGIN):
+        return True
+
+    # for cookies issued before issue time was recorded the age is unknown
+    issued_at = account.cookie_issued_at
+    if config.COOKIE_MAX_AGE > 0 and issued_at is not None:
+        return now - issued_at >= timedelta(seconds=config.COOKIE_MAX_AGE)
+
+    return False
+
+
+def refresh_stale_cookies(accounts: list[model.Account], account_table: AccountTable) -> int:
+    count = 0
+    for account in accounts:
+        if not is_cookie_stale(account):
+            continue
+
+        try:
+            reauthenticate(account, account_table)
+            count += 1
+        except Exception as e:
+            logger.warning(f'Failed to refresh cookie for user "{account.username}": {str(e)}')
 
-    return account_table.save(account)
+    return count
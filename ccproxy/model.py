@@ -1,13 +1,166 @@
-from pydantic import BaseModel
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, TYPE_CHECKING
+from datetime import datetime
 
+# Plain slotted classes rather than validating models: accounts are built on
+# every request from rows we have written ourselves, so nothing is validated or
+# copied on construction. Data that comes from clients is checked explicitly,
+# see CredentialsEnvelope.parse_obj().
 
-class CredentialsEnvelope(BaseModel):
+_set = object.__setattr__
+
+
+class ValidationError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
+class CredentialsEnvelope:
     username: str
     password: str
     host: str
 
+    @classmethod
+    def parse_obj(cls, data: dict[str, Any]) -> 'CredentialsEnvelope':
+        invalid_fields = [name for name in ('username', 'password', 'host') if not isinstance(data.get(name), str)]
+        if len(invalid_fields) > 0:
+            raise ValidationError(f'Expected strings for the following fields: {", ".join(invalid_fields)}')
+
+        return cls(username=data['username'], password=data['password'], host=data['host'])
+
+
+@dataclass(slots=True)
+class Cookie:
+    value: str
+    issued_at: datetime
+    expires_at: Optional[datetime] = None
 
+
+# A dataclass for dataclasses.fields(), asdict() and replace(), but __init__,
+# __eq__ and __repr__ are written by hand: construction doesn't mark fields dirty
+# and the password is left out of logs
+@dataclass(init=False, eq=False, repr=False)
 class Account(CredentialsEnvelope):
+    __slots__ = (
+        'id', 'cookie', 'cookie_issued_at', 'cookie_expires_at', 'version',
+        '_dirty_fields', '_encrypted_password', '_decrypt'
+    )
+
+    FIELDS = frozenset(('username', 'password', 'host', 'id', 'cookie', 'cookie_issued_at', 'cookie_expires_at', 'version'))
+
     id: Optional[str]
     cookie: Optional[str]
+    cookie_issued_at: Optional[datetime]
+    cookie_expires_at: Optional[datetime]
+    # version of the stored row the account was loaded from, None for accounts
+    # that haven't been stored yet (or rows written before versioning)
+    version: Optional[int]
+
+    # not fields, hence only declared for type checking
+    if TYPE_CHECKING:
+        # fields assigned since the account was loaded or saved
+        _dirty_fields: set[str]
+
+        # for accounts loaded from DB "password" holds no value until it is first
+        # accessed, only then the ciphertext gets decrypted
+        _encrypted_password: Optional[str]
+        _decrypt: Optional[Callable[[str], str]]
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        host: str,
+        id: Optional[str] = None,
+        cookie: Optional[str] = None,
+        cookie_issued_at: Optional[datetime] = None,
+        cookie_expires_at: Optional[datetime] = None,
+        version: Optional[int] = None
+    ) -> None:
+        # assigned around __setattr__, construction doesn't make fields dirty
+        _set(self, 'username', username)
+        _set(self, 'password', password)
+        _set(self, 'host', host)
+        _set(self, 'id', id)
+        _set(self, 'cookie', cookie)
+        _set(self, 'cookie_issued_at', cookie_issued_at)
+        _set(self, 'cookie_expires_at', cookie_expires_at)
+        _set(self, 'version', version)
+        _set(self, '_dirty_fields', set())
+        _set(self, '_encrypted_password', None)
+        _set(self, '_decrypt', None)
+
+    @classmethod
+    def from_encrypted_password(
+        cls,
+        encrypted_password: str,
+        decrypt: Callable[[str], str],
+        **values: Any
+    ) -> 'Account':
+        # trusted construction, only meant for rows that we have written ourselves
+        account = cls.__new__(cls)
+        _set(account, 'id', None)
+        _set(account, 'cookie', None)
+        _set(account, 'cookie_issued_at', None)
+        _set(account, 'cookie_expires_at', None)
+        _set(account, 'version', None)
+        for name, value in values.items():
+            _set(account, name, value)
+        _set(account, '_dirty_fields', set())
+        _set(account, '_encrypted_password', encrypted_password)
+        _set(account, '_decrypt', decrypt)
+
+        return account
+
+    # ciphertext of the current password, None if password has been changed since
+    # the account was loaded
+    @property
+    def encrypted_password(self) -> Optional[str]:
+        return self._encrypted_password
+
+    if not TYPE_CHECKING:
+        def __getattr__(self, name: str) -> Any:
+            if name == 'password' and self._encrypted_password is not None and self._decrypt is not None:
+                password = self._decrypt(self._encrypted_password)
+                _set(self, 'password', password)
+
+                return password
+
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @property
+    def dirty_fields(self) -> frozenset[str]:
+        return frozenset(self._dirty_fields)
+
+    def mark_clean(self) -> None:
+        self._dirty_fields.clear()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == 'password':
+            _set(self, '_encrypted_password', None)
+
+        if name in self.FIELDS:
+            self._dirty_fields.add(name)
+
+        _set(self, name, value)
+
+    # copy, deepcopy and pickle restore slots through here rather than through
+    # __setattr__, which needs _dirty_fields to be there already. Copies track
+    # dirty fields on their own.
+    def __setstate__(self, state: tuple[None, dict[str, Any]]) -> None:
+        for name, value in state[1].items():
+            _set(self, name, value)
+        _set(self, '_dirty_fields', set(self._dirty_fields))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Account):
+            return NotImplemented
+
+        return all(getattr(self, name) == getattr(other, name) for name in self.FIELDS)
+
+    # the password is left out, accounts end up in logs
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}(id={self.id!r}, username={self.username!r}, host={self.host!r}, '
+            f'version={self.version!r})'
+        )
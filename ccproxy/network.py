@@ -1,8 +1,28 @@
+from __future__ import annotations
 from enum import Enum
-from typing import Any
-import requests
-from requests import Response
-from ccproxy import model, config
+from typing import Any, Mapping, Optional, TYPE_CHECKING
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import threading
+from ccproxy import circuit_breaker, config, retry, tracing
+
+if TYPE_CHECKING:
+    import requests
+    from requests import Response
+    from ccproxy import model
+
+DEFAULT_HEADERS = {
+    'X-Requested-With': 'XMLHttpRequest',
+    'Accept-Language': 'en-GB,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Content-Type': 'application/json; charset=utf-8',
+    'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_5_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'
+}
+
+# one pooled session per ComfortClick origin, kept for the life of the process
+# so warm invocations skip TCP and TLS handshakes
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
 
 
 class AuthContractError(RuntimeError):
@@ -17,32 +37,170 @@ class AuthContractError(RuntimeError):
         self.type = type
 
 
-def do_request(url: str, method: str, json: dict[Any, Any] = {}, headers: dict[str, Any] = {}) -> Response:
-    headers = {
-        'X-Requested-With': 'XMLHttpRequest',
-        'Accept-Language': 'en-GB,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Content-Type': 'application/json; charset=utf-8',
-        'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_5_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'
-    } | headers
+def get_session(url: str) -> requests.Session:
+    origin = _get_origin(url)
+
+    session = _sessions.get(origin)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(origin)
+            if session is None:
+                session = _create_session()
+                _sessions[origin] = session
+
+    return session
+
+
+def get_known_origins() -> list[str]:
+    return list(_sessions.keys())
+
+
+# opens (or keeps alive) a pooled connection to a given host, response status
+# doesn't matter. Hosts whose circuit is open are left alone, returns whether
+# the host has been connected to.
+def warm_up_connection(url: str, timeout: float) -> bool:
+    origin = _get_origin(url)
+    if circuit_breaker.get_breaker(origin).state is circuit_breaker.CircuitBreaker.State.OPEN:
+        return False
+
+    get_session(origin).head(origin, timeout=timeout).close()
+
+    return True
+
 
-    response = requests.request(
-        method, url, json=json, headers=headers, verify=False
+def close_sessions() -> None:
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _get_origin(url: str) -> str:
+    parts = urlsplit(url)
+
+    return f'{parts.scheme}://{parts.netloc}'.lower()
+
+
+def _create_session() -> requests.Session:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from http.cookiejar import DefaultCookiePolicy
+
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    if not config.HTTP_KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+    session.verify = False
+    # cookies are managed per account via explicit "Cookie" header, the session
+    # is shared between accounts so it must never remember any of them
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.HTTP_POOL_SIZE
     )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+# Transient failures are retried, see ccproxy.retry, requests that aren't
+# idempotent only when they haven't reached ComfortClick. Raises
+# circuit_breaker.CircuitBreaker.OpenError when the host keeps failing.
+def do_request(
+    url: str,
+    method: str,
+    json: dict[Any, Any] = {},
+    headers: dict[str, Any] = {},
+    idempotent: bool = False
+) -> Response:
+    return _create_retry_policy().call(
+        lambda: _do_request_once(url, method, json, headers),
+        idempotent,
+        _classify_response
+    )
+
+
+def _classify_response(response: Response) -> Optional[retry.ErrorClass]:
+    return retry.classify_status_code(response.status_code)
+
+
+def _do_request_once(url: str, method: str, json: dict[Any, Any], headers: dict[str, Any]) -> Response:
+    import requests
+
+    breaker = circuit_breaker.get_breaker(_get_origin(url))
+    with breaker.attempt((requests.Timeout,), (requests.ConnectionError,)) as attempt, tracing.span('comfortclick.request'):
+        response = get_session(url).request(
+            method,
+            url,
+            json=json,
+            headers=headers,
+            timeout=(config.HTTP_CONNECT_TIMEOUT, attempt.read_timeout)
+        )
+        attempt.status_code = response.status_code
 
     return response
 
 
-def do_authenticated_request(account: model.Account, url: str, method: str, json: dict[str, Any] = {}, headers: dict[str, Any] = {}) -> Response:
-    headers = {
+def _create_retry_policy() -> retry.RetryPolicy:
+    return retry.RetryPolicy(
+        'comfortclick',
+        _classify_error,
+        config.RETRY_MAX_ATTEMPTS,
+        config.RETRY_BASE_DELAY,
+        config.RETRY_MAX_DELAY
+    )
+
+
+def _classify_error(e: BaseException) -> Optional[retry.ErrorClass]:
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    # requests raise a plain ConnectionError when a connection couldn't be opened
+    if isinstance(e, requests.ConnectTimeout) or (
+        isinstance(e, requests.ConnectionError)
+        and len(e.args) > 0
+        and isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+    ):
+        return retry.ErrorClass.NOT_SENT
+    elif isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return retry.ErrorClass.TRANSIENT
+
+    return None
+
+
+def do_authenticated_request(
+    account: model.Account,
+    url: str,
+    method: str,
+    json: dict[str, Any] = {},
+    headers: dict[str, Any] = {},
+    idempotent: bool = False
+) -> Response:
+    return do_request(url, method, json, create_authenticated_headers(account, headers), idempotent)
+
+
+def authenticate(credentials: model.CredentialsEnvelope) -> model.Cookie:
+    issued_at = datetime.now(timezone.utc)
+    with tracing.span('comfortclick.login'):
+        # logging in twice does no harm
+        response = do_request(f'{credentials.host}/Login', 'POST', create_login_payload(credentials), idempotent=True)
+
+    return parse_auth_response(response.json(), response.headers, issued_at)
+
+
+# the helpers below define the ComfortClick contract, they are shared with
+# ccproxy.async_network so both clients behave the same way
+
+def create_authenticated_headers(account: model.Account, headers: dict[str, Any] = {}) -> dict[str, Any]:
+    return {
         'Cookie': f"CurrentPath=; {account.cookie}"
     } | headers
 
-    return do_request(url, method, json, headers)
-
 
-def authenticate(credentials: model.CredentialsEnvelope) -> str:
-    payload = {
+def create_login_payload(credentials: model.CredentialsEnvelope) -> dict[str, Any]:
+    return {
         'UserName': credentials.username,
         'Password': credentials.password,
         'DeviceName': config.DEVICE_NAME,
@@ -51,22 +209,48 @@ def authenticate(credentials: model.CredentialsEnvelope) -> str:
         'RememberMe': False
     }
 
-    response = do_request(f'{credentials.host}/Login', 'POST', payload)
-    _validate_auth_reponse(response)
 
-    raw_cookie = response.headers['Set-Cookie'].split(';')
-    if len(raw_cookie) != 2:
+def parse_auth_response(body: Any, headers: Mapping[str, str], issued_at: datetime) -> model.Cookie:
+    from ccproxy import model
+
+    _validate_auth_reponse(body, headers)
+
+    raw_cookie = headers['Set-Cookie'].split(';')
+    if len(raw_cookie) < 2:
         raise AuthContractError(
             'Wrongly formatted "Set-Cookie" header returned.',
             type=AuthContractError.Types.INVALID_SET_COOKIE_HEADER
         )
-    return raw_cookie[0]
 
+    return model.Cookie(
+        value=raw_cookie[0],
+        issued_at=issued_at,
+        expires_at=_parse_cookie_expiry(raw_cookie[1:], issued_at)
+    )
+
+
+def _parse_cookie_expiry(attributes: list[str], issued_at: datetime) -> Optional[datetime]:
+    from email.utils import parsedate_to_datetime
+
+    expires_at = None
+    for attribute in attributes:
+        name, _, value = attribute.strip().partition('=')
+        name = name.lower()
+        try:
+            if name == 'max-age':
+                # Max-Age takes precedence over Expires
+                return issued_at + timedelta(seconds=int(value))
+            elif name == 'expires':
+                expires_at = parsedate_to_datetime(value)
+                if expires_at.tzinfo is None:
+                    expires_at = expires_at.replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            continue
+
+    return expires_at
 
-def _validate_auth_reponse(response: Response) -> None:
-    body = response.json()
-    headers = response.headers
 
+def _validate_auth_reponse(body: Any, headers: Mapping[str, str]) -> None:
     if 'Status' not in body:
         raise AuthContractError(
             'Server returned invalid response, "Status" field is missing.',
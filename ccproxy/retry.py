@@ -0,0 +1,161 @@
+from __future__ import annotations
+from contextvars import ContextVar
+from enum import Enum
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+import functools
+import logging
+import random
+import time
+from ccproxy import config, tracing
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+F = TypeVar('F', bound=Callable[..., dict[str, Any]])
+
+# Retries of transient failures, shared by the ComfortClick clients and
+# AccountTable. Every client classifies its own errors, the policy decides
+# whether a class of error may be retried for a given call: requests that aren't
+# idempotent (e.g. /SetValue which toggles a device) are only retried when they
+# are known not to have reached the server. Delays grow exponentially with full
+# jitter, capped by RETRY_MAX_DELAY, and no retry is attempted past the
+# deadline of the invocation, see with_lambda_deadline().
+
+
+class ErrorClass(Enum):
+    # the request never reached the server, e.g. connection refused
+    NOT_SENT = 'not_sent'
+    # the server may or may not have processed the request, e.g. a 502 or a connection reset
+    TRANSIENT = 'transient'
+    # the server refused to process the request for now, e.g. DynamoDB throttling
+    THROTTLED = 'throttled'
+
+
+# monotonic time by which the invocation has to be done
+_deadline: ContextVar[Optional[float]] = ContextVar('ccproxy_retry_deadline', default=None)
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        name: str,
+        classify: Callable[[BaseException], Optional[ErrorClass]],
+        max_attempts: int,
+        base_delay: float,
+        max_delay: float,
+        sleep: Callable[[float], None] = time.sleep
+    ) -> None:
+        self._name = name
+        self._classify = classify
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._sleep = sleep
+
+    # classify_result lets results be retried too, e.g. HTTP responses with 502,
+    # the last result is returned as is once retries are exhausted
+    def call(
+        self,
+        fn: Callable[[], T],
+        idempotent: bool = True,
+        classify_result: Optional[Callable[[T], Optional[ErrorClass]]] = None
+    ) -> T:
+        attempt = 1
+        while True:
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._get_delay(attempt, self._classify(e), idempotent)
+                if delay is None:
+                    raise
+                logger.info(f'Retrying {self._name} call in {delay:.3f}s after: {str(e)}')
+            else:
+                if classify_result is None:
+                    return result
+                delay = self._get_delay(attempt, classify_result(result), idempotent)
+                if delay is None:
+                    return result
+                logger.info(f'Retrying {self._name} call in {delay:.3f}s after: {result}')
+
+            self._sleep(delay)
+            attempt += 1
+
+    async def call_async(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        idempotent: bool = True,
+        classify_result: Optional[Callable[[T], Optional[ErrorClass]]] = None
+    ) -> T:
+        # only the async handler needs the event loop, see tests/test_import_time.py
+        import asyncio
+
+        attempt = 1
+        while True:
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._get_delay(attempt, self._classify(e), idempotent)
+                if delay is None:
+                    raise
+                logger.info(f'Retrying {self._name} call in {delay:.3f}s after: {str(e)}')
+            else:
+                if classify_result is None:
+                    return result
+                delay = self._get_delay(attempt, classify_result(result), idempotent)
+                if delay is None:
+                    return result
+                logger.info(f'Retrying {self._name} call in {delay:.3f}s after: {result}')
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # None when the call shouldn't be retried
+    def _get_delay(self, attempt: int, error_class: Optional[ErrorClass], idempotent: bool) -> Optional[float]:
+        if error_class is None or attempt >= self._max_attempts:
+            return None
+        if error_class is ErrorClass.TRANSIENT and not idempotent:
+            return None
+
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** (attempt - 1)))
+
+        remaining_time = get_remaining_time()
+        if remaining_time is not None and remaining_time <= delay:
+            logger.info(f'Not retrying {self._name} call, the invocation is about to time out')
+            return None
+
+        tracing.count(f'{self._name}_retries')
+
+        return delay
+
+
+# Bounds retries by the time the Lambda invocation has left, minus
+# RETRY_DEADLINE_MARGIN seconds to respond. Invocations without a Lambda
+# context (e.g. tests, the CLI) aren't bounded.
+def with_lambda_deadline(handler_fn: F) -> F:
+    @functools.wraps(handler_fn)
+    def wrapped_handler(event: Any, context: Any) -> dict[str, Any]:
+        get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+        if get_remaining_time_in_millis is None:
+            return handler_fn(event, context)
+
+        token = _deadline.set(
+            time.monotonic() + get_remaining_time_in_millis() / 1000 - config.RETRY_DEADLINE_MARGIN
+        )
+        try:
+            return handler_fn(event, context)
+        finally:
+            _deadline.reset(token)
+
+    return wrapped_handler  # type: ignore[return-value]
+
+
+# seconds left until the deadline, None if there is none
+def get_remaining_time() -> Optional[float]:
+    deadline = _deadline.get()
+
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# gateways in front of ComfortClick answer with these while it restarts
+def classify_status_code(status_code: int) -> Optional[ErrorClass]:
+    return ErrorClass.TRANSIENT if status_code in (502, 503, 504) else None
@@ -0,0 +1,245 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qsl, urlsplit
+import base64
+import json
+import logging
+import signal
+import socket
+import threading
+import time
+import uuid
+from ccproxy import config
+
+logger = logging.getLogger(__name__)
+
+# Self-hosted mode: the Lambda handlers served by a long-running HTTP server,
+# e.g. on a box next to the ComfortClick server. Requests are translated into
+# the event shape Lambda function URLs send (payload format 2.0) and responses
+# back, so the handlers run unchanged, and the warm state (clients, config,
+# pooled connections) lives as long as the process. Requests are served by a
+# fixed pool of SERVER_WORKERS threads, connections wait in the listen backlog
+# while all of them are busy. Only the sync handlers are served, the event loop
+# of ccproxy.async_network can't be shared between threads.
+
+Handler = Callable[[dict[str, Any], Any], dict[str, Any]]
+
+_MAX_BODY_SIZE = 64 * 1024
+
+
+# "/" is process_action, so shortcuts only need their host changed
+def get_routes() -> dict[str, Handler]:
+    from ccproxy.handlers.login import login_handler
+    from ccproxy.handlers.process_action import process_action_handler
+
+    return {
+        '/': process_action_handler,
+        '/process_action': process_action_handler,
+        '/login': login_handler,
+    }
+
+
+# Stands in for the Lambda context, with_lambda_deadline() bounds retries by it
+class RequestContext:
+    def __init__(self, timeout: float) -> None:
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def create_event(method: str, target: str, headers: Message, body: bytes, source_ip: str) -> dict[str, Any]:
+    parts = urlsplit(target)
+
+    event: dict[str, Any] = {
+        'version': '2.0',
+        'rawPath': parts.path,
+        'rawQueryString': parts.query,
+        'headers': _join_values((name.lower(), value) for name, value in headers.items()),
+        # omitted by Lambda when there is no query string, the handlers expect it though
+        'queryStringParameters': _join_values(parse_qsl(parts.query, keep_blank_values=True)),
+        'requestContext': {
+            'http': {'method': method, 'path': parts.path, 'sourceIp': source_ip}
+        },
+        'isBase64Encoded': False,
+    }
+
+    if len(body) > 0:
+        try:
+            event['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            event['body'] = base64.b64encode(body).decode('ascii')
+            event['isBase64Encoded'] = True
+
+    return event
+
+
+# Returns status code, headers and body. Like Lambda function URLs do, anything
+# but an object with "statusCode" is sent as JSON, and so are bodies without a
+# content type.
+def create_response(result: Any) -> tuple[int, dict[str, str], bytes]:
+    if not isinstance(result, dict) or 'statusCode' not in result:
+        return 200, {'content-type': 'application/json'}, json.dumps(result).encode('utf-8')
+
+    headers = {name.lower(): str(value) for name, value in result.get('headers', {}).items()}
+    headers.setdefault('content-type', 'application/json')
+
+    body = result.get('body', '')
+    if not isinstance(body, str):
+        body = json.dumps(body)
+
+    data = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode('utf-8')
+
+    return int(result['statusCode']), headers, data
+
+
+# repeated query parameters and headers are joined with commas, like Lambda function URLs do
+def _join_values(pairs: Any) -> dict[str, str]:
+    joined: dict[str, str] = {}
+    for name, value in pairs:
+        joined[name] = f'{joined[name]},{value}' if name in joined else value
+
+    return joined
+
+
+class Server(HTTPServer):
+    # connections that wait for a free worker
+    request_queue_size = 64
+
+    def __init__(self, address: tuple[str, int], routes: dict[str, Handler], workers: int) -> None:
+        super().__init__(address, _RequestHandler)
+        self.routes = routes
+        self.is_stopping = False
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='ccproxy-server')
+        self._free_workers = threading.BoundedSemaphore(workers)
+
+    # Stops accepting connections, serve_forever() returns once it notices. Can be
+    # called from a signal handler that runs on the thread of serve_forever(),
+    # which shutdown() waits for.
+    def stop(self) -> None:
+        self.is_stopping = True
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    # waits for requests in flight
+    def server_close(self) -> None:
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        # blocks the accept loop until a worker is free
+        self._free_workers.acquire()
+        try:
+            self._executor.submit(self._process_request, request, client_address)
+        except RuntimeError:
+            # the executor has been shut down
+            self._free_workers.release()
+            self.shutdown_request(request)
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        logger.exception(f'Failed to handle a request from {client_address}')
+
+    def _process_request(self, request: socket.socket, client_address: Any) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_workers.release()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server: Server
+    protocol_version = 'HTTP/1.1'
+    # sets TCP_NODELAY, headers and body are written separately and the body would
+    # otherwise wait for the client's delayed ACK on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        super().setup()
+        # idle keep-alive connections would hold on to workers otherwise
+        self.connection.settimeout(config.SERVER_KEEP_ALIVE_TIMEOUT)
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.info(f'{self.address_string()} - {format % args}')
+
+    def _handle(self) -> None:
+        handler = self.server.routes.get(urlsplit(self.path).path)
+        if handler is None:
+            self._respond(404, {'content-type': 'text/plain'}, b'Not found')
+            return
+
+        try:
+            content_length = int(self.headers.get('content-length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0 or content_length > _MAX_BODY_SIZE:
+            self.close_connection = True
+            self._respond(413 if content_length > 0 else 400, {'content-type': 'text/plain'}, b'Invalid body')
+            return
+
+        event = create_event(
+            self.command,
+            self.path,
+            self.headers,
+            self.rfile.read(content_length),
+            self.client_address[0]
+        )
+        try:
+            status_code, headers, body = create_response(
+                handler(event, RequestContext(config.SERVER_REQUEST_TIMEOUT))
+            )
+        except Exception as e:
+            # the handlers catch their own exceptions, this is a bug in the translation
+            logger.exception(f'Failed to handle {self.command} {self.path}: {str(e)}')
+            status_code, headers, body = 500, {'content-type': 'text/plain'}, b'Internal server error'
+
+        self._respond(status_code, headers, body)
+
+    def _respond(self, status_code: int, headers: dict[str, str], body: bytes) -> None:
+        if self.server.is_stopping:
+            self.close_connection = True
+
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(body)))
+        if self.close_connection:
+            self.send_header('connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host: str, port: int, workers: int) -> None:
+    from ccproxy import network, warmup
+
+    server = Server((host, port), get_routes(), workers)
+
+    def handle_signal(signum: int, frame: Any) -> None:
+        logger.info(f'Received signal {signum}, finishing requests in flight')
+        server.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # the first requests find clients, config and connections ready, like after a "lambda_tender" ping
+    warmup.warm_up()
+
+    logger.info(f'Listening on http://{host}:{server.server_port} with {workers} workers')
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        network.close_sessions()
+        logger.info('Stopped')
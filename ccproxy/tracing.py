@@ -0,0 +1,135 @@
+from __future__ import annotations
+from contextlib import AbstractContextManager
+from contextvars import ContextVar
+from typing import Any, Callable, Optional, TypeVar
+from ccproxy import config
+import functools
+import json
+import sys
+import threading
+import time
+
+# Request-scoped timings. A handler decorated with @traced() collects how long
+# every stage wrapped in span() took, counters and flags, and prints them as
+# one CloudWatch Embedded Metric Format line once the invocation is over. When
+# TRACING_ENABLED is off no trace is started and span() hands out a shared
+# no-op context manager, so instrumented code pays for a ContextVar lookup only.
+
+# process-wide, the first traced invocation is flagged as a cold start
+_is_cold_start = True
+
+F = TypeVar('F', bound=Callable[..., dict[str, Any]])
+
+_current: ContextVar[Optional[Trace]] = ContextVar('ccproxy_trace', default=None)
+
+
+class Trace:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # stages that run several times (or concurrently) are summed up
+        self.durations: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.properties: dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+
+    def add_duration(self, name: str, duration_ms: float) -> None:
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + duration_ms
+
+    def add_count(self, name: str, value: int) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_emf(self) -> dict[str, Any]:
+        total_ms = (time.perf_counter() - self._started_at) * 1000
+        durations = {name: round(value, 3) for name, value in self.durations.items()} | {'total': round(total_ms, 3)}
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': config.TRACING_NAMESPACE,
+                    'Dimensions': [['handler']],
+                    'Metrics': (
+                        [{'Name': name, 'Unit': 'Milliseconds'} for name in durations]
+                        + [{'Name': name, 'Unit': 'Count'} for name in self.counts]
+                    )
+                }]
+            },
+            'handler': self.name
+        } | durations | self.counts | self.properties
+
+
+class _Span(AbstractContextManager['_Span']):
+    __slots__ = ('_trace', '_name', '_started_at')
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self._trace = trace
+        self._name = name
+        self._started_at = 0.0
+
+    def __enter__(self) -> _Span:
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._trace.add_duration(self._name, (time.perf_counter() - self._started_at) * 1000)
+
+
+class _NoopSpan(AbstractContextManager['_NoopSpan']):
+    def __enter__(self) -> _NoopSpan:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str) -> AbstractContextManager[Any]:
+    trace = _current.get()
+    return _NOOP_SPAN if trace is None else _Span(trace, name)
+
+
+def count(name: str, value: int = 1) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add_count(name, value)
+
+
+# emitted as a property rather than a metric
+def flag(name: str, value: Any) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.properties[name] = value
+
+
+def traced(name: str) -> Callable[[F], F]:
+    def decorator(handler_fn: F) -> F:
+        @functools.wraps(handler_fn)
+        def wrapped_handler(*args: Any, **kwargs: Any) -> dict[str, Any]:
+            if not config.TRACING_ENABLED:
+                return handler_fn(*args, **kwargs)
+
+            global _is_cold_start
+
+            trace = Trace(name)
+            trace.properties['cold_start'] = _is_cold_start
+            _is_cold_start = False
+
+            token = _current.set(trace)
+            try:
+                result = handler_fn(*args, **kwargs)
+                trace.properties['status_code'] = result.get('statusCode')
+
+                return result
+            finally:
+                _current.reset(token)
+                sys.stdout.write(json.dumps(trace.to_emf()) + '\n')
+                sys.stdout.flush()
+
+        return wrapped_handler  # type: ignore[return-value]
+
+    return decorator
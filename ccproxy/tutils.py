@@ -1,4 +1,16 @@
-from ccproxy import config, container
+from __future__ import annotations
+from ccproxy import config, container, main
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb import DynamoDBServiceResource
+
+
+# the proxy only uses the low-level client, the resource is handy to inspect tables in tests
+def create_dynamodb_resource() -> DynamoDBServiceResource:
+    import boto3
+
+    return boto3.resource('dynamodb', endpoint_url=None if config.DYNAMODB_HOST == '' else config.DYNAMODB_HOST)
 
 
 def create_accounts_table_if_not_exists() -> bool:
@@ -23,12 +35,28 @@ def create_accounts_table_if_not_exists() -> bool:
                 {
                     'AttributeName': 'host',
                     'AttributeType': 'S',
+                },
+                {
+                    'AttributeName': 'host_username',
+                    'AttributeType': 'S',
                 }
             ],
             BillingMode='PAY_PER_REQUEST',
             GlobalSecondaryIndexes=[
                 {
-                    'IndexName': 'HostAndUsernameIndex',
+                    'IndexName': main.HOST_USERNAME_INDEX,
+                    'KeySchema': [
+                        {
+                            'AttributeName': 'host_username',
+                            'KeyType': 'HASH',
+                        }
+                    ],
+                    "Projection": {
+                        "ProjectionType": "ALL"
+                    },
+                },
+                {
+                    'IndexName': main.LEGACY_HOST_INDEX,
                     'KeySchema': [
                         {
                             'AttributeName': 'host',
@@ -0,0 +1,87 @@
+from ccproxy import config, container, main, network, retry
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Runs on "lambda_tender" pings, so the first real request after the ping finds
+# clients constructed, config parsed and connections to ComfortClick open.
+# Returns how long every step took, in milliseconds.
+def warm_up() -> dict[str, float]:
+    timings: dict[str, float] = {}
+
+    _run_step('account_table', timings, _warm_up_account_table)
+    _run_step('config', timings, lambda: container.get_config_loader().load())
+    _run_step('connections', timings, _warm_up_connections)
+    if config.WARMUP_CHECK_COOKIES:
+        _run_step('cookies', timings, _refresh_cookies)
+
+    logger.info(f'Warm-up finished: {timings}')
+
+    return timings
+
+
+def _run_step(name: str, timings: dict[str, float], step: Callable[[], Any]) -> None:
+    started_at = time.perf_counter()
+    try:
+        step()
+    except Exception as e:
+        logger.warning(f'Warm-up step "{name}" failed: {str(e)}')
+    finally:
+        timings[name] = round((time.perf_counter() - started_at) * 1000, 3)
+
+
+def _warm_up_account_table() -> None:
+    # resolves credentials and opens a connection to DynamoDB as well
+    container.get_account_table().ping()
+
+
+def _get_known_hosts() -> set[str]:
+    hosts = set(network.get_known_origins())
+    hosts.update(account.host for account in container.get_account_cache().accounts())
+    hosts.update(host.strip() for host in config.WARMUP_HOSTS.split(',') if host.strip() != '')
+
+    return hosts
+
+
+# Hosts are connected to concurrently, a host that doesn't answer holds up the
+# step for WARMUP_TIMEOUT at most. Within a Lambda invocation no request runs
+# past its deadline, hosts that are left over are warmed up by the next ping.
+def _warm_up_connections() -> None:
+    hosts = _get_known_hosts()
+    if len(hosts) == 0:
+        return
+
+    # the deadline is read here, worker threads don't see it, see ccproxy.retry
+    remaining_time = retry.get_remaining_time()
+    deadline = None if remaining_time is None else time.monotonic() + remaining_time
+    with ThreadPoolExecutor(max_workers=min(len(hosts), config.HTTP_POOL_SIZE)) as executor:
+        futures = {host: executor.submit(_warm_up_connection, host, deadline) for host in hosts}
+
+    for host, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning(f'Failed to warm up connection to "{host}": {str(e)}')
+
+
+def _warm_up_connection(host: str, deadline: Optional[float]) -> None:
+    timeout = config.WARMUP_TIMEOUT
+    if deadline is not None:
+        # connecting and responding may take the timeout each
+        timeout = min(timeout, (deadline - time.monotonic()) / 2)
+
+    if timeout <= 0:
+        logger.info(f'Not warming up connection to "{host}", the invocation is about to time out')
+    elif not network.warm_up_connection(host, timeout):
+        logger.info(f'Not warming up connection to "{host}", its circuit is open')
+
+
+def _refresh_cookies() -> None:
+    main.refresh_stale_cookies(
+        container.get_account_cache().accounts(),
+        container.get_account_table()
+    )
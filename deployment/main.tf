@@ -3,6 +3,15 @@ module "deployment" {
 
   layer_zip_path   = "${path.module}/artifacts/layer.zip"   # use "bin/build-layers.sh"
   package_zip_path = "${path.module}/artifacts/package.zip" # use "bin/build-package.sh"
+
+  # process_action_async = true
+
+  # settings = {
+  #   COOKIE_MAX_AGE           = "43200"
+  #   WARMUP_HOSTS             = "https://192.168.1.123:8443"
+  #   AUTH_LEASE_DURATION      = "9.5"
+  #   AUTH_LEASE_POLL_INTERVAL = "0.25"
+  # }
 }
 
 module "lambda_tender" {
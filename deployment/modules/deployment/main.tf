@@ -1,4 +1,6 @@
 locals {
+  host_username_gsi = "HostUsernameIndex"
+  # TODO remove once "make backfill-host-username-key" has been run against the table
   host_and_username_gsi = "HostAndUsernameIndex"
 }
 
@@ -17,6 +19,16 @@ resource "aws_dynamodb_table" "auth" {
     name = "host"
     type = "S"
   }
+  attribute {
+    name = "host_username"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = local.host_username_gsi
+    hash_key        = "host_username"
+    projection_type = "ALL"
+  }
 
   global_secondary_index {
     name            = local.host_and_username_gsi
@@ -25,10 +37,48 @@ resource "aws_dynamodb_table" "auth" {
   }
 }
 
+# circuit breakers opened by one Lambda container are picked up by the others,
+# see CIRCUIT_BREAKER_TABLE
+resource "aws_dynamodb_table" "circuits" {
+  name         = "${var.aws_resource_prefix}circuits"
+  hash_key     = "host"
+  billing_mode = "PAY_PER_REQUEST"
+
+  attribute {
+    name = "host"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+# responses of process_action remembered by idempotency key, see IDEMPOTENCY_TABLE
+resource "aws_dynamodb_table" "idempotency" {
+  name         = "${var.aws_resource_prefix}idempotency"
+  hash_key     = "id"
+  billing_mode = "PAY_PER_REQUEST"
+
+  attribute {
+    name = "id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
 resource "aws_iam_policy" "lambda" {
   name_prefix = "${var.aws_resource_prefix}lambda-"
   policy = templatefile("${path.module}/templates/lambda_policy.tpl", {
     table_arn             = aws_dynamodb_table.auth.arn
+    circuits_table_arn    = aws_dynamodb_table.circuits.arn
+    idempotency_table_arn = aws_dynamodb_table.idempotency.arn
+    host_username_gsi     = local.host_username_gsi
     host_and_username_gsi = local.host_and_username_gsi
   })
 }
@@ -53,7 +103,7 @@ resource "aws_lambda_layer_version" "this" {
 
 resource "aws_lambda_function" "process_action" {
   function_name = "${var.aws_resource_prefix}main"
-  handler       = "ccproxy.handlers.process_action.process_action_handler"
+  handler       = var.process_action_async ? "ccproxy.handlers.process_action.process_action_async_handler" : "ccproxy.handlers.process_action.process_action_handler"
   role          = aws_iam_role.lambda.arn
   runtime       = "python3.10"
   memory_size   = 256
@@ -66,9 +116,11 @@ resource "aws_lambda_function" "process_action" {
   layers = [aws_lambda_layer_version.this.arn]
 
   environment {
-    variables = {
-      ACCOUNTS_TABLE = aws_dynamodb_table.auth.name
-    }
+    variables = merge(var.settings, {
+      ACCOUNTS_TABLE        = aws_dynamodb_table.auth.name
+      CIRCUIT_BREAKER_TABLE = aws_dynamodb_table.circuits.name
+      IDEMPOTENCY_TABLE     = aws_dynamodb_table.idempotency.name
+    })
   }
 }
 
@@ -92,9 +144,10 @@ resource "aws_lambda_function" "login" {
   layers = [aws_lambda_layer_version.this.arn]
 
   environment {
-    variables = {
-      ACCOUNTS_TABLE = aws_dynamodb_table.auth.name
-    }
+    variables = merge(var.settings, {
+      ACCOUNTS_TABLE        = aws_dynamodb_table.auth.name
+      CIRCUIT_BREAKER_TABLE = aws_dynamodb_table.circuits.name
+    })
   }
 }
 
@@ -7,16 +7,33 @@
         "dynamodb:GetItem",
         "dynamodb:Query",
         "dynamodb:PutItem",
-        "dynamodb:UpdateItem"
+        "dynamodb:UpdateItem",
+        "dynamodb:BatchGetItem",
+        "dynamodb:BatchWriteItem"
       ],
       "Resource": "${table_arn}"
     },
+    {
+      "Effect": "Allow",
+      "Action": [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+        "dynamodb:DeleteItem"
+      ],
+      "Resource": [
+        "${circuits_table_arn}",
+        "${idempotency_table_arn}"
+      ]
+    },
     {
       "Effect": "Allow",
       "Action": [
         "dynamodb:Query"
       ],
-      "Resource": "${table_arn}/index/${host_and_username_gsi}"
+      "Resource": [
+        "${table_arn}/index/${host_username_gsi}",
+        "${table_arn}/index/${host_and_username_gsi}"
+      ]
     },
     {
       "Effect": "Allow",
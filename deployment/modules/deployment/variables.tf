@@ -9,3 +9,17 @@ variable "layer_zip_path" {
 variable "package_zip_path" {
   type = string
 }
+
+# serves process_action with process_action_async_handler, which sends requests
+# to ComfortClick with httpx rather than requests
+variable "process_action_async" {
+  type    = bool
+  default = false
+}
+
+# extra environment variables of the functions, they take precedence over .env.prod,
+# see .env.dist and ccproxy/config.py, e.g. { COOKIE_MAX_AGE = "43200" }
+variable "settings" {
+  type    = map(string)
+  default = {}
+}
@@ -3,6 +3,7 @@ import pytest
 from ccproxy.handlers.login import login_handler
 from ccproxy.handlers import utils as handler_utils
 from ccproxy import model, network, main
+from ccproxy.circuit_breaker import CircuitBreaker
 from unittest.mock import patch, Mock
 import json
 
@@ -70,3 +71,14 @@ class TestLogin:
         logger.warning.assert_called_once_with(
             'Login error for user "un": Boom'
         )
+
+    @patch('ccproxy.main.authenticate')
+    def test_circuit_open(self, mock_authenticate: Mock) -> None:
+        mock_authenticate.side_effect = CircuitBreaker.OpenError('Boom', host='https://hst', retry_after=30)
+
+        payload = {'username': 'un', 'password': 'pwd', 'host': 'hst'}
+
+        result = login_handler({'body': json.dumps(payload)}, {})
+
+        assert result['statusCode'] == 503
+        assert result['headers'] == {'Retry-After': '30'}
@@ -1,14 +1,28 @@
 from typing import Any
 from unittest import mock
 import pytest
-from ccproxy.handlers.process_action import process_action_handler, do_api_call
+from ccproxy.handlers.process_action import (
+    process_action_handler,
+    process_action_async_handler,
+    do_api_call,
+    do_api_call_async,
+    do_batch_api_call
+)
 from ccproxy.handlers import utils as handler_utils
-from unittest.mock import patch, Mock
-from ccproxy import config, api
+from unittest.mock import AsyncMock, patch, Mock
+from ccproxy import async_network, config, api, container, idempotency
+from ccproxy.circuit_breaker import CircuitBreaker
 from requests.exceptions import HTTPError
+from datetime import datetime, timezone
+import httpx
+import json
 
 
 class TestProcessAction:
+    def setup_method(self) -> None:
+        # keys claimed by one test would be replayed in the next one otherwise
+        container.override('idempotency_store', idempotency.InMemoryIdempotencyStore(config.IDEMPOTENCY_CACHE_SIZE))
+
     def test_no_action_query_param_specified(self) -> None:
         result = process_action_handler(
             {'queryStringParameters': {}, 'headers': {}},
@@ -21,15 +35,15 @@ class TestProcessAction:
         assert '_errorType' in result
         assert result['_errorType'] == 'action_not_specified'
 
-    @patch('ccproxy.container.create_account_table')
+    @patch('ccproxy.container.get_account_table')
     @patch('ccproxy.handlers.process_action.do_api_call')
-    def test_unknown_action_given(self, mock_do_api_call: Mock, mock_create_account_table: Mock) -> None:
+    def test_unknown_action_given(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
         account_table = Mock()
         account_table.find.return_value = {}
 
         mock_do_api_call.side_effect = api.RemoteDeviceController.UnknownActionError()
 
-        mock_create_account_table.return_value = account_table
+        mock_get_account_table.return_value = account_table
 
         result = process_action_handler(
             {
@@ -50,12 +64,12 @@ class TestProcessAction:
         assert result['_errorType'] == 'unknown_action'
         assert result['body'] == 'Unkown action "something1234567" given.'
 
-    @patch('ccproxy.container.create_account_table')
-    def test_not_found(self, mock_create_account_table: Mock) -> Any:
+    @patch('ccproxy.container.get_account_table')
+    def test_not_found(self, mock_get_account_table: Mock) -> Any:
         account_table = Mock()
         account_table.find.return_value = None
 
-        mock_create_account_table.return_value = account_table
+        mock_get_account_table.return_value = account_table
 
         account_id = '12345678910111223141516'
 
@@ -74,16 +88,16 @@ class TestProcessAction:
         assert result['statusCode'] == 400
         assert result['body'] == f'Unable to find account "{account_id[:config.ACCOUNT_ID_LENGTH]}".'
 
-    @patch('ccproxy.container.create_account_table')
+    @patch('ccproxy.container.get_account_table')
     @patch('ccproxy.handlers.process_action.do_api_call')
-    def test_happy_path(self, mock_do_api_call: Mock, mock_create_account_table: Mock) -> None:
+    def test_happy_path(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
         account_id = '1234'
         account: dict[Any, Any] = {}
 
         account_table = Mock(name='account_table')
         account_table.find.return_value = account
 
-        mock_create_account_table.return_value = account_table
+        mock_get_account_table.return_value = account_table
 
         mock_do_api_call.return_value = 'some_fancy_action_returned_message'
 
@@ -141,11 +155,13 @@ class TestProcessAction:
 
         account = Mock()
         account.username = 'foousername'
+        account.cookie_issued_at = None
+        account.cookie_expires_at = None
         account_table: dict[Any, Any] = {}
 
         with (
             mock.patch(
-                'ccproxy.main.authenticate',
+                'ccproxy.main.reauthenticate',
                 new=authenticate_mock),
             mock.patch(
                 'ccproxy.container.create_remote_device_controller',
@@ -168,6 +184,442 @@ class TestProcessAction:
             authenticate_mock.assert_called_once_with(account, account_table)
             assert result == 'toggle-result'
 
+    def test_stale_cookie_is_refreshed_before_request(self) -> None:
+        account = Mock()
+        account.username = 'foousername'
+        account.cookie_issued_at = None
+        account.cookie_expires_at = datetime.now(timezone.utc)
+        refreshed_account = Mock()
+
+        response_mock = Mock()
+        response_mock.status_code = 401
+
+        device_controller_mock = Mock()
+        device_controller_mock.toggle.side_effect = HTTPError(response=response_mock)
+
+        account_table = Mock()
+
+        with (
+            mock.patch('ccproxy.main.reauthenticate') as authenticate_mock,
+            mock.patch(
+                'ccproxy.container.create_remote_device_controller'
+            ) as create_remote_device_controller_mock
+        ):
+            authenticate_mock.return_value = refreshed_account
+            create_remote_device_controller_mock.return_value = device_controller_mock
+
+            with pytest.raises(HTTPError):
+                do_api_call(account, account_table, 'open_garage_door')
+
+            # 401 right after the refresh is not retried
+            authenticate_mock.assert_called_once_with(account, account_table)
+            create_remote_device_controller_mock.assert_called_once_with(refreshed_account)
+
+    @pytest.mark.parametrize(
+        'query, expected_actions',
+        [
+            ({'action': 'close_garage,lock_door'}, ['close_garage', 'lock_door']),
+            ({'action': 'close_garage, lock_door,,close_garage'}, ['close_garage', 'lock_door']),
+            ({'scene': 'leaving_home'}, ['close_garage', 'lock_door']),
+            ({'scene': 'leaving_home', 'action': 'turn_ventilation_off'}, ['close_garage', 'lock_door', 'turn_ventilation_off']),
+        ]
+    )
+    @patch('ccproxy.container.create_remote_device_controller')
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_batch_api_call')
+    def test_batch(
+        self,
+        mock_do_batch_api_call: Mock,
+        mock_get_account_table: Mock,
+        mock_create_remote_device_controller: Mock,
+        query: dict[str, str],
+        expected_actions: list[str]
+    ) -> None:
+        account = Mock()
+        mock_get_account_table.return_value.find.return_value = account
+        device_controller = mock_create_remote_device_controller.return_value
+        device_controller.get_scene_actions.return_value = ['close_garage', 'lock_door']
+        device_controller.get_scene_message.return_value = None
+        mock_do_batch_api_call.side_effect = lambda account, account_table, actions: {
+            action: f'{action} done' for action in actions
+        }
+
+        result = process_action_handler(
+            {'queryStringParameters': query, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 200
+        mock_do_batch_api_call.assert_called_once_with(
+            account, mock_get_account_table.return_value, expected_actions
+        )
+        body = json.loads(result['body'])
+        assert body['message'] == ' '.join(f'{action} done' for action in expected_actions)
+        assert body['results'] == {
+            action: {'ok': True, 'message': f'{action} done'} for action in expected_actions
+        }
+
+    @pytest.mark.parametrize(
+        'failing_actions, expected_status_code',
+        [
+            (['lock_door'], 207),
+            (['close_garage', 'lock_door'], 502),
+        ]
+    )
+    @patch('ccproxy.container.create_remote_device_controller')
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_batch_api_call')
+    def test_batch_failures(
+        self,
+        mock_do_batch_api_call: Mock,
+        mock_get_account_table: Mock,
+        mock_create_remote_device_controller: Mock,
+        failing_actions: list[str],
+        expected_status_code: int
+    ) -> None:
+        response_mock = Mock()
+        response_mock.status_code = 500
+        device_controller = mock_create_remote_device_controller.return_value
+        device_controller.get_scene_actions.return_value = ['close_garage', 'lock_door']
+        device_controller.get_scene_message.return_value = 'Bye'
+        mock_do_batch_api_call.return_value = {
+            action: HTTPError(response=response_mock) if action in failing_actions else 'done'
+            for action in ['close_garage', 'lock_door']
+        }
+
+        result = process_action_handler(
+            {'queryStringParameters': {'scene': 'leaving_home'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == expected_status_code
+        body = json.loads(result['body'])
+        assert body['message'] == 'Bye'
+        for action in failing_actions:
+            assert body['results'][action] == {'ok': False, 'error': 'ComfortClick responded with 500'}
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call')
+    def test_circuit_open(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_api_call.side_effect = CircuitBreaker.OpenError(
+            'Boom', host='https://192.168.1.123:8443', retry_after=12.3
+        )
+
+        result = process_action_handler(
+            {'queryStringParameters': {'action': 'close_garage'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 503
+        assert result['headers'] == {'Retry-After': '13'}
+        assert result['_errorType'] == 'comfortclick_unavailable'
+        assert result['body'] == 'ComfortClick is not responding, try again in 13 seconds.'
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_batch_api_call')
+    def test_batch_circuit_open(self, mock_do_batch_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_batch_api_call.return_value = {
+            'close_garage': 'done',
+            'lock_door': CircuitBreaker.OpenError('Boom', host='https://192.168.1.123:8443', retry_after=1)
+        }
+
+        result = process_action_handler(
+            {'queryStringParameters': {'action': 'close_garage,lock_door'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 207
+        body = json.loads(result['body'])
+        assert body['results']['lock_door'] == {'ok': False, 'error': 'ComfortClick is not responding'}
+
+        # e.g. when re-authentication has been refused
+        mock_do_batch_api_call.return_value = None
+        mock_do_batch_api_call.side_effect = CircuitBreaker.OpenError(
+            'Boom', host='https://192.168.1.123:8443', retry_after=0.2
+        )
+
+        result = process_action_handler(
+            {
+                'queryStringParameters': {'action': 'close_garage,lock_door'},
+                'headers': {'x-ccproxy-account': '1234', 'idempotency-key': 'foo'}
+            },
+            {}
+        )
+
+        assert result['statusCode'] == 503
+        assert result['headers'] == {'Retry-After': '1'}
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_batch_api_call')
+    def test_batch_unknown_action(self, mock_do_batch_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_batch_api_call.side_effect = api.RemoteDeviceController.UnknownActionError('open_sesame')
+
+        result = process_action_handler(
+            {'queryStringParameters': {'action': 'close_garage,open_sesame'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 400
+        assert result['_errorType'] == 'unknown_action'
+        assert result['body'] == 'Unkown action "open_sesame" given.'
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_read_api_call')
+    def test_read(self, mock_do_read_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_read_api_call.return_value = {
+            'garage_door': True,
+            'front_door': HTTPError(response=Mock(status_code=500))
+        }
+
+        result = process_action_handler(
+            {
+                'queryStringParameters': {'read': 'garage_door, front_door,garage_door'},
+                'headers': {'x-ccproxy-account': '1234'}
+            },
+            {}
+        )
+
+        assert result['statusCode'] == 207
+        assert json.loads(result['body']) == {
+            'results': {
+                'garage_door': {'ok': True, 'value': True},
+                'front_door': {'ok': False, 'error': 'ComfortClick responded with 500'}
+            }
+        }
+        assert mock_do_read_api_call.call_args.args[2] == ['garage_door', 'front_door']
+
+        # reads aren't deduplicated
+        process_action_handler(
+            {'queryStringParameters': {'read': 'garage_door,front_door'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+        assert mock_do_read_api_call.call_count == 2
+
+        mock_do_read_api_call.side_effect = api.RemoteDeviceController.UnknownActionError('open_sesame')
+        result = process_action_handler(
+            {'queryStringParameters': {'read': 'open_sesame'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+        assert result['statusCode'] == 400
+        assert result['_errorType'] == 'unknown_action'
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_read_api_call_async', new_callable=AsyncMock)
+    def test_read_async(self, mock_do_read_api_call_async: AsyncMock, mock_get_account_table: Mock) -> None:
+        mock_do_read_api_call_async.return_value = {'garage_door': 'Open'}
+
+        result = process_action_async_handler(
+            {'queryStringParameters': {'read': 'garage_door'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 200
+        assert json.loads(result['body']) == {'results': {'garage_door': {'ok': True, 'value': 'Open'}}}
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call')
+    def test_idempotency_key(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_api_call.return_value = 'Opened'
+
+        def process(action: str, key: str) -> dict[str, Any]:
+            result: dict[str, Any] = process_action_handler(
+                {
+                    'queryStringParameters': {'action': action},
+                    'headers': {'x-ccproxy-account': '1234', 'idempotency-key': key}
+                },
+                {}
+            )
+
+            return result
+
+        assert process('open_garage', 'foo')['body'] == 'Opened'
+
+        result = process('open_garage', 'foo')
+        assert result['statusCode'] == 200
+        assert result['body'] == 'Opened'
+        assert result['headers'] == {'x-ccproxy-idempotent-replay': 'true'}
+        assert mock_do_api_call.call_count == 1
+
+        result = process('close_garage', 'foo')
+        assert result['statusCode'] == 422
+        assert result['_errorType'] == 'idempotency_key_reused'
+
+        # failed requests can be retried with the same key
+        mock_do_api_call.side_effect = HTTPError(response=Mock(status_code=500))
+        assert process('close_garage', 'bar')['statusCode'] != 200
+        mock_do_api_call.side_effect = None
+        assert 'headers' not in process('close_garage', 'bar')
+        assert mock_do_api_call.call_count == 3
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call')
+    def test_request_in_progress(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
+        container.get_idempotency_store().claim(
+            '1234#key#foo', json.dumps({'action': 'open_garage', 'scene': None}), 15
+        )
+
+        result = process_action_handler(
+            {
+                'queryStringParameters': {'action': 'open_garage'},
+                'headers': {'x-ccproxy-account': '1234', 'idempotency-key': 'foo'}
+            },
+            {}
+        )
+
+        assert result['statusCode'] == 409
+        assert result['headers'] == {'Retry-After': '1'}
+        assert result['_errorType'] == 'request_in_progress'
+        mock_do_api_call.assert_not_called()
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call')
+    def test_duplicates_within_window(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_api_call.return_value = 'Opened'
+        event = {'queryStringParameters': {'action': 'open_garage'}, 'headers': {'x-ccproxy-account': '1234'}}
+
+        # off by default, toggling twice on purpose toggles twice
+        assert 'headers' not in process_action_handler(event, {})
+        assert 'headers' not in process_action_handler(event, {})
+        assert mock_do_api_call.call_count == 2
+
+        with patch('ccproxy.config.IDEMPOTENCY_WINDOW', 5.0):
+            process_action_handler(event, {})
+            assert process_action_handler(event, {})['headers'] == {'x-ccproxy-idempotent-replay': 'true'}
+        assert mock_do_api_call.call_count == 3
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call')
+    def test_idempotency_store_unavailable(self, mock_do_api_call: Mock, mock_get_account_table: Mock) -> None:
+        mock_do_api_call.return_value = 'Opened'
+        store = Mock()
+        store.claim.side_effect = RuntimeError('Boom')
+        container.override('idempotency_store', store)
+
+        result = process_action_handler(
+            {'queryStringParameters': {'action': 'open_garage'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result['statusCode'] == 200
+        assert result['body'] == 'Opened'
+
+    def test_batch_reauth(self) -> None:
+        account = Mock()
+        account.username = 'foousername'
+        account.cookie_issued_at = None
+        account.cookie_expires_at = None
+        refreshed_account = Mock()
+        account_table = Mock()
+
+        unauthorized_response = Mock()
+        unauthorized_response.status_code = 401
+        failing_response = Mock()
+        failing_response.status_code = 500
+
+        expired_error = HTTPError(response=unauthorized_response)
+        failed_error = HTTPError(response=failing_response)
+
+        device_controller = Mock()
+        device_controller.toggle_many.side_effect = [
+            {'close_garage': 'done', 'lock_door': expired_error, 'turn_ventilation_off': failed_error},
+            {'lock_door': 'done after reauth'}
+        ]
+
+        with (
+            mock.patch('ccproxy.main.reauthenticate') as authenticate_mock,
+            mock.patch(
+                'ccproxy.container.create_remote_device_controller'
+            ) as create_remote_device_controller_mock
+        ):
+            authenticate_mock.return_value = refreshed_account
+            create_remote_device_controller_mock.return_value = device_controller
+
+            results = do_batch_api_call(
+                account, account_table, ['close_garage', 'lock_door', 'turn_ventilation_off']
+            )
+
+            authenticate_mock.assert_called_once_with(account, account_table)
+            assert device_controller.toggle_many.call_args_list[1][0] == (['lock_door'],)
+            create_remote_device_controller_mock.assert_called_with(refreshed_account)
+            assert results == {
+                'close_garage': 'done',
+                'lock_door': 'done after reauth',
+                'turn_ventilation_off': failed_error
+            }
+
+    @patch('ccproxy.container.get_account_table')
+    @patch('ccproxy.handlers.process_action.do_api_call_async', new_callable=AsyncMock)
+    @patch('ccproxy.handlers.process_action.do_batch_api_call_async', new_callable=AsyncMock)
+    def test_async_handler(
+        self,
+        mock_do_batch_api_call_async: AsyncMock,
+        mock_do_api_call_async: AsyncMock,
+        mock_get_account_table: Mock
+    ) -> None:
+        account = Mock()
+        account_table = mock_get_account_table.return_value
+        account_table.find.return_value = account
+        mock_do_api_call_async.return_value = 'Roger that'
+        mock_do_batch_api_call_async.return_value = {'close_garage': 'done', 'lock_door': 'done too'}
+
+        result = process_action_async_handler(
+            {'queryStringParameters': {'action': 'close_garage'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+        batch_result = process_action_async_handler(
+            {'queryStringParameters': {'action': 'close_garage,lock_door'}, 'headers': {'x-ccproxy-account': '1234'}},
+            {}
+        )
+
+        assert result == {'statusCode': 200, 'body': 'Roger that'}
+        mock_do_api_call_async.assert_awaited_once_with(account, account_table, 'close_garage')
+        assert batch_result['statusCode'] == 200
+        assert json.loads(batch_result['body'])['message'] == 'done done too'
+        mock_do_batch_api_call_async.assert_awaited_once_with(account, account_table, ['close_garage', 'lock_door'])
+        assert handler_utils.exception_handler.__name__ in process_action_async_handler.decorators
+
+    def test_async_reauth(self) -> None:
+        account = Mock()
+        account.username = 'foousername'
+        account.cookie_issued_at = None
+        account.cookie_expires_at = None
+        refreshed_account = Mock()
+        account_table = Mock()
+
+        request = httpx.Request('POST', 'https://example.org/SetValue')
+        expired_error = httpx.HTTPStatusError(
+            'Unauthorized', request=request, response=httpx.Response(401, request=request)
+        )
+
+        device_controller = Mock()
+        device_controller.toggle_async = AsyncMock(side_effect=[expired_error, 'toggle-result'])
+
+        with (
+            mock.patch('ccproxy.main.reauthenticate_async', new_callable=AsyncMock) as authenticate_mock,
+            mock.patch(
+                'ccproxy.container.create_remote_device_controller'
+            ) as create_remote_device_controller_mock
+        ):
+            authenticate_mock.return_value = refreshed_account
+            create_remote_device_controller_mock.return_value = device_controller
+
+            result = async_network.run(do_api_call_async(account, account_table, 'open_garage_door'))
+
+            authenticate_mock.assert_awaited_once_with(account, account_table)
+            create_remote_device_controller_mock.assert_called_with(refreshed_account)
+            assert device_controller.toggle_async.await_count == 2
+            assert result == 'toggle-result'
+
+    @patch('ccproxy.warmup.warm_up')
+    def test_lambda_tender(self, mock_warm_up: Mock) -> None:
+        mock_warm_up.return_value = {'config': 0.1}
+
+        result = process_action_handler({'lambda_tender': True}, {})
+
+        assert result['statusCode'] == 418
+        assert result['_timings'] == {'config': 0.1}
+        mock_warm_up.assert_called_once()
+
     def test_generic_exception_thrown(self) -> None:
         assert hasattr(process_action_handler, 'decorators') is True
         assert handler_utils.exception_handler.__name__ in process_action_handler.decorators
@@ -1,6 +1,11 @@
-from unittest.mock import Mock, patch
-from ccproxy import api
+from unittest.mock import AsyncMock, Mock, patch
+from ccproxy import api, async_network
 from typing import Any
+from pathlib import Path
+from requests import HTTPError
+import json
+import os
+import pytest
 
 
 class TestRemoteDeviceController:
@@ -101,7 +106,8 @@ class TestRemoteDeviceController:
                 'objectName': 'bla_action_path',
                 'valueName': 'Value',
                 'value': 'true'
-            }
+            },
+            idempotent=False
         )
         response_mock.raise_for_status.assert_called_once()
         assert message in config['messages']['bla_action']
@@ -122,3 +128,327 @@ class TestRemoteDeviceController:
 
         actions = dc.get_supported_actions()
         assert actions == ('bla_action', 'bar_action',)
+
+
+class TestScenes:
+    config: dict[str, Any] = {
+        "messages": {
+            "close_garage": ["Closing garage"],
+            "lock_door": ["Locking door"],
+            "leaving_home": ["Bye"]
+        },
+        "actions": {
+            "close_garage": "close_garage_path",
+            "lock_door": "lock_door_path"
+        },
+        "scenes": {
+            "leaving_home": ["close_garage", "lock_door"],
+            "quiet_leaving": ["lock_door"]
+        }
+    }
+
+    @pytest.mark.parametrize(
+        'scenes, expected_error',
+        [
+            (
+                {'foo_scene': [], 'bar_scene': []},
+                'Actions are not provided for the following scenes: foo_scene, bar_scene'
+            ),
+            (
+                {'foo_scene': ['foo_action', 'missing_action'], 'bar_scene': ['missing_action']},
+                'Scenes refer to the following unknown actions: missing_action'
+            ),
+        ]
+    )
+    def test_config_validation(self, scenes: dict[str, list[str]], expected_error: str) -> None:
+        config = {
+            "messages": {"foo_action": ["foo message"]},
+            "actions": {"foo_action": "foo_action_path"},
+            "scenes": scenes
+        }
+
+        with pytest.raises(api.RemoteDeviceController.InvalidConfigError) as e:
+            api.RemoteDeviceController(config, Mock())
+
+        assert str(e.value) == expected_error
+
+    @pytest.mark.parametrize(
+        'config, expected_error',
+        [
+            (['foo'], 'Config should be an object'),
+            ({'actions': {'foo_action': 'foo_action_path'}}, '"messages" should be an object'),
+            (
+                {'messages': {'foo_action': 'foo message'}, 'actions': {'foo_action': 'foo_action_path'}},
+                '"messages" has invalid values for the following names: foo_action'
+            ),
+            (
+                {'messages': {'foo_action': ['foo message']}, 'actions': {'foo_action': 1}},
+                '"actions" has invalid values for the following names: foo_action'
+            ),
+            (
+                {
+                    'messages': {'foo_action': ['foo message']},
+                    'actions': {'foo_action': 'foo_action_path'},
+                    'scenes': None
+                },
+                '"scenes" should be an object'
+            ),
+        ]
+    )
+    def test_config_types(self, config: Any, expected_error: str) -> None:
+        with pytest.raises(api.RemoteDeviceController.InvalidConfigError) as e:
+            api.parse_config(config)
+
+        assert str(e.value) == expected_error
+
+    def test_scenes_are_optional(self) -> None:
+        config = {
+            "messages": {"foo_action": ["foo message"]},
+            "actions": {"foo_action": "foo_action_path"}
+        }
+
+        dc = api.RemoteDeviceController(config, Mock())
+
+        assert dc.get_supported_scenes() == ()
+
+    def test_get_scene(self) -> None:
+        dc = api.RemoteDeviceController(self.config, Mock())
+
+        assert dc.get_supported_scenes() == ('leaving_home', 'quiet_leaving')
+        assert dc.get_scene_actions('leaving_home') == ['close_garage', 'lock_door']
+        assert dc.get_scene_message('leaving_home') == 'Bye'
+        assert dc.get_scene_message('quiet_leaving') is None
+
+        with pytest.raises(api.RemoteDeviceController.UnknownActionError):
+            dc.get_scene_actions('close_garage')
+
+    @patch('ccproxy.network.do_authenticated_request')
+    def test_toggle_many(self, do_authenticated_request_mock: Mock) -> None:
+        account = Mock()
+        account.host = 'https://example.org'
+
+        failing_response = Mock()
+        failing_response.raise_for_status.side_effect = HTTPError('Boom')
+
+        def do_authenticated_request(_: Any, url: str, method: str, payload: dict[str, Any], **kwargs: Any) -> Mock:
+            return failing_response if payload['objectName'] == 'lock_door_path' else Mock()
+
+        do_authenticated_request_mock.side_effect = do_authenticated_request
+
+        dc = api.RemoteDeviceController(self.config, account)
+        results = dc.toggle_many(['close_garage', 'lock_door'])
+
+        assert list(results.keys()) == ['close_garage', 'lock_door']
+        assert results['close_garage'] == 'Closing garage'
+        assert isinstance(results['lock_door'], HTTPError)
+        assert do_authenticated_request_mock.call_count == 2
+
+    @patch('ccproxy.network.do_authenticated_request')
+    def test_toggle_many_unknown_action(self, do_authenticated_request_mock: Mock) -> None:
+        dc = api.RemoteDeviceController(self.config, Mock())
+
+        with pytest.raises(api.RemoteDeviceController.UnknownActionError) as e:
+            dc.toggle_many(['close_garage', 'open_sesame'])
+
+        assert e.value.args == ('open_sesame',)
+        do_authenticated_request_mock.assert_not_called()
+
+
+    @patch('ccproxy.async_network.do_authenticated_request', new_callable=AsyncMock)
+    def test_toggle_many_async(self, do_authenticated_request_mock: AsyncMock) -> None:
+        account = Mock()
+        account.host = 'https://example.org'
+
+        failing_response = Mock()
+        failing_response.raise_for_status.side_effect = HTTPError('Boom')
+
+        async def do_authenticated_request(_: Any, url: str, method: str, payload: dict[str, Any], **kwargs: Any) -> Mock:
+            return failing_response if payload['objectName'] == 'lock_door_path' else Mock()
+
+        do_authenticated_request_mock.side_effect = do_authenticated_request
+
+        dc = api.RemoteDeviceController(self.config, account)
+        results = async_network.run(dc.toggle_many_async(['close_garage', 'lock_door']))
+
+        assert list(results.keys()) == ['close_garage', 'lock_door']
+        assert results['close_garage'] == 'Closing garage'
+        assert isinstance(results['lock_door'], HTTPError)
+        do_authenticated_request_mock.assert_any_call(
+            account,
+            'https://example.org/SetValue',
+            'POST',
+            {'objectName': 'close_garage_path', 'valueName': 'Value', 'value': 'true'},
+            idempotent=False
+        )
+
+        with pytest.raises(api.RemoteDeviceController.UnknownActionError):
+            async_network.run(dc.toggle_async('open_sesame'))
+
+
+    @patch('ccproxy.network.do_authenticated_request')
+    def test_read(self, do_authenticated_request_mock: Mock) -> None:
+        account = Mock()
+        account.id = '1234'
+        account.host = 'https://example.org'
+
+        response = Mock()
+        response.json.return_value = {'Value': True}
+        do_authenticated_request_mock.return_value = response
+
+        dc = api.RemoteDeviceController(self.config, account, api.ValueCache(10, 5.0))
+
+        assert dc.read('close_garage') is True
+        assert dc.read('close_garage') is True
+        do_authenticated_request_mock.assert_called_once_with(
+            account,
+            'https://example.org/GetValue',
+            'POST',
+            {'objectName': 'close_garage_path', 'valueName': 'Value'},
+            idempotent=True
+        )
+
+        # toggling invalidates the cached value
+        response.json.return_value = False
+        dc.toggle('close_garage')
+        assert dc.read('close_garage') is False
+        assert do_authenticated_request_mock.call_count == 3
+
+        with pytest.raises(api.RemoteDeviceController.UnknownActionError):
+            dc.read('open_sesame')
+
+    @patch('ccproxy.network.do_authenticated_request')
+    def test_read_many(self, do_authenticated_request_mock: Mock) -> None:
+        account = Mock()
+        account.host = 'https://example.org'
+
+        def do_authenticated_request(_: Any, url: str, method: str, payload: dict[str, Any], **kwargs: Any) -> Mock:
+            response = Mock()
+            if payload['objectName'] == 'lock_door_path':
+                response.raise_for_status.side_effect = HTTPError('Boom')
+            response.json.return_value = 21.5
+
+            return response
+
+        do_authenticated_request_mock.side_effect = do_authenticated_request
+
+        dc = api.RemoteDeviceController(self.config, account)
+        results = dc.read_many(['close_garage', 'lock_door'])
+
+        assert results['close_garage'] == 21.5
+        assert isinstance(results['lock_door'], HTTPError)
+
+    @patch('ccproxy.async_network.do_authenticated_request', new_callable=AsyncMock)
+    def test_read_many_async(self, do_authenticated_request_mock: AsyncMock) -> None:
+        account = Mock()
+        account.id = '1234'
+        account.host = 'https://example.org'
+
+        response = Mock()
+        response.json.return_value = {'Value': 'Open'}
+        do_authenticated_request_mock.return_value = response
+
+        value_cache = api.ValueCache(10, 5.0)
+        value_cache.put('1234', 'lock_door_path', 'Locked')
+        dc = api.RemoteDeviceController(self.config, account, value_cache)
+
+        results = async_network.run(dc.read_many_async(['close_garage', 'lock_door']))
+
+        assert results == {'close_garage': 'Open', 'lock_door': 'Locked'}
+        do_authenticated_request_mock.assert_called_once_with(
+            account,
+            'https://example.org/GetValue',
+            'POST',
+            {'objectName': 'close_garage_path', 'valueName': 'Value'},
+            idempotent=True
+        )
+
+
+class TestValueCache:
+    def test_entries_expire(self) -> None:
+        now = [100.0]
+        cache = api.ValueCache(10, 5.0, lambda: now[0])
+
+        assert cache.get('1234', 'garage') == (False, None)
+
+        cache.put('1234', 'garage', None)
+        assert cache.get('1234', 'garage') == (True, None)
+        assert cache.get('5678', 'garage') == (False, None)
+
+        now[0] += 5
+        assert cache.get('1234', 'garage') == (False, None)
+
+    def test_invalidate_and_bounds(self) -> None:
+        cache = api.ValueCache(2, 5.0)
+
+        cache.put('1234', 'garage', 1)
+        cache.put('1234', 'door', 2)
+        cache.invalidate('1234', 'garage')
+        assert cache.get('1234', 'garage') == (False, None)
+
+        cache.put('1234', 'window', 3)
+        cache.put('1234', 'light', 4)
+        assert cache.get('1234', 'door') == (False, None)
+        assert cache.get('1234', 'light') == (True, 4)
+
+        disabled_cache = api.ValueCache(0, 5.0)
+        disabled_cache.put('1234', 'garage', 1)
+        assert disabled_cache.get('1234', 'garage') == (False, None)
+
+
+class TestConfigLoader:
+    def _write(self, path: Path, contents: dict[str, Any], mtime_ns: int) -> None:
+        path.write_text(json.dumps(contents))
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_load_is_cached_until_file_changes(self, tmp_path: Path) -> None:
+        path = tmp_path / 'config.json'
+        self._write(path, {'messages': {'foo': ['bar']}, 'actions': {'foo': 'foo_path'}}, 1_000_000_000)
+
+        loader = api.ConfigLoader(str(path))
+
+        config = loader.load()
+        assert config.actions == {'foo': 'foo_path'}
+
+        with patch('ccproxy.api.parse_config') as mock_parse_config:
+            assert loader.load() is config
+            mock_parse_config.assert_not_called()
+
+        self._write(path, {'messages': {'baz': ['bar']}, 'actions': {'baz': 'baz_path'}}, 2_000_000_000)
+
+        reloaded_config = loader.load()
+        assert reloaded_config is not config
+        assert reloaded_config.actions == {'baz': 'baz_path'}
+
+    def test_broken_reload_keeps_last_good_config(self, tmp_path: Path) -> None:
+        path = tmp_path / 'config.json'
+        self._write(path, {'messages': {'foo': ['bar']}, 'actions': {'foo': 'foo_path'}}, 1_000_000_000)
+
+        loader = api.ConfigLoader(str(path))
+        config = loader.load()
+
+        self._write(path, {'messages': {}, 'actions': {'foo': 'foo_path'}}, 2_000_000_000)
+        assert loader.load() is config
+
+        path.write_text('{not json')
+        assert loader.load() is config
+
+        path.unlink()
+        assert loader.load() is config
+
+    def test_broken_initial_load(self, tmp_path: Path) -> None:
+        path = tmp_path / 'config.json'
+        self._write(path, {'messages': {}, 'actions': {'foo': 'foo_path'}}, 1_000_000_000)
+
+        loader = api.ConfigLoader(str(path))
+
+        with pytest.raises(api.RemoteDeviceController.InvalidConfigError):
+            loader.load()
+
+    def test_controller_accepts_loaded_config(self) -> None:
+        config = api.parse_config({'messages': {'foo': ['bar']}, 'actions': {'foo': 'foo_path'}})
+
+        with patch('ccproxy.api.parse_config') as mock_parse_config:
+            dc = api.RemoteDeviceController(config, Mock())
+
+            mock_parse_config.assert_not_called()
+            assert dc.get_supported_actions() == ('foo',)
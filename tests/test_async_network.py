@@ -0,0 +1,136 @@
+from unittest.mock import AsyncMock, Mock, patch
+from ccproxy import async_network, circuit_breaker, model, network
+from typing import Any, Optional
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import asyncio
+import json
+import threading
+import pytest
+
+_CREDENTIALS = model.CredentialsEnvelope(
+    username='foo-un',
+    password='foo-pwd',
+    host='https://192.168.1.123:8443'
+)
+
+
+@pytest.mark.parametrize(
+    'body, headers, expected_exception_type',
+    [
+        ({}, {}, network.AuthContractError.Types.NO_STATUS_FIELD),
+        ({'Status': 'not-ok'}, {}, network.AuthContractError.Types.NOT_OK_STATUS),
+        ({'Status': 'OK'}, {}, network.AuthContractError.Types.NO_COOKIE_HEADER),
+        ({'Status': 'OK'}, {'Set-Cookie': 'Token=foo'}, network.AuthContractError.Types.INVALID_SET_COOKIE_HEADER),
+    ]
+)
+@patch('ccproxy.async_network.do_request', new_callable=AsyncMock)
+def test_authenticate_invalid_response(
+    mock_do_request: AsyncMock,
+    body: dict[str, Any],
+    headers: dict[str, str],
+    expected_exception_type: network.AuthContractError.Types
+) -> None:
+    dummy_response = Mock()
+    dummy_response.headers = headers
+    dummy_response.json.return_value = body
+    mock_do_request.return_value = dummy_response
+
+    with pytest.raises(async_network.AuthContractError) as e:
+        async_network.run(async_network.authenticate(_CREDENTIALS))
+
+    assert e.value.type is expected_exception_type
+
+
+class TestClients:
+    def setup_method(self) -> None:
+        async_network.run(async_network.aclose_clients())
+        circuit_breaker.reset_breakers()
+
+    def teardown_method(self) -> None:
+        async_network.run(async_network.aclose_clients())
+        circuit_breaker.reset_breakers()
+
+    def test_client_is_shared_per_origin(self) -> None:
+        async def get_clients() -> list[Any]:
+            return [
+                async_network.get_client('https://192.168.1.123:8443/Login'),
+                async_network.get_client('https://192.168.1.123:8443/SetValue'),
+                async_network.get_client('https://192.168.1.124:8443/SetValue'),
+            ]
+
+        login_client, set_value_client, other_host_client = async_network.run(get_clients())
+
+        assert login_client is set_value_client
+        assert login_client is not other_host_client
+        assert login_client.headers['X-Requested-With'] == 'XMLHttpRequest'
+        # the same event loop is used by every run(), so are the clients
+        assert async_network.run(get_clients())[0] is login_client
+
+    def test_clients_are_recreated_for_another_event_loop(self) -> None:
+        async def get_client() -> Any:
+            return async_network.get_client('https://192.168.1.123:8443/Login')
+
+        client = async_network.run(get_client())
+
+        assert asyncio.run(get_client()) is not client
+
+    def test_authenticate_and_toggle(self) -> None:
+        received: list[tuple[str, Optional[str], dict[str, Any]]] = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                received.append((self.path, self.headers.get('Cookie'), payload))
+
+                body = json.dumps({'Status': 'OK'}).encode()
+                self.send_response(200)
+                if self.path == '/Login':
+                    self.send_header('Set-Cookie', 'Token=from-server; Max-Age=3600; HttpOnly')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            host = f'http://127.0.0.1:{server.server_port}'
+            credentials = model.CredentialsEnvelope(username='foo-un', password='foo-pwd', host=host)
+            cookie = async_network.run(async_network.authenticate(credentials))
+
+            account = model.Account(username='foo-un', password='foo-pwd', host=host, cookie=cookie.value)
+            response = async_network.run(
+                async_network.do_authenticated_request(account, f'{host}/SetValue', 'POST', {'foo': 'bar'})
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert response.status_code == 200
+        assert cookie.value == 'Token=from-server'
+        assert cookie.expires_at is not None
+        assert received[0][0] == '/Login'
+        assert received[0][1] is None
+        assert received[0][2]['UserName'] == 'foo-un'
+        # the cookie set by the server is not remembered by the shared client
+        assert received[1] == ('/SetValue', 'CurrentPath=; Token=from-server', {'foo': 'bar'})
+
+    @patch('ccproxy.config.CIRCUIT_BREAKER_FAILURES', 2)
+    @patch('ccproxy.config.RETRY_MAX_ATTEMPTS', 1)
+    def test_unreachable_host_trips_circuit(self) -> None:
+        import httpx
+
+        # nothing listens on a port of a socket that has just been closed
+        server = HTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler)
+        url = f'http://127.0.0.1:{server.server_port}/SetValue'
+        server.server_close()
+
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                async_network.run(async_network.do_request(url, 'POST'))
+
+        with pytest.raises(circuit_breaker.CircuitBreaker.OpenError):
+            async_network.run(async_network.do_request(url, 'POST'))
@@ -0,0 +1,221 @@
+from unittest.mock import Mock, patch
+from ccproxy import config, container, tutils
+from ccproxy.circuit_breaker import CircuitBreaker, CircuitStateTable
+from typing import Iterator
+import time
+import uuid
+import pytest
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# mypy would narrow breaker.state down after the first assert on it
+def _get_state(breaker: CircuitBreaker) -> CircuitBreaker.State:
+    return breaker.state
+
+
+def _fail(breaker: CircuitBreaker) -> None:
+    with pytest.raises(ConnectionError):
+        with breaker.attempt((TimeoutError,), (ConnectionError,)):
+            raise ConnectionError()
+
+
+def _respond(breaker: CircuitBreaker, status_code: int) -> None:
+    with breaker.attempt((TimeoutError,), (ConnectionError,)) as attempt:
+        attempt.status_code = status_code
+
+
+def test_opens_after_consecutive_failures() -> None:
+    clock = FakeClock()
+    breaker = CircuitBreaker('https://foo', 3, 30.0, clock=clock)
+
+    _fail(breaker)
+    _fail(breaker)
+    _respond(breaker, 200)  # resets the count
+    _fail(breaker)
+    _respond(breaker, 503)
+    assert _get_state(breaker) is CircuitBreaker.State.CLOSED
+
+    _fail(breaker)
+    assert _get_state(breaker) is CircuitBreaker.State.OPEN
+
+    clock.now += 10
+    with pytest.raises(CircuitBreaker.OpenError) as e:
+        _respond(breaker, 200)
+
+    assert e.value.host == 'https://foo'
+    assert e.value.retry_after == 20
+
+
+def test_client_errors_and_other_exceptions_are_not_failures() -> None:
+    breaker = CircuitBreaker('https://foo', 1, 30.0)
+
+    _respond(breaker, 401)
+    with pytest.raises(ValueError):
+        with breaker.attempt((TimeoutError,), (ConnectionError,)):
+            raise ValueError()
+
+    assert _get_state(breaker) is CircuitBreaker.State.CLOSED
+
+
+def test_half_open_lets_one_trial_through() -> None:
+    clock = FakeClock()
+    breaker = CircuitBreaker('https://foo', 1, 30.0, clock=clock)
+    _fail(breaker)
+
+    clock.now += 30
+    with breaker.attempt((TimeoutError,), (ConnectionError,)) as attempt:
+        assert _get_state(breaker) is CircuitBreaker.State.HALF_OPEN
+        with pytest.raises(CircuitBreaker.OpenError):
+            _respond(breaker, 200)
+        attempt.status_code = 200
+
+    assert _get_state(breaker) is CircuitBreaker.State.CLOSED
+
+
+def test_failed_trial_opens_circuit_again() -> None:
+    clock = FakeClock()
+    breaker = CircuitBreaker('https://foo', 3, 30.0, clock=clock)
+    for _ in range(3):
+        _fail(breaker)
+
+    clock.now += 30
+    _fail(breaker)
+
+    assert _get_state(breaker) is CircuitBreaker.State.OPEN
+    with pytest.raises(CircuitBreaker.OpenError) as e:
+        _respond(breaker, 200)
+    assert e.value.retry_after == 30
+
+
+def test_late_outcomes_do_not_close_circuit() -> None:
+    breaker = CircuitBreaker('https://foo', 1, 30.0)
+
+    with breaker.attempt((TimeoutError,), (ConnectionError,)) as attempt:
+        _fail(breaker)
+        attempt.status_code = 200
+
+    assert _get_state(breaker) is CircuitBreaker.State.OPEN
+
+
+def test_disabled_breaker() -> None:
+    breaker = CircuitBreaker('https://foo', 0, 30.0)
+    for _ in range(10):
+        _fail(breaker)
+
+    _respond(breaker, 200)
+
+
+@patch('ccproxy.config.HTTP_READ_TIMEOUT', 6.0)
+@patch('ccproxy.config.HTTP_MIN_READ_TIMEOUT', 0.2)
+@patch('ccproxy.config.HTTP_TIMEOUT_MULTIPLIER', 3.0)
+@patch('ccproxy.config.HTTP_TIMEOUT_PERCENTILE', 0.9)
+def test_read_timeout_adapts_to_latency() -> None:
+    breaker = CircuitBreaker('https://foo', 5, 30.0)
+
+    for _ in range(10):
+        breaker.release(False, True, 0.1)
+    # not enough samples yet
+    assert breaker.get_read_timeout() == 6.0
+
+    for _ in range(8):
+        breaker.release(False, True, 0.1)
+    for _ in range(2):
+        breaker.release(False, True, 1.0)
+    # 90th percentile of 18 * 0.1 and 2 * 1.0
+    assert breaker.get_read_timeout() == pytest.approx(0.3)
+    assert breaker.get_read_timeout(is_trial=True) == 6.0
+
+    # only the last 100 latencies are kept
+    for _ in range(100):
+        breaker.release(False, True, 0.01)
+    assert breaker.get_read_timeout() == 0.2
+
+    for _ in range(100):
+        breaker.release(False, True, 5.0)
+    assert breaker.get_read_timeout() == 6.0
+
+    with patch('ccproxy.config.HTTP_ADAPTIVE_TIMEOUT', False):
+        for _ in range(100):
+            breaker.release(False, True, 0.01)
+        assert breaker.get_read_timeout() == 6.0
+
+
+def test_timeouts_are_recorded_as_latency() -> None:
+    breaker = CircuitBreaker('https://foo', 100, 30.0)
+
+    for _ in range(20):
+        with pytest.raises(TimeoutError):
+            with breaker.attempt((TimeoutError,), (ConnectionError,)):
+                time.sleep(0.001)
+                raise TimeoutError()
+
+    assert breaker.get_read_timeout() >= config.HTTP_MIN_READ_TIMEOUT
+
+
+def test_shared_state_is_synced() -> None:
+    clock = FakeClock()
+    state_table = Mock()
+    state_table.get_open_until.return_value = None
+    breaker = CircuitBreaker('https://foo', 1, 30.0, state_table, sync_interval=5.0, clock=clock)
+
+    _respond(breaker, 200)
+    _respond(breaker, 200)
+    state_table.get_open_until.assert_called_once_with('https://foo')
+
+    # opened by another process
+    state_table.get_open_until.return_value = clock.now + 20
+    clock.now += 5
+    with pytest.raises(CircuitBreaker.OpenError):
+        _respond(breaker, 200)
+
+    clock.now += 20
+    _respond(breaker, 200)
+    state_table.delete.assert_called_once_with('https://foo')
+
+    _fail(breaker)
+    state_table.set_open_until.assert_called_once_with('https://foo', clock.now + 30)
+
+
+def test_shared_state_failures_are_ignored() -> None:
+    state_table = Mock()
+    state_table.get_open_until.side_effect = RuntimeError('boom')
+    state_table.set_open_until.side_effect = RuntimeError('boom')
+    breaker = CircuitBreaker('https://foo', 1, 30.0, state_table)
+
+    _respond(breaker, 200)
+    _fail(breaker)
+
+    assert _get_state(breaker) is CircuitBreaker.State.OPEN
+
+
+@pytest.fixture
+def state_table() -> Iterator[CircuitStateTable]:
+    name = f'ccproxy-circuits-{uuid.uuid4()}'
+    resource = tutils.create_dynamodb_resource()
+    table = resource.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'host', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'host', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    try:
+        yield CircuitStateTable(container.create_dynamodb_client(), name)
+    finally:
+        table.delete()
+
+
+def test_state_table(state_table: CircuitStateTable) -> None:
+    assert state_table.get_open_until('https://foo') is None
+
+    state_table.set_open_until('https://foo', 1_700_000_000.25)
+    assert state_table.get_open_until('https://foo') == 1_700_000_000.25
+
+    state_table.delete('https://foo')
+    assert state_table.get_open_until('https://foo') is None
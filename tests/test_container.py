@@ -0,0 +1,34 @@
+from unittest.mock import Mock
+from ccproxy import container, main
+
+
+class TestSharedInstances:
+    def setup_method(self) -> None:
+        container.reset()
+
+    def teardown_method(self) -> None:
+        container.reset()
+
+    def test_instances_are_reused(self) -> None:
+        account_table = container.get_account_table()
+
+        assert isinstance(account_table, main.AccountTable)
+        assert container.get_account_table() is account_table
+        assert container.get_encrypter() is container.get_encrypter()
+        assert container.get_dynamodb_client() is container.get_dynamodb_client()
+
+    def test_reset(self) -> None:
+        account_table = container.get_account_table()
+        encrypter = container.get_encrypter()
+
+        container.reset()
+
+        assert container.get_account_table() is not account_table
+        assert container.get_encrypter() is not encrypter
+
+    def test_override(self) -> None:
+        account_table = Mock()
+
+        container.override('account_table', account_table)
+
+        assert container.get_account_table() is account_table
@@ -0,0 +1,10 @@
+from ccproxy import dynamodb
+
+
+def test_marshal_item() -> None:
+    item = {'id': 'abc', 'cookie': 'ck', 'version': 3}
+
+    marshalled_item = dynamodb.marshal_item(item)
+
+    assert marshalled_item == {'id': {'S': 'abc'}, 'cookie': {'S': 'ck'}, 'version': {'N': '3'}}
+    assert dynamodb.unmarshal_item(marshalled_item) == item
@@ -0,0 +1,102 @@
+from unittest.mock import patch
+from ccproxy import container, main, tutils
+from ccproxy.idempotency import DynamoDBIdempotencyStore, InMemoryIdempotencyStore, Record
+from botocore.exceptions import ConnectionClosedError
+from typing import Any, Iterator
+import uuid
+import pytest
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_in_memory_store() -> None:
+    clock = FakeClock()
+    store = InMemoryIdempotencyStore(2, clock)
+
+    assert store.claim('foo', 'action=a', 15) is None
+    assert store.claim('foo', 'action=a', 15) == Record('action=a', None)
+
+    store.complete('foo', 'action=a', {'statusCode': 200}, 60)
+    clock.now += 30
+    assert store.claim('foo', 'action=b', 15) == Record('action=a', {'statusCode': 200})
+
+    clock.now += 30
+    assert store.claim('foo', 'action=b', 15) is None
+
+    store.release('foo')
+    assert store.claim('foo', 'action=a', 15) is None
+
+
+def test_in_memory_store_is_bounded() -> None:
+    store = InMemoryIdempotencyStore(2)
+
+    for key in ('foo', 'bar', 'baz'):
+        assert store.claim(key, 'action=a', 15) is None
+
+    assert store.claim('foo', 'action=a', 15) is None
+    assert store.claim('baz', 'action=a', 15) is not None
+
+
+@pytest.fixture
+def table_name() -> Iterator[str]:
+    name = f'ccproxy-idempotency-{uuid.uuid4()}'
+    resource = tutils.create_dynamodb_resource()
+    table = resource.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    try:
+        yield name
+    finally:
+        table.delete()
+
+
+def test_dynamodb_store(table_name: str) -> None:
+    clock = FakeClock()
+    client = container.create_dynamodb_client()
+    store = DynamoDBIdempotencyStore(client, table_name, main.create_dynamodb_retry_policy(), clock)
+    other_store = DynamoDBIdempotencyStore(client, table_name, main.create_dynamodb_retry_policy(), clock)
+
+    assert store.claim('foo', 'action=a', 15) is None
+    assert other_store.claim('foo', 'action=a', 15) == Record('action=a', None)
+
+    response = {'statusCode': 200, 'body': 'Done'}
+    store.complete('foo', 'action=a', response, 60)
+    assert other_store.claim('foo', 'action=b', 15) == Record('action=a', response)
+
+    # expired, but not removed by DynamoDB yet
+    clock.now += 61
+    assert other_store.claim('foo', 'action=b', 15) is None
+
+    other_store.release('foo')
+    assert store.claim('foo', 'action=a', 15) is None
+
+
+def test_dynamodb_store_recognizes_own_claim(table_name: str) -> None:
+    client = container.create_dynamodb_client()
+    store = DynamoDBIdempotencyStore(client, table_name, main.create_dynamodb_retry_policy())
+    put_item = client.put_item
+    calls = []
+
+    # the first put succeeds, but its response gets lost and it is retried
+    def put_item_with_lost_response(**kwargs: Any) -> Any:
+        calls.append(kwargs)
+        response = put_item(**kwargs)
+        if len(calls) == 1:
+            raise ConnectionClosedError(endpoint_url='http://localhost:8000')
+
+        return response
+
+    with patch.object(client, 'put_item', side_effect=put_item_with_lost_response):
+        assert store.claim('foo', 'action=a', 15) is None
+
+    assert len(calls) == 2
+    assert store.claim('foo', 'action=a', 15) == Record('action=a', None)
@@ -0,0 +1,56 @@
+from pathlib import Path
+import subprocess
+import sys
+import pytest
+
+# importing a handler currently takes ~15ms, twice that leaves room for slower
+# machines but still catches a stray top-level import of asyncio (~40ms) or boto3
+# (over 100ms)
+_IMPORT_TIME_BUDGET_MS = 30
+
+# SDKs (and asyncio, only needed by the async handler) that must only be imported
+# once a handler is invoked
+_DEFERRED_MODULES = (
+    'boto3', 'botocore', 'cryptography', 'requests', 'httpx', 'mypy_boto3_dynamodb', 'asyncio'
+)
+
+_HANDLER_MODULES = ['ccproxy.handlers.process_action', 'ccproxy.handlers.login']
+
+_PROJECT_DIR = Path(__file__).parent.parent
+
+
+def _run_python(*args: str) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=_PROJECT_DIR,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+
+@pytest.mark.parametrize('module', _HANDLER_MODULES)
+def test_import_time_budget(module: str) -> None:
+    # lines look like "import time:       418 |      17065 | ccproxy.handlers.process_action",
+    # the second column is cumulative time in microseconds
+    timings = []
+    for _ in range(3):
+        result = _run_python('-X', 'importtime', '-c', f'import {module}')
+
+        for line in result.stderr.splitlines():
+            parts = [part.strip() for part in line.split('|')]
+            if len(parts) == 3 and parts[2] == module:
+                timings.append(int(parts[1]) / 1000)
+
+    assert len(timings) == 3
+    assert min(timings) <= _IMPORT_TIME_BUDGET_MS, f'Importing "{module}" took {min(timings)}ms'
+
+
+@pytest.mark.parametrize('module', _HANDLER_MODULES)
+def test_heavy_modules_are_deferred(module: str) -> None:
+    result = _run_python(
+        '-c',
+        f'import sys, {module}; print(",".join(m for m in {_DEFERRED_MODULES!r} if m in sys.modules))'
+    )
+
+    assert result.stdout.strip() == ''
@@ -0,0 +1,152 @@
+from unittest.mock import patch
+from ccproxy import container, key_rotation, main, model, tutils
+from cryptography.fernet import Fernet, InvalidToken
+from pathlib import Path
+from typing import Any, Iterator
+import json
+import uuid
+import pytest
+
+_OLD_KEY = Fernet.generate_key().decode('utf-8')
+_NEW_KEY = Fernet.generate_key().decode('utf-8')
+
+
+@pytest.fixture
+def account_table() -> Iterator[main.AccountTable]:
+    # rotation scans the whole table, so it gets one of its own
+    table_name = f'ccproxy-rotation-{uuid.uuid4()}'
+    with patch('ccproxy.config.ACCOUNTS_TABLE', table_name):
+        tutils.create_accounts_table_if_not_exists()
+        yield main.AccountTable(main.Encrypter([_OLD_KEY]), container.create_dynamodb_client())
+
+    container.create_dynamodb_client().delete_table(TableName=table_name)
+
+
+def _create_accounts(account_table: main.AccountTable, count: int) -> list[str]:
+    ids = []
+    for i in range(count):
+        account = account_table.save(
+            model.Account(username=f'un-{i}', password=f'pwd-{i}', host='hst', cookie=f'ck-{i}')
+        )
+        assert account.id is not None
+        ids.append(account.id)
+
+    return ids
+
+
+def _get_raw_table(account_table: main.AccountTable) -> Any:
+    return tutils.create_dynamodb_resource().Table(account_table._table_name)
+
+
+def test_rotate_encryption_key(account_table: main.AccountTable, tmp_path: Path) -> None:
+    ids = _create_accounts(account_table, 7)
+    progress_path = str(tmp_path / 'progress.json')
+
+    stats = key_rotation.rotate_encryption_key(
+        account_table,
+        main.Encrypter([_NEW_KEY, _OLD_KEY]),
+        key_rotation.RotationProgress(progress_path, 3),
+        3,
+        2
+    )
+
+    assert stats == key_rotation.RotationStats(scanned=7, rotated=7)
+    assert not Path(progress_path).exists()
+
+    new_key_only = main.Encrypter([_NEW_KEY])
+    for i, id in enumerate(ids):
+        item = _get_raw_table(account_table).get_item(Key={'id': id})['Item']
+        assert new_key_only.decrypt(str(item['password'])) == f'pwd-{i}'
+        assert new_key_only.decrypt(str(item['cookie'])) == f'ck-{i}'
+        assert item['version'] == 1
+
+    # everything is encrypted with the new key already
+    stats = key_rotation.rotate_encryption_key(
+        account_table,
+        main.Encrypter([_NEW_KEY, _OLD_KEY]),
+        key_rotation.RotationProgress(progress_path, 3),
+        3,
+        2
+    )
+    assert stats == key_rotation.RotationStats(scanned=7, rotated=0)
+
+
+def test_rotation_resumes(account_table: main.AccountTable, tmp_path: Path) -> None:
+    _create_accounts(account_table, 4)
+    progress_path = tmp_path / 'progress.json'
+    progress_path.write_text(json.dumps({
+        'total_segments': 2,
+        'segments': {'0': {'last_key': None, 'done': True}}
+    }))
+
+    with patch.object(
+        account_table, 'scan_encrypted_attributes', wraps=account_table.scan_encrypted_attributes
+    ) as scan_spy:
+        stats = key_rotation.rotate_encryption_key(
+            account_table,
+            main.Encrypter([_NEW_KEY, _OLD_KEY]),
+            key_rotation.RotationProgress(str(progress_path), 2),
+            2,
+            100
+        )
+
+    assert {call.args[0] for call in scan_spy.call_args_list} == {1}
+    segment_items, _ = account_table.scan_encrypted_attributes(1, 2, 100)
+    assert stats.scanned == len(segment_items)
+
+    with pytest.raises(RuntimeError):
+        progress_path.write_text(json.dumps({'total_segments': 2, 'segments': {}}))
+        key_rotation.RotationProgress(str(progress_path), 4)
+
+
+def test_concurrently_modified_account_is_skipped(account_table: main.AccountTable) -> None:
+    id = _create_accounts(account_table, 1)[0]
+    item = _get_raw_table(account_table).get_item(Key={'id': id})['Item']
+
+    account = account_table.find(id)
+    assert account is not None
+    account.cookie = 'new-ck'
+    account_table.save(account)
+
+    assert account_table.replace_encrypted_attributes(
+        id,
+        {'password': str(item['password']), 'cookie': str(item['cookie'])},
+        {'password': 'rotated-password', 'cookie': 'rotated-cookie'}
+    ) is False
+
+    item = _get_raw_table(account_table).get_item(Key={'id': id})['Item']
+    assert main.Encrypter([_OLD_KEY]).decrypt(str(item['cookie'])) == 'new-ck'
+
+
+def test_undecryptable_account_is_reported(account_table: main.AccountTable, tmp_path: Path) -> None:
+    _create_accounts(account_table, 2)
+    _get_raw_table(account_table).put_item(Item={'id': 'broken', 'password': 'garbage', 'cookie': 'garbage'})
+
+    stats = key_rotation.rotate_encryption_key(
+        account_table,
+        main.Encrypter([_NEW_KEY, _OLD_KEY]),
+        key_rotation.RotationProgress(str(tmp_path / 'progress.json'), 1),
+        1,
+        100
+    )
+
+    assert stats == key_rotation.RotationStats(scanned=3, rotated=2, failed=1)
+
+
+def test_encrypter_key_list() -> None:
+    old_encrypter = main.Encrypter([_OLD_KEY])
+    encrypter = main.Encrypter([_NEW_KEY, _OLD_KEY])
+
+    old_value = old_encrypter.encrypt('foo')
+    assert encrypter.decrypt(old_value) == 'foo'
+
+    rotated_value = encrypter.rotate(old_value)
+    assert rotated_value is not None
+    assert main.Encrypter([_NEW_KEY]).decrypt(rotated_value) == 'foo'
+    assert encrypter.rotate(rotated_value) is None
+
+    with pytest.raises(InvalidToken):
+        old_encrypter.decrypt(encrypter.encrypt('foo'))
+
+    with patch('ccproxy.config.DB_ENCRYPTION_KEY', f' {_NEW_KEY}, {_OLD_KEY} '):
+        assert main.Encrypter().decrypt(old_value) == 'foo'
@@ -0,0 +1,86 @@
+from ccproxy import model
+import copy
+import dataclasses
+from typing import Any
+from unittest.mock import Mock
+import pytest
+
+
+def test_parse_credentials() -> None:
+    credentials = model.CredentialsEnvelope.parse_obj(
+        {'username': 'un', 'password': 'pwd', 'host': 'hst', 'foo': 'bar'}
+    )
+
+    assert credentials == model.CredentialsEnvelope(username='un', password='pwd', host='hst')
+
+
+@pytest.mark.parametrize('body', [{'username': 'un', 'host': 'hst'}, {'username': 'un', 'password': 1, 'host': 'hst'}])
+def test_parse_invalid_credentials(body: dict[str, Any]) -> None:
+    with pytest.raises(model.ValidationError) as e:
+        model.CredentialsEnvelope.parse_obj(body)
+
+    assert str(e.value) == 'Expected strings for the following fields: password'
+
+
+def test_account_fields() -> None:
+    account = model.Account(username='un', password='pwd', host='hst', cookie='ck')
+
+    assert account.id is None
+    assert account.version is None
+    assert account.dirty_fields == frozenset()
+    assert account == model.Account(username='un', password='pwd', host='hst', cookie='ck')
+    assert 'pwd' not in repr(account)
+
+    account.version = 2
+    account.cookie = 'new-ck'
+    assert account.dirty_fields == frozenset({'version', 'cookie'})
+
+    with pytest.raises(AttributeError):
+        account.foo = 'bar'
+
+
+def test_account_from_encrypted_password() -> None:
+    decrypt = Mock(return_value='pwd')
+
+    account = model.Account.from_encrypted_password('encrypted-pwd', decrypt, id='1', username='un', host='hst')
+
+    assert account.cookie is None
+    assert account.dirty_fields == frozenset()
+    decrypt.assert_not_called()
+
+    assert account.password == 'pwd'
+    assert account.password == 'pwd'
+    decrypt.assert_called_once_with('encrypted-pwd')
+    assert account.encrypted_password == 'encrypted-pwd'
+
+
+def test_account_as_dataclass() -> None:
+    account = model.Account(username='un', password='pwd', host='hst', id='1', cookie='ck', version=2)
+
+    assert dataclasses.asdict(account) == {
+        'username': 'un',
+        'password': 'pwd',
+        'host': 'hst',
+        'id': '1',
+        'cookie': 'ck',
+        'cookie_issued_at': None,
+        'cookie_expires_at': None,
+        'version': 2
+    }
+    assert {field.name for field in dataclasses.fields(account)} == model.Account.FIELDS
+    assert dataclasses.replace(account, cookie='new-ck').dirty_fields == frozenset()
+
+
+@pytest.mark.parametrize('copy_fn', [copy.copy, copy.deepcopy])
+def test_copy_account(copy_fn: Any) -> None:
+    decrypt = Mock(return_value='pwd')
+    account = model.Account.from_encrypted_password('encrypted-pwd', decrypt, id='1', username='un', host='hst')
+    account.cookie = 'ck'
+
+    copied_account = copy_fn(account)
+    copied_account.version = 3
+
+    assert copied_account.password == 'pwd'
+    assert copied_account.cookie == 'ck'
+    assert copied_account.dirty_fields == frozenset({'cookie', 'version'})
+    assert account.dirty_fields == frozenset({'cookie'})
@@ -1,9 +1,14 @@
 from unittest.mock import Mock
 from ccproxy.main import authenticate
-from ccproxy import model, network
+from ccproxy import circuit_breaker, model, network, config
 from unittest.mock import patch
-from typing import Any
+from typing import Any, Optional
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+import threading
+import time
 import pytest
+import requests
 
 @pytest.mark.parametrize(
     'response, expected_exception_type',
@@ -53,4 +58,182 @@ def test_authenticate_invalid_response(mock_do_request: Mock, response: dict[str
 
         assert False
     except network.AuthContractError as e:
-        assert e.type is expected_exception_type
\ No newline at end of file
+        assert e.type is expected_exception_type
+
+@pytest.mark.parametrize(
+    'set_cookie_header, expires_in',
+    [
+        ('Token=foo; HttpOnly', None),
+        ('Token=foo; Max-Age=3600; HttpOnly', 3600),
+        ('Token=foo; expires=not a date; HttpOnly', None),
+    ]
+)
+@patch('ccproxy.network.do_request')
+def test_authenticate_cookie_expiry(mock_do_request: Mock, set_cookie_header: str, expires_in: Optional[int]) -> None:
+    dummy_response = Mock()
+    dummy_response.headers = {'Set-Cookie': set_cookie_header}
+    dummy_response.json.return_value = {'Status': 'OK'}
+    mock_do_request.return_value = dummy_response
+
+    cookie = network.authenticate(
+        model.CredentialsEnvelope(username='foo-un', password='foo-pwd', host='https://192.168.1.123:8443')
+    )
+
+    assert cookie.value == 'Token=foo'
+    assert cookie.issued_at.tzinfo is not None
+    if expires_in is None:
+        assert cookie.expires_at is None
+    else:
+        assert cookie.expires_at == cookie.issued_at + timedelta(seconds=expires_in)
+
+
+@patch('ccproxy.network.do_request')
+def test_authenticate_cookie_expires_attribute(mock_do_request: Mock) -> None:
+    dummy_response = Mock()
+    dummy_response.headers = {'Set-Cookie': 'Token=foo; expires=Wed, 21 Oct 2015 07:28:00 GMT'}
+    dummy_response.json.return_value = {'Status': 'OK'}
+    mock_do_request.return_value = dummy_response
+
+    cookie = network.authenticate(
+        model.CredentialsEnvelope(username='foo-un', password='foo-pwd', host='https://192.168.1.123:8443')
+    )
+
+    assert cookie.expires_at == datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)
+
+
+@patch('ccproxy.network.do_request')
+def test_authenticate_invalid_set_cookie_header(mock_do_request: Mock) -> None:
+    dummy_response = Mock()
+    dummy_response.headers = {'Set-Cookie': 'Token=foo'}
+    dummy_response.json.return_value = {'Status': 'OK'}
+    mock_do_request.return_value = dummy_response
+
+    with pytest.raises(network.AuthContractError) as e:
+        network.authenticate(
+            model.CredentialsEnvelope(username='foo-un', password='foo-pwd', host='https://192.168.1.123:8443')
+        )
+
+    assert e.value.type is network.AuthContractError.Types.INVALID_SET_COOKIE_HEADER
+
+
+class TestSessions:
+    def setup_method(self) -> None:
+        network.close_sessions()
+        circuit_breaker.reset_breakers()
+
+    def teardown_method(self) -> None:
+        network.close_sessions()
+        circuit_breaker.reset_breakers()
+
+    def test_session_is_shared_per_origin(self) -> None:
+        login_session = network.get_session('https://192.168.1.123:8443/Login')
+        set_value_session = network.get_session('https://192.168.1.123:8443/SetValue')
+        other_host_session = network.get_session('https://192.168.1.124:8443/SetValue')
+
+        assert login_session is set_value_session
+        assert login_session is not other_host_session
+        assert login_session.verify is False
+        assert login_session.headers['X-Requested-With'] == 'XMLHttpRequest'
+
+    @patch('ccproxy.network.get_session')
+    def test_do_request_uses_pooled_session(self, mock_get_session: Mock) -> None:
+        session = Mock()
+        session.request.return_value.status_code = 200
+        mock_get_session.return_value = session
+
+        response = network.do_request(
+            'https://192.168.1.123:8443/SetValue', 'POST', {'foo': 'bar'}, {'Cookie': 'Token=1'}
+        )
+
+        assert response is session.request.return_value
+        mock_get_session.assert_called_once_with('https://192.168.1.123:8443/SetValue')
+        session.request.assert_called_once_with(
+            'POST',
+            'https://192.168.1.123:8443/SetValue',
+            json={'foo': 'bar'},
+            headers={'Cookie': 'Token=1'},
+            timeout=(config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+        )
+
+    @patch('ccproxy.network.get_session')
+    def test_warm_up_connection(self, mock_get_session: Mock) -> None:
+        assert network.warm_up_connection('https://192.168.1.123:8443/SetValue', 0.5)
+
+        mock_get_session.assert_called_once_with('https://192.168.1.123:8443')
+        mock_get_session.return_value.head.assert_called_once_with('https://192.168.1.123:8443', timeout=0.5)
+
+    @patch('ccproxy.circuit_breaker.get_breaker')
+    @patch('ccproxy.network.get_session')
+    def test_warm_up_connection_skips_open_circuit(self, mock_get_session: Mock, mock_get_breaker: Mock) -> None:
+        mock_get_breaker.return_value.state = circuit_breaker.CircuitBreaker.State.OPEN
+
+        assert not network.warm_up_connection('https://192.168.1.123:8443/SetValue', 0.5)
+
+        mock_get_breaker.assert_called_once_with('https://192.168.1.123:8443')
+        mock_get_session.assert_not_called()
+
+    def test_session_does_not_keep_server_cookies(self) -> None:
+        received_cookies = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                received_cookies.append(self.headers.get('Cookie'))
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'Token=from-server; HttpOnly')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/Login'
+            network.do_request(url, 'POST')
+            network.do_request(url, 'POST')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert received_cookies == [None, None]
+
+    @patch('ccproxy.config.CIRCUIT_BREAKER_FAILURES', 2)
+    @patch('ccproxy.config.HTTP_READ_TIMEOUT', 0.2)
+    def test_hanging_host_trips_circuit(self) -> None:
+        received_paths = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                received_paths.append(self.path)
+                time.sleep(0.5)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/SetValue'
+            for _ in range(2):
+                with pytest.raises(requests.Timeout):
+                    network.do_request(url, 'POST')
+
+            started_at = time.perf_counter()
+            with pytest.raises(circuit_breaker.CircuitBreaker.OpenError) as e:
+                network.do_request(url, 'POST')
+            elapsed = time.perf_counter() - started_at
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert len(received_paths) == 2
+        assert elapsed < 0.1
+        assert e.value.host == f'http://127.0.0.1:{server.server_port}'
+        assert e.value.retry_after > 0
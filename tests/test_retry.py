@@ -0,0 +1,250 @@
+from unittest.mock import Mock, patch
+from ccproxy import async_network, circuit_breaker, container, main, network, retry
+from ccproxy.retry import ErrorClass, RetryPolicy
+from botocore.exceptions import ClientError, EndpointConnectionError
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Iterator, Optional
+import threading
+import time
+import pytest
+import requests
+
+
+class Flaky:
+    def __init__(self, failures: list[Exception], result: str = 'done') -> None:
+        self.failures = failures
+        self.result = result
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if len(self.failures) > 0:
+            raise self.failures.pop(0)
+
+        return self.result
+
+
+class NotSentError(Exception):
+    pass
+
+
+class TransientError(Exception):
+    pass
+
+
+def _classify(e: BaseException) -> Optional[ErrorClass]:
+    if isinstance(e, NotSentError):
+        return ErrorClass.NOT_SENT
+    elif isinstance(e, TransientError):
+        return ErrorClass.TRANSIENT
+
+    return None
+
+
+def _create_policy(max_attempts: int = 3, sleep: Callable[[float], None] = lambda delay: None) -> RetryPolicy:
+    return RetryPolicy('foo', _classify, max_attempts, 0.1, 1.0, sleep)
+
+
+def test_retries_until_success() -> None:
+    delays: list[float] = []
+    fn = Flaky([NotSentError(), TransientError()])
+
+    assert _create_policy(sleep=delays.append).call(fn) == 'done'
+    assert fn.calls == 3
+    # full jitter, capped exponential backoff
+    assert 0 <= delays[0] <= 0.1
+    assert 0 <= delays[1] <= 0.2
+
+
+def test_gives_up_after_max_attempts() -> None:
+    fn = Flaky([NotSentError(), NotSentError(), NotSentError()])
+
+    with pytest.raises(NotSentError):
+        _create_policy().call(fn)
+    assert fn.calls == 3
+
+
+def test_unclassified_errors_are_not_retried() -> None:
+    fn = Flaky([ValueError()])
+
+    with pytest.raises(ValueError):
+        _create_policy().call(fn)
+    assert fn.calls == 1
+
+
+def test_calls_that_are_not_idempotent() -> None:
+    fn = Flaky([NotSentError(), TransientError()])
+
+    with pytest.raises(TransientError):
+        _create_policy().call(fn, idempotent=False)
+    assert fn.calls == 2
+
+
+def test_results_are_retried() -> None:
+    results = iter([502, 503, 200])
+
+    def classify_result(status_code: int) -> Optional[ErrorClass]:
+        return retry.classify_status_code(status_code)
+
+    assert _create_policy().call(lambda: next(results), classify_result=classify_result) == 200
+
+    # the last result is returned once retries are exhausted
+    results = iter([502, 502, 502, 200])
+    assert _create_policy().call(lambda: next(results), classify_result=classify_result) == 502
+
+    results = iter([502, 200])
+    assert _create_policy().call(lambda: next(results), False, classify_result) == 502
+
+
+def test_call_async() -> None:
+    async def call() -> str:
+        return fn()
+
+    fn = Flaky([NotSentError(), TransientError()])
+    assert async_network.run(_create_policy().call_async(call)) == 'done'
+    assert fn.calls == 3
+
+    fn = Flaky([TransientError()])
+    with pytest.raises(TransientError):
+        async_network.run(_create_policy().call_async(call, idempotent=False))
+
+
+def test_lambda_deadline() -> None:
+    fn = Flaky([NotSentError(), NotSentError()])
+    context = Mock()
+
+    @retry.with_lambda_deadline
+    def handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
+        remaining_time = retry.get_remaining_time()
+        assert remaining_time is not None and remaining_time < 0.3
+
+        return {'body': _create_policy(sleep=time.sleep).call(fn)}
+
+    # nothing is left once RETRY_DEADLINE_MARGIN is taken off
+    context.get_remaining_time_in_millis.return_value = 300
+    with patch('ccproxy.config.RETRY_DEADLINE_MARGIN', 0.3):
+        with pytest.raises(NotSentError):
+            handler({}, context)
+    assert fn.calls == 1
+    assert retry.get_remaining_time() is None
+
+    context.get_remaining_time_in_millis.return_value = 10000
+    with patch('ccproxy.config.RETRY_DEADLINE_MARGIN', 9.8):
+        assert handler({}, context) == {'body': 'done'}
+
+
+class TestNetwork:
+    def setup_method(self) -> None:
+        network.close_sessions()
+        circuit_breaker.reset_breakers()
+
+    def teardown_method(self) -> None:
+        network.close_sessions()
+        circuit_breaker.reset_breakers()
+
+    @pytest.fixture
+    def server(self) -> Iterator[tuple[str, list[str]]]:
+        received_paths: list[str] = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                received_paths.append(self.path)
+                self.rfile.read(int(self.headers['Content-Length']))
+                # every first request of a path hits a restarting gateway
+                self.send_response(502 if received_paths.count(self.path) == 1 else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield f'http://127.0.0.1:{server.server_port}', received_paths
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_bad_gateway(self, server: tuple[str, list[str]]) -> None:
+        host, received_paths = server
+
+        assert network.do_request(f'{host}/GetValue', 'POST', {}, idempotent=True).status_code == 200
+        assert network.do_request(f'{host}/SetValue', 'POST', {}).status_code == 502
+        assert received_paths == ['/GetValue', '/GetValue', '/SetValue']
+
+    def test_bad_gateway_async(self, server: tuple[str, list[str]]) -> None:
+        host, received_paths = server
+
+        async def do_requests() -> list[int]:
+            try:
+                return [
+                    (await async_network.do_request(f'{host}/GetValue', 'POST', {}, idempotent=True)).status_code,
+                    (await async_network.do_request(f'{host}/SetValue', 'POST', {})).status_code,
+                ]
+            finally:
+                await async_network.aclose_clients()
+
+        assert async_network.run(do_requests()) == [200, 502]
+        assert received_paths == ['/GetValue', '/GetValue', '/SetValue']
+
+    def test_refused_connection(self) -> None:
+        # nothing listens on a port of a socket that has just been closed
+        server = HTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler)
+        url = f'http://127.0.0.1:{server.server_port}/SetValue'
+        server.server_close()
+
+        with patch('ccproxy.network._do_request_once', side_effect=network._do_request_once) as mock_do_request_once:
+            with pytest.raises(requests.ConnectionError) as e:
+                network.do_request(url, 'POST', {})
+
+        assert network._classify_error(e.value) is ErrorClass.NOT_SENT
+        # even a toggle is retried, it hasn't reached the server
+        assert mock_do_request_once.call_count == 3
+
+    def test_classify_error(self) -> None:
+        assert network._classify_error(requests.ConnectTimeout()) is ErrorClass.NOT_SENT
+        assert network._classify_error(requests.ReadTimeout()) is ErrorClass.TRANSIENT
+        assert network._classify_error(requests.ConnectionError(ConnectionResetError())) is ErrorClass.TRANSIENT
+        assert network._classify_error(ValueError()) is None
+
+
+def _create_client_error(code: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': 'Boom'}}, 'GetItem')
+
+
+@pytest.mark.parametrize(
+    'error, expected_error_class',
+    [
+        (_create_client_error('ProvisionedThroughputExceededException'), ErrorClass.THROTTLED),
+        (_create_client_error('ThrottlingException'), ErrorClass.THROTTLED),
+        (_create_client_error('InternalServerError'), ErrorClass.TRANSIENT),
+        (_create_client_error('ConditionalCheckFailedException'), None),
+        (EndpointConnectionError(endpoint_url='http://localhost:8000'), ErrorClass.NOT_SENT),
+    ]
+)
+def test_classify_dynamodb_error(error: Exception, expected_error_class: Optional[ErrorClass]) -> None:
+    assert main._classify_dynamodb_error(error) is expected_error_class
+
+
+def test_account_table_retries_throttled_reads() -> None:
+    from ccproxy import tutils
+
+    tutils.create_accounts_table_if_not_exists()
+    at = main.AccountTable(main.Encrypter(), container.create_dynamodb_client())
+
+    get_item = at._dynamodb.get_item
+    calls = []
+
+    def throttled_get_item(**kwargs: Any) -> Any:
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise _create_client_error('ProvisionedThroughputExceededException')
+
+        return get_item(**kwargs)
+
+    with patch.object(at._dynamodb, 'get_item', side_effect=throttled_get_item):
+        assert at.find('missing') is None
+
+    assert len(calls) == 2
@@ -0,0 +1,190 @@
+from ccproxy import server
+from ccproxy.handlers.login import login_handler
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import requests
+
+_PROJECT_DIR = Path(__file__).parent.parent
+
+
+class EchoHandler:
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.concurrency = 0
+        self.max_concurrency = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event: dict[str, Any], context: Any) -> dict[str, Any]:
+        with self._lock:
+            self.concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self.concurrency)
+        try:
+            time.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.concurrency -= 1
+
+        return {
+            'statusCode': 200,
+            'headers': {'X-Remaining-Time': context.get_remaining_time_in_millis()},
+            'body': json.dumps(event)
+        }
+
+
+def _start(routes: dict[str, server.Handler], workers: int = 2) -> tuple[server.Server, threading.Thread]:
+    http_server = server.Server(('127.0.0.1', 0), routes, workers)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    return http_server, thread
+
+
+@pytest.fixture
+def echo_server() -> Iterator[tuple[str, EchoHandler]]:
+    handler = EchoHandler()
+    http_server, _ = _start({'/': handler, '/login': login_handler})
+    try:
+        yield f'http://127.0.0.1:{http_server.server_port}', handler
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+
+def test_requests_are_translated_into_events(echo_server: tuple[str, EchoHandler]) -> None:
+    url, _ = echo_server
+
+    response = requests.get(
+        f'{url}/?action=open&action=close&scene=',
+        headers={'X-CCProxy-Account': '1234'}
+    )
+
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    assert 0 < int(response.headers['x-remaining-time']) <= 10000
+    event = response.json()
+    assert event['queryStringParameters'] == {'action': 'open,close', 'scene': ''}
+    assert event['headers']['x-ccproxy-account'] == '1234'
+    assert event['requestContext']['http']['method'] == 'GET'
+    assert 'body' not in event
+
+    event = requests.post(f'{url}/', data='{"foo": "bar"}').json()
+    assert event['queryStringParameters'] == {}
+    assert event['body'] == '{"foo": "bar"}'
+    assert event['isBase64Encoded'] is False
+
+    event = requests.post(f'{url}/', data=b'\xff\xfe').json()
+    assert event['body'] == '//4='
+    assert event['isBase64Encoded'] is True
+
+
+def test_real_handler(echo_server: tuple[str, EchoHandler]) -> None:
+    url, _ = echo_server
+
+    response = requests.post(f'{url}/login', data='not json')
+
+    assert response.status_code == 400
+    assert response.text == ''
+
+
+def test_unknown_path_and_invalid_body(echo_server: tuple[str, EchoHandler]) -> None:
+    url, _ = echo_server
+
+    assert requests.get(f'{url}/foo').status_code == 404
+    assert requests.post(f'{url}/', data='x' * (64 * 1024 + 1)).status_code == 413
+
+
+def test_keep_alive_requests_are_not_delayed(echo_server: tuple[str, EchoHandler]) -> None:
+    url, _ = echo_server
+
+    # with Nagle's algorithm a response written in pieces waits for the client's
+    # delayed ACK, adding ~40ms to every request after the first on a connection
+    with requests.Session() as session:
+        session.get(f'{url}/').raise_for_status()
+
+        latencies = []
+        for _ in range(10):
+            started_at = time.perf_counter()
+            session.get(f'{url}/').raise_for_status()
+            latencies.append(time.perf_counter() - started_at)
+
+    assert sorted(latencies)[len(latencies) // 2] < 0.02
+
+
+def test_create_response() -> None:
+    assert server.create_response({'statusCode': 503, 'headers': {'Retry-After': 3}, 'body': 'Try later'}) == (
+        503, {'retry-after': '3', 'content-type': 'application/json'}, b'Try later'
+    )
+    assert server.create_response({'statusCode': 204}) == (204, {'content-type': 'application/json'}, b'')
+    assert server.create_response(['foo']) == (200, {'content-type': 'application/json'}, b'["foo"]')
+
+
+def test_worker_pool_is_bounded() -> None:
+    handler = EchoHandler(delay=0.1)
+    http_server, _ = _start({'/': handler}, workers=2)
+    url = f'http://127.0.0.1:{http_server.server_port}/'
+    try:
+        with ThreadPoolExecutor(6) as executor:
+            status_codes = list(executor.map(lambda _: requests.get(url).status_code, range(6)))
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+    assert status_codes == [200] * 6
+    assert handler.max_concurrency == 2
+
+
+def test_requests_in_flight_are_finished_on_stop() -> None:
+    handler = EchoHandler(delay=0.3)
+    http_server, thread = _start({'/': handler})
+    url = f'http://127.0.0.1:{http_server.server_port}/'
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(requests.get, url)
+        while handler.concurrency == 0:
+            time.sleep(0.01)
+
+        http_server.stop()
+        thread.join(5)
+        http_server.server_close()
+
+        response = future.result()
+
+    assert response.status_code == 200
+    assert response.headers['connection'] == 'close'
+    with pytest.raises(requests.ConnectionError):
+        requests.get(url, timeout=1)
+
+
+def test_serve_command_stops_on_sigterm() -> None:
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'ccproxy.cli', 'serve', '--port', '0', '--workers', '2'],
+        cwd=_PROJECT_DIR,
+        env=os.environ | {'WARMUP_CHECK_COOKIES': 'false', 'TRACING_ENABLED': 'false'},
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    assert process.stderr is not None
+    try:
+        url = None
+        for line in process.stderr:
+            if 'Listening on ' in line:
+                url = line.split('Listening on ')[1].split(' ')[0]
+                break
+
+        assert url is not None
+        assert requests.post(f'{url}/login', data='not json').status_code == 400
+
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        process.kill()
+        process.wait()
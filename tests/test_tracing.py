@@ -0,0 +1,105 @@
+from unittest.mock import Mock, patch
+from ccproxy import tracing
+from ccproxy.handlers.process_action import process_action_handler
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+import contextvars
+import json
+import pytest
+
+
+def _handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
+    with tracing.span('stage'):
+        tracing.count('things', 2)
+        tracing.count('things')
+    tracing.flag('foo', 'bar')
+
+    return {'statusCode': 201}
+
+
+def test_disabled_tracing(capsys: pytest.CaptureFixture[str]) -> None:
+    result = tracing.traced('foo')(_handler)({}, {})
+
+    assert result == {'statusCode': 201}
+    assert capsys.readouterr().out == ''
+    assert isinstance(tracing.span('stage'), tracing._NoopSpan)
+
+
+@patch('ccproxy.config.TRACING_ENABLED', True)
+def test_enabled_tracing(capsys: pytest.CaptureFixture[str]) -> None:
+    tracing.traced('foo')(_handler)({}, {})
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+
+    record = json.loads(lines[0])
+    metrics = record['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Dimensions'] == [['handler']]
+    assert {metric['Name'] for metric in metrics['Metrics']} == {'stage', 'total', 'things'}
+    assert record['handler'] == 'foo'
+    assert record['status_code'] == 201
+    assert record['things'] == 3
+    assert record['foo'] == 'bar'
+    assert 0 <= record['stage'] <= record['total']
+    assert isinstance(record['cold_start'], bool)
+    # the trace doesn't outlive the invocation
+    assert isinstance(tracing.span('stage'), tracing._NoopSpan)
+
+
+@patch('ccproxy.config.TRACING_ENABLED', True)
+def test_trace_is_emitted_on_exception(capsys: pytest.CaptureFixture[str]) -> None:
+    def failing_handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
+        with tracing.span('stage'):
+            raise ValueError()
+
+    with pytest.raises(ValueError):
+        tracing.traced('foo')(failing_handler)({}, {})
+
+    record = json.loads(capsys.readouterr().out)
+    assert 'stage' in record
+    assert 'status_code' not in record
+
+
+@patch('ccproxy.config.TRACING_ENABLED', True)
+def test_spans_are_summed_across_threads(capsys: pytest.CaptureFixture[str]) -> None:
+    def stage() -> None:
+        with tracing.span('stage'):
+            tracing.count('calls')
+
+    def run_stage(context: contextvars.Context) -> None:
+        context.run(stage)
+
+    def handler(event: dict[str, Any], context: Any) -> dict[str, Any]:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for future in [executor.submit(run_stage, contextvars.copy_context()) for _ in range(8)]:
+                future.result()
+
+        return {'statusCode': 200}
+
+    tracing.traced('foo')(handler)({}, {})
+
+    assert json.loads(capsys.readouterr().out)['calls'] == 8
+
+
+@patch('ccproxy.config.TRACING_ENABLED', True)
+@patch('ccproxy.container.get_account_table')
+@patch('ccproxy.handlers.process_action.do_api_call')
+def test_process_action_handler(
+    mock_do_api_call: Mock,
+    mock_get_account_table: Mock,
+    capsys: pytest.CaptureFixture[str]
+) -> None:
+    mock_get_account_table.return_value.find.return_value = Mock()
+    mock_do_api_call.return_value = 'Done'
+
+    result = process_action_handler(
+        {'queryStringParameters': {'action': 'foo'}, 'headers': {'x-ccproxy-account': '1234'}},
+        {}
+    )
+
+    assert result['statusCode'] == 200
+
+    record = json.loads(capsys.readouterr().out)
+    assert record['handler'] == 'process_action'
+    assert record['status_code'] == 200
+    assert 'total' in record
@@ -0,0 +1,104 @@
+from unittest.mock import Mock, patch
+from ccproxy import config, retry, warmup
+import time
+
+
+@patch('ccproxy.main.refresh_stale_cookies')
+@patch('ccproxy.network.warm_up_connection')
+@patch('ccproxy.network.get_known_origins')
+@patch('ccproxy.container.get_config_loader')
+@patch('ccproxy.container.get_account_cache')
+@patch('ccproxy.container.get_account_table')
+def test_warm_up(
+    mock_get_account_table: Mock,
+    mock_get_account_cache: Mock,
+    mock_get_config_loader: Mock,
+    mock_get_known_origins: Mock,
+    mock_warm_up_connection: Mock,
+    mock_refresh_stale_cookies: Mock
+) -> None:
+    account = Mock()
+    account.host = 'https://192.168.1.124:8443'
+    mock_get_account_cache.return_value.accounts.return_value = [account]
+    mock_get_known_origins.return_value = ['https://192.168.1.123:8443']
+
+    with (
+        patch('ccproxy.config.WARMUP_HOSTS', 'https://192.168.1.123:8443, https://192.168.1.125'),
+        patch('ccproxy.config.WARMUP_CHECK_COOKIES', True)
+    ):
+        timings = warmup.warm_up()
+
+    assert list(timings.keys()) == ['account_table', 'config', 'connections', 'cookies']
+    assert all(timing >= 0 for timing in timings.values())
+
+    mock_get_account_table.return_value.ping.assert_called_once()
+    mock_get_config_loader.return_value.load.assert_called_once()
+    assert sorted(call.args for call in mock_warm_up_connection.call_args_list) == [
+        ('https://192.168.1.123:8443', config.WARMUP_TIMEOUT),
+        ('https://192.168.1.124:8443', config.WARMUP_TIMEOUT),
+        ('https://192.168.1.125', config.WARMUP_TIMEOUT)
+    ]
+    mock_refresh_stale_cookies.assert_called_once_with(
+        [account], mock_get_account_table.return_value
+    )
+
+
+@patch('ccproxy.main.refresh_stale_cookies')
+@patch('ccproxy.network.warm_up_connection')
+@patch('ccproxy.network.get_known_origins')
+@patch('ccproxy.container.get_config_loader')
+@patch('ccproxy.container.get_account_cache')
+@patch('ccproxy.container.get_account_table')
+def test_failing_step_does_not_stop_warm_up(
+    mock_get_account_table: Mock,
+    mock_get_account_cache: Mock,
+    mock_get_config_loader: Mock,
+    mock_get_known_origins: Mock,
+    mock_warm_up_connection: Mock,
+    mock_refresh_stale_cookies: Mock
+) -> None:
+    mock_get_account_cache.return_value.accounts.return_value = []
+    mock_get_known_origins.return_value = []
+    mock_get_config_loader.return_value.load.side_effect = FileNotFoundError('config.json')
+
+    with (
+        patch('ccproxy.config.WARMUP_HOSTS', ''),
+        patch('ccproxy.config.WARMUP_CHECK_COOKIES', False)
+    ):
+        timings = warmup.warm_up()
+
+    assert list(timings.keys()) == ['account_table', 'config', 'connections']
+    mock_warm_up_connection.assert_not_called()
+    mock_refresh_stale_cookies.assert_not_called()
+
+
+@patch('ccproxy.network.warm_up_connection')
+@patch('ccproxy.network.get_known_origins')
+@patch('ccproxy.container.get_account_cache')
+def test_warm_up_connections_within_deadline(
+    mock_get_account_cache: Mock,
+    mock_get_known_origins: Mock,
+    mock_warm_up_connection: Mock
+) -> None:
+    mock_get_account_cache.return_value.accounts.return_value = []
+    mock_get_known_origins.return_value = ['https://192.168.1.123:8443', 'https://192.168.1.124:8443']
+    mock_warm_up_connection.side_effect = [True, ConnectionError('unreachable')]
+
+    token = retry._deadline.set(time.monotonic() + 0.5)
+    try:
+        with patch('ccproxy.config.WARMUP_HOSTS', ''):
+            warmup._warm_up_connections()
+
+        # the other host still gets warmed up
+        assert mock_warm_up_connection.call_count == 2
+        assert all(0 < call.args[1] <= 0.25 for call in mock_warm_up_connection.call_args_list)
+
+        mock_warm_up_connection.reset_mock()
+        retry._deadline.set(time.monotonic())
+
+        with patch('ccproxy.config.WARMUP_HOSTS', ''):
+            warmup._warm_up_connections()
+
+        mock_warm_up_connection.assert_not_called()
+    finally:
+        retry._deadline.reset(token)